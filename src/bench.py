@@ -0,0 +1,942 @@
+"""## This file contains the benchmarks and performance checks of the pipeline
+
+Run them from the src directory, e.g. `python bench.py import-time`, or run the whole suite on a synthetic corpus
+and compare two runs with `python bench.py suite --scale 16k` and `python bench.py compare old.json new.json`
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import polars as pl
+
+import helpers
+from config import *
+from synthetic import (
+    StubServer,
+    make_archive_html,
+    make_archive_records,
+    make_scraped_df,
+    make_vtt,
+    vocabulary,
+)
+
+
+def measure_import_time(module: str = "helpers", repeat: int = 5) -> float:
+    """Returns the best cold import time of the module in seconds, each attempt in a fresh interpreter."""
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def check_import_time(
+    module: str = "helpers", budget: float = import_time_budget
+) -> bool:
+    """Checks that importing the module stays under budget seconds, and that it doesn't pull in any of the lazy_dependencies."""
+    import_time = measure_import_time(module)
+    code = f"import sys, {module}; print(','.join(m for m in {lazy_dependencies!r} if m in sys.modules))"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    eager_dependencies = [m for m in output.strip().split(",") if m]
+    print(f"import {module}: {import_time:.3f}s (budget {budget:.3f}s)")
+    if eager_dependencies:
+        print(f"import {module} eagerly imports: {', '.join(eager_dependencies)}")
+    return import_time <= budget and not eager_dependencies
+
+
+def check_archive_parser(
+    n_videos: int = 2000, chunk_sizes: list[int] = [13, 64, 4096], seed: int = 0
+) -> bool:
+    """Checks that parsing a synthetic archive page fed in pieces of every chunk_size gives the same records
+    as parsing it in one piece, e.g. that sections split between two pieces keep their spaces.
+    """
+    html = make_archive_html(random.Random(seed), n_videos).encode()
+
+    def parse(chunk_size: int) -> list[dict]:
+        return [
+            record
+            for records in helpers.iter_archive_records(html, chunk_size=chunk_size)
+            for record in records
+        ]
+
+    expected = parse(len(html))
+    ok = True
+    for chunk_size in chunk_sizes:
+        records = parse(chunk_size)
+        differing = sum(a != b for a, b in zip(records, expected)) + abs(
+            len(records) - len(expected)
+        )
+        print(f"archive parser, {chunk_size} byte pieces: {differing} records differ")
+        ok = ok and not differing
+    return ok
+
+
+def legacy_vtt_to_text(vtt_text: str) -> str:
+    """The webvtt-py based vtt_to_text, which only skipped exact repeats. Kept as the baseline of benchmark_vtt."""
+    import webvtt
+
+    text_captions = [""]
+    captions = webvtt.from_buffer(io.StringIO(vtt_text))
+    for caption in captions:
+        if caption.text != text_captions[-1]:
+            text_captions.append(caption.text)
+    return " ".join(text_captions).strip()
+
+
+def benchmark_vtt(n_files: int = 16000, n_cues: int = 600, seed: int = 0) -> dict:
+    """Times legacy_vtt_to_text, vtt_to_text and vtt_column_to_text over n_files synthetic VTT files."""
+    rng = random.Random(seed)
+    vtts = pl.Series("vtt", [make_vtt(rng, n_cues) for _ in range(n_files)])
+    results = {"n_files": n_files, "n_cues": n_cues}
+
+    start = time.perf_counter()
+    legacy_texts = [legacy_vtt_to_text(vtt) for vtt in vtts]
+    results["legacy_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    texts = [helpers.vtt_to_text(vtt) for vtt in vtts]
+    results["vtt_to_text_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    helpers.vtt_column_to_text(vtts)
+    results["vtt_column_to_text_seconds"] = time.perf_counter() - start
+
+    results["legacy_words"] = sum(len(text.split()) for text in legacy_texts)
+    results["words"] = sum(len(text.split()) for text in texts)
+    for name, value in results.items():
+        print(
+            f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}"
+        )
+    return results
+
+
+def benchmark_rules(
+    rule_counts: list[int] = [1, 5, 10, 25, 50, 100],
+    n_rows: int = 16000,
+    seed: int = 0,
+) -> list[dict]:
+    """Times applying n rules with one str.replace_all per rule (the previous to_pre_scraping_df) against compile_replacements.
+
+    The column is a synthetic title column with n_rows rows, where one title in ten has a word stuck to a year,
+    and every rule splits one word from a year."""
+    rng = random.Random(seed)
+    titles = pl.Series(
+        "title",
+        [
+            " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 8)))
+            + (
+                f" {rng.choice(vocabulary)}{rng.randint(2000, 2025)}"
+                if rng.random() < 0.1
+                else ""
+            )
+            for _ in range(n_rows)
+        ],
+    )
+    words = sorted(set(vocabulary))
+    results = []
+    for rule_count in rule_counts:
+        rules = {
+            rf"({words[i % len(words)]}{'x' * (i // len(words))})(\d{{4}})": r"${1} ${2}"
+            for i in range(rule_count)
+        }
+        lf = titles.to_frame().lazy()
+
+        start = time.perf_counter()
+        per_rule = lf
+        for pattern, replacement in rules.items():
+            per_rule = per_rule.with_columns(
+                pl.col("title").str.replace_all(pattern, replacement)
+            )
+        per_rule = per_rule.collect()
+        per_rule_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compiled = lf.with_columns(
+            helpers.compile_replacements(titles, rules)
+        ).collect()
+        compiled_seconds = time.perf_counter() - start
+
+        assert per_rule.equals(compiled)
+        result = {
+            "rules": rule_count,
+            "live_rules": len(helpers.live_replacements(titles, rules)),
+            "per_rule_seconds": per_rule_seconds,
+            "compiled_seconds": compiled_seconds,
+        }
+        print(
+            f"rules: {rule_count:4} live: {result['live_rules']:4} "
+            f"per rule: {per_rule_seconds:.4f}s compiled: {compiled_seconds:.4f}s"
+        )
+        results.append(result)
+    return results
+
+
+def _timed(function, *args, **kwargs) -> tuple[object, float]:
+    """Returns the result of function(*args, **kwargs) and the seconds it took."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _result(seconds: float, rows_in: int, rows_out: int, **extra) -> dict:
+    return {
+        "seconds": seconds,
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+        "rows_per_second": rows_in / seconds if seconds else None,
+        **extra,
+    }
+
+
+def benchmark_scrape(
+    n_videos: int = 1000,
+    latency: float = bench_stub_latency,
+    n_cues: int = 200,
+    seed: int = 0,
+    sequential_sample: int = 50,
+) -> dict:
+    """Times scraping the mp4_url and the vtt of n_videos videos from a StubServer, with the http cache disabled.
+
+    The first sequential_sample video pages are also fetched one by one with requests.get, the way the scraper used to,
+    as the baseline."""
+    import fetching
+    import requests
+
+    http_cache_was_enabled = fetching.http_cache_enabled
+    fetching.http_cache_enabled = False
+    try:
+        with StubServer(n_videos, latency, seed, n_cues) as server:
+            video_urls = [
+                f"{server.url}/pages/video.php?id={i}" for i in range(n_videos)
+            ]
+            start = time.perf_counter()
+            for video_url in video_urls[:sequential_sample]:
+                helpers.get_mp4_url_from_html(requests.get(video_url).text)
+            sequential_seconds = time.perf_counter() - start
+
+            df_mp4, video_seconds = _timed(
+                helpers.get_mp4_urls_from_video_urls, video_urls
+            )
+            vtt_urls = df_mp4["mp4_url"].str.replace(r"mp4$", "vtt")
+            df_vtt, vtt_seconds = _timed(helpers.get_vtts_from_vtt_urls, vtt_urls)
+    finally:
+        fetching.http_cache_enabled = http_cache_was_enabled
+
+    seconds = video_seconds + vtt_seconds
+    return _result(
+        seconds,
+        2 * n_videos,
+        df_vtt["vtt"].drop_nulls().len(),
+        latency=latency,
+        errors=df_mp4["error"].drop_nulls().len() + df_vtt["error"].drop_nulls().len(),
+        video_pages_per_second=n_videos / video_seconds,
+        sequential_video_pages_per_second=sequential_sample / sequential_seconds,
+    )
+
+
+suite_benchmarks = ["archive", "pre_scraping", "vtt", "transcripts", "chunks", "scrape"]
+"""The benchmarks of run_suite, in the order of the pipeline stages"""
+
+
+def run_suite(
+    scale: str = "1k",
+    benchmarks: list[str] = suite_benchmarks,
+    n_cues: int = 200,
+    latency: float = bench_stub_latency,
+    seed: int = 0,
+) -> dict:
+    """Runs the benchmarks of the pipeline stages on a synthetic corpus of bench_scales[scale] videos.
+
+    - archive: get_records_from_html_file on a synthetic archive page.
+    - pre_scraping: to_pre_scraping_df on the archive records.
+    - vtt: vtt_column_to_transcript on one synthetic VTT of n_cues cues per video.
+    - transcripts: to_transcript_df on the scraped df.
+    - chunks: to_chunk_df on the transcript df.
+    - scrape: benchmark_scrape against a StubServer answering after latency seconds.
+
+    Generating the corpus is not timed. Returns the environment and one result per benchmark.
+    """
+    n_videos = bench_scales[scale]
+    results = {}
+
+    if "archive" in benchmarks:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "archive.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(make_archive_html(random.Random(seed), n_videos))
+            records, seconds = _timed(helpers.get_records_from_html_file, path)
+        results["archive"] = _result(seconds, n_videos, len(records))
+
+    if "pre_scraping" in benchmarks:
+        records = make_archive_records(random.Random(seed), n_videos)
+        df, seconds = _timed(helpers.to_pre_scraping_df, records)
+        results["pre_scraping"] = _result(seconds, len(records), df.height)
+
+    if {"vtt", "transcripts", "chunks"} & set(benchmarks):
+        df_scraped = make_scraped_df(random.Random(seed), n_videos, n_cues)
+        transcripts, seconds = _timed(
+            helpers.vtt_column_to_transcript, df_scraped["vtt"]
+        )
+        if "vtt" in benchmarks:
+            results["vtt"] = _result(
+                seconds, df_scraped.height, transcripts.height, n_cues=n_cues
+            )
+        df_transcript, seconds = _timed(
+            helpers.to_transcript_df,
+            df_scraped.with_columns(transcripts.get_columns()),
+        )
+        if "transcripts" in benchmarks:
+            results["transcripts"] = _result(
+                seconds, df_scraped.height, df_transcript.height
+            )
+        if "chunks" in benchmarks:
+            try:
+                df_chunks, seconds = _timed(helpers.to_chunk_df, df_transcript)
+                results["chunks"] = _result(
+                    seconds, df_transcript.height, df_chunks.height
+                )
+            except OSError as e:
+                # The tokenizer could not be loaded, e.g. offline without a local copy
+                results["chunks"] = {"error": str(e)}
+
+    if "scrape" in benchmarks:
+        results["scrape"] = benchmark_scrape(
+            n_videos, latency, n_cues, seed, min(n_videos, 50)
+        )
+
+    return {
+        "scale": scale,
+        "n_videos": n_videos,
+        "seed": seed,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+
+def compare_results(old: dict, new: dict) -> list[dict]:
+    """Compares the seconds of every benchmark found in both suite results. speedup > 1 means new is faster."""
+    comparison = []
+    for name, new_result in new["results"].items():
+        old_result = old["results"].get(name, {})
+        if "seconds" not in old_result or "seconds" not in new_result:
+            continue
+        comparison.append(
+            {
+                "benchmark": name,
+                "old_seconds": old_result["seconds"],
+                "new_seconds": new_result["seconds"],
+                "speedup": old_result["seconds"] / new_result["seconds"],
+            }
+        )
+        print(
+            f"{name:14} old: {old_result['seconds']:9.3f}s new: {new_result['seconds']:9.3f}s "
+            f"speedup: {comparison[-1]['speedup']:.2f}x"
+        )
+    return comparison
+
+
+def _latency_ms(latencies: list[float]) -> dict:
+    """The p50, p95 and mean of latencies in seconds, in milliseconds."""
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p95_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+    }
+
+
+def _recall(results: list[list[str]], exact: list[list[str]]) -> float:
+    """The share of the exact top k chunk_ids found by results."""
+    found = sum(
+        len(set(ids) & set(exact_ids)) for ids, exact_ids in zip(results, exact)
+    )
+    return found / max(1, sum(len(exact_ids) for exact_ids in exact))
+
+
+def benchmark_vector_query(
+    n_chunks: int = bench_vector_rows,
+    n_queries: int = 200,
+    k: int = 10,
+    chroma: bool = True,
+    seed: int = 0,
+) -> dict:
+    """Times the queries of VectorIndex against the equivalent Chroma query, on n_chunks synthetic chunks.
+
+    - load: opening the index.
+    - f32, int8: one query at a time, unfiltered and filtered on one preacher.
+    - batched: all the queries in one search call, per query.
+    - concurrent: all the queries submitted to the thread pool of the index, per query.
+    - chroma: collection.query with query_embeddings, unfiltered and with where={"preacher": ...}.
+
+    The recall@k of int8 and Chroma (approximate HNSW) is measured against the exact float32 results.
+    Writing the indexes and the Chroma collection is not timed."""
+    import vector_index
+    from synthetic import iter_chunk_embeddings
+
+    rng = random.Random(seed)
+    np_random = np.random.default_rng(seed)
+    query_rows = sorted(rng.sample(range(n_chunks), min(n_queries, n_chunks)))
+    queries = []
+    results = {"n_chunks": n_chunks, "n_queries": len(query_rows), "k": k}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writers = {
+            "f32": vector_index.VectorIndexWriter(os.path.join(tmp_dir, "f32"), False),
+            "int8": vector_index.VectorIndexWriter(os.path.join(tmp_dir, "int8"), True),
+        }
+        collection = None
+        if chroma:
+            import chromadb
+            from chromadb import Settings
+
+            client = chromadb.PersistentClient(
+                path=os.path.join(tmp_dir, "chroma"),
+                settings=Settings(anonymized_telemetry=False),
+            )
+            collection = client.create_collection(
+                "bench_chunks", metadata={"hnsw:space": "cosine"}
+            )
+        offset = 0
+        for rows, embeddings in iter_chunk_embeddings(n_chunks, seed=seed):
+            for writer in writers.values():
+                writer.write(rows, embeddings)
+            if collection is not None:
+                for i in range(0, rows.height, 5000):
+                    collection.add(
+                        ids=rows["chunk_id"][i : i + 5000].to_list(),
+                        embeddings=embeddings[i : i + 5000],
+                        metadatas=rows.select("preacher", "section")[
+                            i : i + 5000
+                        ].to_dicts(),
+                    )
+            for row in query_rows:
+                if offset <= row < offset + rows.height:
+                    # Perturbed, so a query isn't exactly one of the chunks
+                    queries.append(
+                        (
+                            embeddings[row - offset]
+                            + np_random.standard_normal(
+                                embeddings.shape[1], dtype=np.float32
+                            ),
+                            rows["preacher"][row - offset],
+                        )
+                    )
+            offset += rows.height
+            print(f"vector-query: {offset}/{n_chunks} chunks written")
+        for writer in writers.values():
+            writer.close()
+
+        indexes = {}
+        for name in writers:
+            indexes[name], seconds = _timed(
+                vector_index.VectorIndex, os.path.join(tmp_dir, name)
+            )
+            results[f"{name}_load_ms"] = 1000 * seconds
+        exact = {}
+        for name, index in indexes.items():
+            for filtered in [False, True]:
+                latencies = []
+                ids = []
+                for query, preacher in queries:
+                    (df,), seconds = _timed(
+                        index.search,
+                        query,
+                        k,
+                        {"preacher": preacher} if filtered else None,
+                    )
+                    latencies.append(seconds)
+                    ids.append(df["chunk_id"].to_list())
+                key = f"{name}{'_filtered' if filtered else ''}"
+                results[key] = _latency_ms(latencies)
+                if name == "f32":
+                    exact[filtered] = ids
+                else:
+                    results[key]["recall"] = _recall(ids, exact[filtered])
+
+        index = indexes["f32"]
+        query_matrix = np.stack([query for query, _ in queries])
+        _, seconds = _timed(index.search, query_matrix, k)
+        results["f32_batched_ms_per_query"] = 1000 * seconds / len(queries)
+        start = time.perf_counter()
+        futures = [index.submit(query, k) for query, _ in queries]
+        for future in futures:
+            future.result()
+        results["f32_concurrent_ms_per_query"] = (
+            1000 * (time.perf_counter() - start) / len(queries)
+        )
+        for index in indexes.values():
+            index.close()
+
+        if collection is not None:
+            for filtered in [False, True]:
+                latencies = []
+                ids = []
+                for query, preacher in queries:
+                    response, seconds = _timed(
+                        collection.query,
+                        query_embeddings=[query],
+                        n_results=k,
+                        where={"preacher": preacher} if filtered else None,
+                    )
+                    latencies.append(seconds)
+                    ids.append(response["ids"][0])
+                key = f"chroma{'_filtered' if filtered else ''}"
+                results[key] = _latency_ms(latencies)
+                results[key]["recall"] = _recall(ids, exact[filtered])
+    print(json.dumps(results, indent=2))
+    return results
+
+
+def benchmark_keyword_query(
+    n_chunks: int = bench_vector_rows, n_queries: int = 200, k: int = 10, seed: int = 0
+) -> dict:
+    """Times building a BM25Index of n_chunks synthetic chunks in ingest_batch_size batches, like the ingestion does,
+    and its queries of 1 to 4 words drawn like the chunk words, one query at a time."""
+    import keyword_index
+    from synthetic import iter_chunk_texts
+
+    rng = np.random.default_rng(seed)
+    results = {"n_chunks": n_chunks, "n_queries": n_queries, "k": k}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = keyword_index.BM25Index(os.path.join(tmp_dir, "bm25"))
+        seconds = 0.0
+        for chunk_ids, texts in iter_chunk_texts(n_chunks, seed=seed):
+            for i in range(0, len(chunk_ids), ingest_batch_size):
+                _, batch_seconds = _timed(
+                    index.add,
+                    chunk_ids[i : i + ingest_batch_size],
+                    texts[i : i + ingest_batch_size],
+                )
+                seconds += batch_seconds
+            print(f"keyword-query: {len(index)}/{n_chunks} chunks indexed")
+        results["index_chunks_per_second"] = n_chunks / seconds
+        results["index_bytes"] = sum(
+            os.path.getsize(os.path.join(tmp_dir, "bm25", name))
+            for name in os.listdir(os.path.join(tmp_dir, "bm25"))
+        )
+        results["segments"] = index._db.execute(
+            "SELECT COUNT(*) FROM segments"
+        ).fetchone()[0]
+        for n_words in [1, 2, 4]:
+            latencies = []
+            for _ in range(n_queries):
+                words = np.minimum(rng.zipf(1.2, n_words) - 1, 49_999)
+                query = " ".join(f"w{word}" for word in words)
+                latencies.append(_timed(index.search, query, k)[1])
+            results[f"{n_words}_words"] = _latency_ms(latencies)
+        index.close()
+    print(json.dumps(results, indent=2))
+    return results
+
+
+def check_keyword_index_refresh(
+    n_chunks: int = 2000, n_queries: int = 50, seed: int = 0
+) -> bool:
+    """Checks that a BM25Index opened before another handle added and deleted chunks ranks them like a handle opened
+    afterwards, instead of failing on the doc_ids it didn't load."""
+    import keyword_index
+    from synthetic import iter_chunk_texts
+
+    rng = np.random.default_rng(seed)
+    chunk_ids, texts = next(iter_chunk_texts(n_chunks, seed=seed))
+    queries = [
+        " ".join(f"w{word}" for word in np.minimum(rng.zipf(1.2, 2) - 1, 49_999))
+        for _ in range(n_queries)
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reader = keyword_index.BM25Index(tmp_dir)
+        writer = keyword_index.BM25Index(tmp_dir)
+        half = n_chunks // 2
+        writer.add(chunk_ids[:half], texts[:half])
+        for query in queries:
+            reader.search(query)
+        writer.add(chunk_ids[half:], texts[half:])
+        writer.delete(chunk_ids[: n_chunks // 10])
+        fresh = keyword_index.BM25Index(tmp_dir)
+        differing = 0
+        for query in queries:
+            filtered = chunk_ids[::3]
+            differing += not reader.search(query).equals(fresh.search(query))
+            differing += not reader.search(query, 10, reader.doc_ids(filtered)).equals(
+                fresh.search(query, 10, fresh.doc_ids(filtered))
+            )
+        for index in [reader, writer, fresh]:
+            index.close()
+    print(f"keyword index refresh: {differing} of {2 * n_queries} searches differ")
+    return not differing
+
+
+def benchmark_query_cache(
+    n_chunks: int = 100_000,
+    n_queries: int = 2000,
+    n_distinct: int = 200,
+    encoder_ms: float = 5.0,
+    k: int = 10,
+    seed: int = 0,
+) -> dict:
+    """Times hybrid searches of n_chunks synthetic chunks with and without the query cache.
+
+    The n_queries queries are drawn from n_distinct queries of 1 to 3 words with Zipf popularity, a third of them
+    filtered on one preacher. The encoder is stood in for by a hashed random embedding that takes encoder_ms,
+    about the latency of MiniLM on one query on a CPU. Writing the indexes is not timed.
+    """
+    import keyword_index
+    import query_cache
+    import search
+    import vector_index
+    from synthetic import iter_chunk_embeddings
+
+    rng = random.Random(seed)
+
+    def embedding_function(texts: list[str]) -> np.ndarray:
+        time.sleep(encoder_ms / 1000 * len(texts))
+        return np.stack(
+            [
+                np.random.default_rng(zlib.crc32(text.encode())).standard_normal(
+                    384, dtype=np.float32
+                )
+                for text in texts
+            ]
+        )
+
+    distinct = [
+        (
+            " ".join(rng.sample(vocabulary, rng.randint(1, 3))),
+            (
+                {"preacher": f"preacher {rng.randrange(50)}"}
+                if rng.random() < 1 / 3
+                else None
+            ),
+        )
+        for _ in range(n_distinct)
+    ]
+    weights = [1 / rank for rank in range(1, n_distinct + 1)]
+    queries = rng.choices(distinct, weights, k=n_queries)
+    results = {
+        "n_chunks": n_chunks,
+        "n_queries": n_queries,
+        "n_distinct": n_distinct,
+        "encoder_ms": encoder_ms,
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writer = vector_index.VectorIndexWriter(os.path.join(tmp_dir, "vectors"), False)
+        keywords = keyword_index.BM25Index(os.path.join(tmp_dir, "bm25"))
+        for rows, embeddings in iter_chunk_embeddings(n_chunks, seed=seed):
+            writer.write(rows, embeddings)
+            keywords.add(rows["chunk_id"].to_list(), rows["chunk"].to_list())
+        writer.close()
+        vectors = vector_index.VectorIndex(os.path.join(tmp_dir, "vectors"))
+
+        engine = search.SearchEngine(vectors, keywords, embedding_function)
+        latencies = [
+            _timed(engine.search, query, k, filters)[1] for query, filters in queries
+        ]
+        results["uncached"] = _latency_ms(latencies)
+        cached = query_cache.CachedSearchEngine(
+            vectors,
+            keywords,
+            embedding_function,
+            version_path=os.path.join(tmp_dir, "collection_version"),
+        )
+        for query, filters in queries:
+            cached.search(query, k, filters)
+        results["cached"] = cached.stats()
+        vectors.close()
+        keywords.close()
+    print(json.dumps(results, indent=2))
+    return results
+
+
+def check_query_cache_refresh(
+    n_chunks: int = 4000, n_queries: int = 30, seed: int = 0
+) -> bool:
+    """Checks that a CachedSearchEngine queried before chunks were ingested through other index handles, and the
+    vector index rebuilt, returns the same results as an engine opened afterwards, in every mode.
+    """
+    import keyword_index
+    import query_cache
+    import search
+    import vector_index
+    from synthetic import iter_chunk_embeddings
+
+    rng = random.Random(seed)
+    batches = list(
+        iter_chunk_embeddings(n_chunks, dim=32, seed=seed, batch_size=n_chunks // 2)
+    )
+    queries = [
+        (
+            " ".join(rng.sample(vocabulary, 2)),
+            (
+                {"preacher": f"preacher {rng.randrange(50)}"}
+                if rng.random() < 0.5
+                else None
+            ),
+        )
+        for _ in range(n_queries)
+    ]
+
+    def embedding_function(texts: list[str]) -> np.ndarray:
+        return np.stack(
+            [
+                np.random.default_rng(zlib.crc32(text.encode())).standard_normal(
+                    32, dtype=np.float32
+                )
+                for text in texts
+            ]
+        )
+
+    def ingest(batches: list, tmp_dir: str):
+        """Adds the batches to the keyword index through a new handle, and rebuilds the vector index with them."""
+        writer = vector_index.VectorIndexWriter(os.path.join(tmp_dir, "vectors"), False)
+        keywords = keyword_index.BM25Index(os.path.join(tmp_dir, "bm25"))
+        for rows, embeddings in batches:
+            writer.write(rows, embeddings)
+            keywords.add(rows["chunk_id"].to_list(), rows["chunk"].to_list())
+        writer.close()
+        keywords.close()
+        query_cache.bump_collection_version(os.path.join(tmp_dir, "collection_version"))
+
+    differing = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ingest(batches[:1], tmp_dir)
+        cached = query_cache.CachedSearchEngine(
+            vector_index.VectorIndex(os.path.join(tmp_dir, "vectors")),
+            keyword_index.BM25Index(os.path.join(tmp_dir, "bm25")),
+            embedding_function,
+            version_path=os.path.join(tmp_dir, "collection_version"),
+        )
+        for mode in search.search_modes:
+            for query, filters in queries:
+                cached.search(query, 10, filters, mode)
+        ingest(batches, tmp_dir)
+        fresh = search.SearchEngine(
+            vector_index.VectorIndex(os.path.join(tmp_dir, "vectors")),
+            keyword_index.BM25Index(os.path.join(tmp_dir, "bm25")),
+            embedding_function,
+        )
+        for mode in search.search_modes:
+            for query, filters in queries:
+                differing += not cached.search(query, 10, filters, mode).equals(
+                    fresh.search(query, 10, filters, mode)
+                )
+        for engine in [cached, fresh]:
+            engine.vector_index.close()
+            engine.keyword_index.close()
+    print(
+        f"query cache refresh: {differing} of {len(search.search_modes) * n_queries} searches differ"
+    )
+    return not differing
+
+
+def _parquet_bytes(*dfs: pl.DataFrame) -> int:
+    """The total size of the dfs written as Parquet, with the default compression."""
+    total = 0
+    for df in dfs:
+        buffer = io.BytesIO()
+        df.write_parquet(buffer)
+        total += buffer.tell()
+    return total
+
+
+def benchmark_chunk_storage(
+    n_videos: int = 1000, n_cues: int = 600, seed: int = 0
+) -> dict:
+    """Compares the size of the chunks of n_videos synthetic videos stored as the wide frame of to_chunked_record_df,
+    and as the chunk table of to_chunk_df plus the video table of to_video_df, in memory and in Parquet.
+
+    Also times the lazy join of the wide view, for the whole chunk table and for one ingest_batch_size batch.
+    """
+    df_scraped = make_scraped_df(random.Random(seed), n_videos, n_cues)
+    df_transcript = helpers.to_transcript_df(
+        df_scraped.with_columns(
+            helpers.vtt_column_to_transcript(df_scraped["vtt"]).get_columns()
+        )
+    )
+    df_chunks = helpers.to_chunk_df(df_transcript)
+    df_videos = helpers.to_video_df(df_transcript)
+    df_wide = (
+        helpers.join_chunk_videos(df_chunks, df_transcript)
+        .select(helpers.ChunkedRecordDataFrameModel.columns)
+        .collect()
+    )
+    _, join_seconds = _timed(
+        lambda: helpers.join_chunk_videos(df_chunks, df_videos).collect()
+    )
+    _, batch_join_seconds = _timed(
+        lambda: helpers.join_chunk_videos(
+            df_chunks.slice(0, ingest_batch_size), df_videos
+        ).collect()
+    )
+    results = {
+        "n_videos": df_videos.height,
+        "n_chunks": df_chunks.height,
+        "wide_memory_bytes": df_wide.estimated_size(),
+        "normalized_memory_bytes": df_chunks.estimated_size()
+        + df_videos.estimated_size(),
+        "wide_metadata_memory_bytes": df_wide.select(
+            helpers.video_columns
+        ).estimated_size(),
+        "video_table_memory_bytes": df_videos.estimated_size(),
+        "wide_parquet_bytes": _parquet_bytes(df_wide),
+        "normalized_parquet_bytes": _parquet_bytes(df_chunks, df_videos),
+        "join_ms": 1000 * join_seconds,
+        "batch_join_ms": 1000 * batch_join_seconds,
+    }
+    print(json.dumps(results, indent=2))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    import_time_parser = subparsers.add_parser(
+        "import-time", help="Fails if importing a module exceeds import_time_budget"
+    )
+    import_time_parser.add_argument("--module", default="helpers")
+    import_time_parser.add_argument("--budget", type=float, default=import_time_budget)
+    archive_parser = subparsers.add_parser(
+        "archive-parser",
+        help="Fails if parsing the archive page in pieces changes the records",
+    )
+    archive_parser.add_argument("--videos", type=int, default=2000)
+    vtt_parser = subparsers.add_parser(
+        "vtt", help="Compares the VTT to text converters on a synthetic corpus"
+    )
+    vtt_parser.add_argument("--files", type=int, default=16000)
+    vtt_parser.add_argument("--cues", type=int, default=600)
+    rules_parser = subparsers.add_parser(
+        "rules", help="Cost of the replacement rules versus the number of rules"
+    )
+    rules_parser.add_argument("--rows", type=int, default=16000)
+    suite_parser = subparsers.add_parser(
+        "suite", help="Benchmarks every stage on a synthetic corpus, saved as JSON"
+    )
+    suite_parser.add_argument("--scale", choices=list(bench_scales), default="1k")
+    suite_parser.add_argument(
+        "--benchmarks", nargs="+", choices=suite_benchmarks, default=suite_benchmarks
+    )
+    suite_parser.add_argument("--cues", type=int, default=200)
+    suite_parser.add_argument("--latency", type=float, default=bench_stub_latency)
+    suite_parser.add_argument("--seed", type=int, default=0)
+    suite_parser.add_argument(
+        "--output", help="Defaults to bench_results_dir/<scale>-<timestamp>.json"
+    )
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compares two JSON results of the suite"
+    )
+    vector_parser = subparsers.add_parser(
+        "vector-query",
+        help="Latency of the vector index against Chroma on synthetic chunks",
+    )
+    vector_parser.add_argument("--chunks", type=int, default=bench_vector_rows)
+    vector_parser.add_argument("--queries", type=int, default=200)
+    vector_parser.add_argument("-k", type=int, default=10)
+    vector_parser.add_argument(
+        "--skip-chroma", action="store_true", help="Only benchmarks the vector index"
+    )
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    keyword_parser = subparsers.add_parser(
+        "keyword-query", help="Indexing rate and query latency of the BM25 index"
+    )
+    keyword_parser.add_argument("--chunks", type=int, default=bench_vector_rows)
+    keyword_parser.add_argument("--queries", type=int, default=200)
+    keyword_parser.add_argument("-k", type=int, default=10)
+    keyword_refresh_parser = subparsers.add_parser(
+        "keyword-refresh",
+        help="Fails if a BM25 index doesn't see the chunks another handle added",
+    )
+    keyword_refresh_parser.add_argument("--chunks", type=int, default=2000)
+    query_cache_refresh_parser = subparsers.add_parser(
+        "query-cache-refresh",
+        help="Fails if the query cache serves results of the indexes before an ingestion",
+    )
+    query_cache_refresh_parser.add_argument("--chunks", type=int, default=4000)
+    storage_parser = subparsers.add_parser(
+        "chunk-storage",
+        help="Size of the wide chunk frame against the chunk and video tables",
+    )
+    storage_parser.add_argument("--videos", type=int, default=1000)
+    storage_parser.add_argument("--cues", type=int, default=600)
+    query_cache_parser = subparsers.add_parser(
+        "query-cache",
+        help="Latency of repeated searches with and without the query cache",
+    )
+    query_cache_parser.add_argument("--chunks", type=int, default=100_000)
+    query_cache_parser.add_argument("--queries", type=int, default=2000)
+    query_cache_parser.add_argument("--distinct", type=int, default=200)
+    query_cache_parser.add_argument("--encoder-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.benchmark == "import-time":
+        if not check_import_time(args.module, args.budget):
+            sys.exit(1)
+    elif args.benchmark == "archive-parser":
+        if not check_archive_parser(args.videos):
+            sys.exit(1)
+    elif args.benchmark == "vtt":
+        benchmark_vtt(args.files, args.cues)
+    elif args.benchmark == "rules":
+        benchmark_rules(n_rows=args.rows)
+    elif args.benchmark == "suite":
+        results = run_suite(
+            args.scale, args.benchmarks, args.cues, args.latency, args.seed
+        )
+        output = args.output or os.path.join(
+            bench_results_dir,
+            f"{args.scale}-{results['timestamp'].replace(':', '')}.json",
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(json.dumps(results["results"], indent=2))
+        print(f"Saved to {output}")
+    elif args.benchmark == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        compare_results(old, new)
+    elif args.benchmark == "vector-query":
+        benchmark_vector_query(
+            args.chunks, args.queries, args.k, chroma=not args.skip_chroma
+        )
+    elif args.benchmark == "keyword-query":
+        benchmark_keyword_query(args.chunks, args.queries, args.k)
+    elif args.benchmark == "query-cache-refresh":
+        if not check_query_cache_refresh(args.chunks):
+            sys.exit(1)
+    elif args.benchmark == "keyword-refresh":
+        if not check_keyword_index_refresh(args.chunks):
+            sys.exit(1)
+    elif args.benchmark == "chunk-storage":
+        benchmark_chunk_storage(args.videos, args.cues)
+    elif args.benchmark == "query-cache":
+        benchmark_query_cache(args.chunks, args.queries, args.distinct, args.encoder_ms)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,10 +15,11 @@ disallowed_sections = [
 ]
 """This filters out sections that are not relevant for RAG, such as music."""
 
-existing_video_ids = []  # connect this to DB
-"""This should contain all the video_ids from the database,
-allowing the pipeline to skip processing records
-that are already available"""
+existing_video_ids = []
+"""Extra video_ids to skip, on top of the ones already recorded in the processed index (see state.py)"""
+
+state_db_path = "data/state.sqlite"
+"""The sqlite file of the processed index, which records how far each video_id got through the pipeline"""
 
 section_replacements = {
     # Word pairs stuck together (lowercase)
@@ -177,3 +178,265 @@ section_preacher_map = {
     "other videos": "unknown",
 }
 """This is used to determine which sections should have the preacher's name extracted from the video title"""
+
+fetch_max_workers = 32
+"""The number of worker threads used by fetching.fetch_urls"""
+
+fetch_max_connections_per_host = 8
+"""Caps the number of concurrent requests sent to a single host, to avoid overloading ATP"""
+
+fetch_retries = 3
+"""The number of times a failed request is retried before the error is recorded"""
+
+fetch_backoff_factor = 0.5
+"""Retries wait backoff_factor * 2 ** attempt seconds"""
+
+fetch_retry_status_codes = [429, 500, 502, 503, 504]
+"""Responses with these status codes are retried, other error codes fail immediately"""
+
+fetch_timeout = 30
+"""Timeout in seconds for each request"""
+
+http_cache_enabled = True
+"""If True, responses are cached on disk by http_cache.py and revalidated with conditional GETs"""
+
+http_cache_dir = "data/http_cache"
+"""The directory holding the cached responses"""
+
+http_cache_max_bytes = 4 * 1024**3
+"""When the compressed bodies exceed this size, the least recently used responses are evicted"""
+
+http_cache_ttls = {
+    r"/archive\.php": 6 * 60 * 60,
+    r"/video\.php\?id=\d+": 30 * 24 * 60 * 60,
+    r"\.vtt$": None,
+}
+"""Seconds a cached response is used without revalidating, by url regex. The first matching pattern wins.
+None means the response never goes stale (published VTT files don't change)."""
+
+http_cache_default_ttl = 24 * 60 * 60
+"""TTL of urls that don't match any pattern in http_cache_ttls"""
+
+tokenizer_name = "sentence-transformers/all-MiniLM-L6-v2"
+"""The tokenizer used to measure chunks. It must match the embedding model."""
+
+chunk_size = 256
+"""Max tokens per chunk"""
+
+chunk_overlap = 30
+"""Tokens shared between consecutive chunks"""
+
+chunker_version = 2
+"""Bumped when the chunker changes the chunks it makes, so the videos chunked by an older one are rechunked"""
+
+chunking_workers = None
+"""The number of processes used by to_chunked_record_df. None uses all cores."""
+
+chunking_batch_size = 64
+"""The number of transcripts sent to a chunking process at a time"""
+
+import_time_budget = 1.0
+"""Max seconds `import helpers` may take, checked by `python bench.py import-time`"""
+
+lazy_dependencies = ["bs4", "webvtt", "transformers", "chromadb"]
+"""Modules that must only be imported by the stages that use them, never at import time"""
+
+vtt_min_overlap_words = 2
+"""Min number of words a caption must repeat from the previous ones to be treated as a rolling caption.
+Shorter overlaps (e.g. "amen amen") are kept, unless the caption is an exact repeat."""
+
+vtt_workers = None
+"""The number of processes used by vtt_column_to_text. None uses all cores."""
+
+vtt_batch_size = 256
+"""The number of VTT files sent to a conversion process at a time"""
+
+chroma_db_path = ".chroma"
+"""The directory of the persistent Chroma database"""
+
+chunk_collection_name = "atp_chunks"
+"""The Chroma collection holding the chunk records"""
+
+ingest_batch_size = 512
+"""The number of chunks embedded and upserted into Chroma at a time"""
+
+ingest_queue_size = 4
+"""The number of embedded batches that may wait for their upsert, before embedding pauses"""
+
+ingest_checkpoint_path = "data/ingest_checkpoint.json"
+"""Records how many chunks were upserted, so an interrupted ingestion resumes where it stopped"""
+
+embedding_model_name = "all-MiniLM-L6-v2"
+"""The model of the embeddings, part of the embedding cache key"""
+
+embedding_cache_enabled = True
+"""If True, ingest_chunks only embeds the chunks that aren't in the embedding cache"""
+
+embedding_cache_dir = "data/embedding_cache"
+"""The directory of the embedding cache"""
+
+embedding_cache_max_rows = 2_000_000
+"""Max number of embeddings kept by EmbeddingCache.evict(), which ingest_chunks calls once the chunks are upserted"""
+
+checkpoint_dir = "data/checkpoints"
+"""The directory holding the Parquet checkpoints of the pipeline stages (see main.py)"""
+
+pipeline_batch_size = 200
+"""The number of videos flowing through the scrape, transcripts and chunks stages at a time"""
+
+pipeline_queue_size = 2
+"""The number of batches that may wait between two pipelined stages, before the upstream stage pauses"""
+
+atp_archive_url = "https://allthepreaching.com/pages/archive.php"
+"""The archive page listing every video"""
+
+bench_scales = {"1k": 1_000, "16k": 16_000, "100k": 100_000}
+"""The number of videos of the synthetic corpus at each `python bench.py suite --scale`"""
+
+bench_results_dir = "data/bench"
+"""The directory the JSON results of `python bench.py suite` are written to"""
+
+bench_stub_latency = 0.05
+"""Seconds the stub server of the scrape benchmark waits before every response, to simulate the network"""
+
+metrics_enabled = True
+"""If True, the pipeline stages, the HTTP requests and the tokenizer are instrumented (see metrics.py)"""
+
+metrics_sample_interval = 0.25
+"""Seconds between two RSS samples while a stage runs"""
+
+metrics_latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+"""Upper bounds in seconds of the buckets of the HTTP latency histograms"""
+
+metrics_report_path = "data/metrics/run_report.json"
+"""The JSON run report written at the end of every `python main.py` command"""
+
+metrics_prometheus_path = "data/metrics/pipeline.prom"
+"""The Prometheus text file written next to the run report, e.g. for the node_exporter textfile collector"""
+
+quarantine_dir = "data/quarantine"
+"""The directory of the quarantine, where the rows that failed validation are written (see validation.py)"""
+
+near_duplicate_action = "skip"
+"""What the pipeline does with the near-duplicate transcripts (see near_duplicates.py):
+"skip" doesn't chunk them, "flag" only records their group, None turns the detection off"""
+
+near_duplicate_threshold = 0.8
+"""Min estimated Jaccard similarity of the word shingles of two transcripts for them to be near-duplicates"""
+
+near_duplicate_db_path = "data/near_duplicates.sqlite"
+"""The sqlite file of the MinHash LSH index of the transcripts"""
+
+minhash_num_perm = 128
+"""The number of hash functions of the MinHash signatures"""
+
+minhash_shingle_size = 5
+"""The number of words per shingle of the MinHash signatures"""
+
+stream_output_dir = "data/transcripts"
+"""The partitioned Parquet dataset written by `python main.py stream-transcripts` (see streaming.py)"""
+
+stream_partition_by = "section"
+"""How the streamed transcripts are partitioned: "section", or "video_id" for ranges of stream_video_id_range ids"""
+
+stream_video_id_range = 10_000
+"""The number of video_ids per partition when stream_partition_by is "video_id\""""
+
+stream_memory_budget = 2 * 1024**3
+"""Max RSS in bytes of the streaming mode, the batches are sized and shrunk to stay under it"""
+
+stream_row_overhead = 4.0
+"""Bytes in memory per byte of vtt while a batch is processed, used to size the first streaming batch"""
+
+vector_index_dir = "data/vector_index"
+"""The directory of the memory-mapped vector index of the chunk embeddings (see vector_index.py)"""
+
+vector_index_quantize = False
+"""If True, the vector index stores the embeddings as int8, a quarter of the size, for slightly less exact scores"""
+
+vector_index_filter_columns = ["preacher", "section"]
+"""The columns the vector index keeps a row bitmap of per value, so searches can be filtered by them"""
+
+vector_index_block_rows = 16384
+"""The number of rows of the vector index scored at a time, which bounds the memory of a search"""
+
+vector_index_build_batch_size = 5000
+"""The number of chunks read from Chroma and written to the vector index at a time"""
+
+vector_query_workers = 4
+"""The number of threads of the vector index serving concurrent searches"""
+
+bench_vector_rows = 1_000_000
+"""The number of synthetic chunks of `python bench.py vector-query`"""
+
+keyword_index_enabled = True
+"""If True, ingest_chunks also adds the chunks to the BM25 keyword index (see keyword_index.py)"""
+
+bm25_index_dir = "data/bm25_index"
+"""The directory of the BM25 keyword index of the chunks"""
+
+bm25_k1 = 1.2
+"""BM25 term frequency saturation"""
+
+bm25_b = 0.75
+"""BM25 document length normalization"""
+
+bm25_max_df_ratio = 0.5
+"""Query terms found in more than this share of the chunks (e.g. "the") are ignored, unless they are all the query has"""
+
+search_mode = "hybrid"
+"""The default mode of `python main.py search`: "vector", "keyword" or "hybrid" (see search.py)"""
+
+hybrid_candidates = 100
+"""The number of results taken from each of the vector and keyword searches before they are fused"""
+
+hybrid_rrf_k = 60
+"""The k of reciprocal rank fusion, 1 / (k + rank). Higher values flatten the weight of the top ranks"""
+
+collection_version_path = "data/collection_version"
+"""A counter bumped by the ingestion whenever chunks land in the collection, which invalidates the query cache"""
+
+query_cache_max_entries = 10_000
+"""The maximum number of search results kept by the query cache (see query_cache.py)"""
+
+query_cache_ttl = 3600
+"""The seconds search results stay in the query cache, None to only drop them when the collection changes"""
+
+query_cache_max_embeddings = 100_000
+"""The maximum number of query embeddings kept by the query cache, 1.5 KB each with MiniLM"""
+
+query_cache_latency_window = 10_000
+"""The number of latest cache hits and misses the query cache latency percentiles are computed over"""
+
+categorical_columns = ["section", "preacher"]
+"""The low cardinality columns of the video table, stored as Categorical"""
+
+cleaning_rules = [
+    "disallowed_sections",
+    "section_replacements",
+    "title_replacements",
+    "preacher_names_replacements",
+    "section_preacher_map",
+]
+"""The config values the cleaned section, title and preacher of a video depend on"""
+
+stage_config_dependencies = {
+    "pre_scraping": cleaning_rules + ["existing_video_ids"],
+    "refresh_metadata": cleaning_rules,
+    "transcripts": [
+        "vtt_min_overlap_words",
+        "near_duplicate_action",
+        "near_duplicate_threshold",
+        "minhash_num_perm",
+        "minhash_shingle_size",
+    ],
+    "chunks": [
+        "tokenizer_name",
+        "chunk_size",
+        "chunk_overlap",
+        "chunker_version",
+        "near_duplicate_action",
+    ],
+    "ingest": ["chunk_collection_name", "embedding_model_name"],
+}
+"""The config values each pipeline stage depends on. A checkpoint made with other values is recomputed (see state.py)"""
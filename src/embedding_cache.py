@@ -0,0 +1,245 @@
+"""## This file contains the embedding cache used by the ingestion stage
+
+Embeddings are keyed by (model name, hash of the normalized chunk text), so chunks that come out byte-identical
+after rechunking or re-cleaning are never embedded twice. The vectors of each model are stored as a memory-mapped
+float32 matrix, and a sqlite index maps every key to its row.
+
+Compacting or evicting rewrites the matrix under a new file name, recorded in the sqlite index in the same
+transaction as the remapped rows, so the index never points at rows of another version of the matrix.
+"""
+
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Callable, Iterable
+
+import numpy as np
+
+from config import *
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes the text before hashing it, so whitespace and unicode form differences don't cause cache misses."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text: str) -> bytes:
+    """Returns the cache key of the text."""
+    return hashlib.blake2b(normalize_text(text).encode(), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """Cache of the embeddings computed by one model.
+
+    - embed(texts, embedding_function) returns the embeddings of the texts, only computing the missing ones.
+    - compact(texts) drops every row that isn't referenced by texts, e.g. the chunk column of the current chunk frame.
+    - evict(max_rows) drops the least recently used rows beyond max_rows.
+    """
+
+    def __init__(
+        self,
+        model_name: str = embedding_model_name,
+        cache_dir: str = embedding_cache_dir,
+    ):
+        self.model_name = model_name
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self._slug = "".join(c if c.isalnum() else "_" for c in model_name)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, f"{self._slug}.sqlite"), check_same_thread=False
+        )
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS keys (
+                text_hash BLOB PRIMARY KEY,
+                row INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                dim INTEGER NOT NULL
+            );
+            """)
+        if "matrix" not in [
+            row[1] for row in self._db.execute("PRAGMA table_info(meta)")
+        ]:
+            # Caches made before the matrix file name was recorded used a fixed one
+            self._db.execute(
+                f"ALTER TABLE meta ADD COLUMN matrix TEXT NOT NULL DEFAULT '{self._slug}.f32'"
+            )
+            self._db.commit()
+        row = self._db.execute("SELECT dim, matrix FROM meta").fetchone()
+        self.dim = row[0] if row is not None else None
+        self.matrix_path = os.path.join(
+            cache_dir, row[1] if row is not None else f"{self._slug}.f32"
+        )
+        self._matrix = None
+        self._delete_unused_matrices()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def rows(self) -> int:
+        """The number of rows of the matrix file."""
+        if self.dim is None or not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (4 * self.dim)
+
+    def _get_matrix(self) -> np.memmap | None:
+        """Returns the memory-mapped matrix, remapping it if rows were appended since."""
+        rows = self.rows
+        if rows == 0:
+            return None
+        if self._matrix is None or self._matrix.shape[0] != rows:
+            self._matrix = np.memmap(
+                self.matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim)
+            )
+        return self._matrix
+
+    def _lookup(self, keys: list[bytes]) -> dict[bytes, int]:
+        """Returns the row of every known key. Must be called with the lock held."""
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i : i + 500]
+            found.update(
+                self._db.execute(
+                    f"SELECT text_hash, row FROM keys WHERE text_hash IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+            )
+        return found
+
+    def embed(
+        self, texts: list[str], embedding_function: Callable[[list[str]], list]
+    ) -> np.ndarray:
+        """Returns the float32 embeddings of the texts, one row per text.
+
+        Cached embeddings are read from the matrix, the others are computed with embedding_function and added to the cache.
+        """
+        keys = [text_hash(text) for text in texts]
+        with self._lock:
+            rows = self._lookup(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in rows and key not in missing:
+                missing[key] = text
+        # Texts repeated within the batch are only embedded once, so they count as hits
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_embeddings = np.asarray(
+                embedding_function(list(missing.values())), dtype=np.float32
+            )
+            with self._lock:
+                if self.dim is None:
+                    self.dim = new_embeddings.shape[1]
+                    self._db.execute(
+                        "INSERT INTO meta (dim, matrix) VALUES (?, ?)",
+                        (self.dim, os.path.basename(self.matrix_path)),
+                    )
+                first_row = self.rows
+                with open(self.matrix_path, "ab") as f:
+                    f.write(new_embeddings.tobytes())
+                now = time.time()
+                new_rows = {key: first_row + i for i, key in enumerate(missing.keys())}
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO keys (text_hash, row, last_used) VALUES (?, ?, ?)",
+                    [(key, row, now) for key, row in new_rows.items()],
+                )
+                self._db.commit()
+            rows.update(new_rows)
+
+        with self._lock:
+            self._db.executemany(
+                "UPDATE keys SET last_used = ? WHERE text_hash = ?",
+                [(time.time(), key) for key in set(keys)],
+            )
+            self._db.commit()
+            matrix = self._get_matrix()
+        if matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.asarray(matrix[[rows[key] for key in keys]])
+
+    def _delete_unused_matrices(self):
+        """Deletes the matrix files of the model other than the current one, left by a rewrite that was interrupted
+        or whose old matrix was still mapped."""
+        for path in glob.glob(os.path.join(self.cache_dir, f"{self._slug}.*f32")):
+            if os.path.abspath(path) != os.path.abspath(self.matrix_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _rewrite(self, keep: list[tuple[bytes, int]]):
+        """Rewrites the matrix with only the kept (key, row) pairs. Must be called with the lock held.
+
+        The new matrix gets a new file name, which is switched to in the same transaction that remaps the keys,
+        so the keys always point at rows of the matrix they were remapped for, even if the rewrite is interrupted.
+        """
+        matrix = self._get_matrix()
+        keep.sort(key=lambda item: item[1])
+        new_name = f"{self._slug}.{time.time_ns()}.f32"
+        new_path = os.path.join(self.cache_dir, new_name)
+        with open(new_path, "wb") as f:
+            for i in range(0, len(keep), 10000):
+                rows = [row for _, row in keep[i : i + 10000]]
+                f.write(np.asarray(matrix[rows]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with self._db:
+            self._db.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS kept (text_hash BLOB PRIMARY KEY, row INTEGER)"
+            )
+            self._db.execute("DELETE FROM kept")
+            self._db.executemany(
+                "INSERT INTO kept (text_hash, row) VALUES (?, ?)",
+                [(key, new_row) for new_row, (key, _) in enumerate(keep)],
+            )
+            self._db.execute(
+                "DELETE FROM keys WHERE text_hash NOT IN (SELECT text_hash FROM kept)"
+            )
+            self._db.execute(
+                "UPDATE keys SET row = (SELECT row FROM kept WHERE kept.text_hash = keys.text_hash)"
+            )
+            self._db.execute("UPDATE meta SET matrix = ?", (new_name,))
+        # The old file can't be deleted while it is still mapped (on Windows)
+        del matrix
+        self._matrix = None
+        self.matrix_path = new_path
+        self._delete_unused_matrices()
+
+    def compact(self, texts: Iterable[str]) -> int:
+        """Drops the rows of every text that isn't in texts. Returns the number of dropped rows.
+
+        texts is only iterated once, so it can be a generator, e.g. over the pages of the Chroma collection.
+        """
+        referenced = {text_hash(text) for text in texts}
+        with self._lock:
+            all_rows = self._db.execute("SELECT text_hash, row FROM keys").fetchall()
+            keep = [(key, row) for key, row in all_rows if key in referenced]
+            if len(keep) < len(all_rows) or len(all_rows) < self.rows:
+                self._rewrite(keep)
+        return len(all_rows) - len(keep)
+
+    def evict(self, max_rows: int = embedding_cache_max_rows) -> int:
+        """Drops the least recently used rows beyond max_rows. Returns the number of dropped rows."""
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+            if count <= max_rows:
+                return 0
+            keep = self._db.execute(
+                "SELECT text_hash, row FROM keys ORDER BY last_used DESC LIMIT ?",
+                (max_rows,),
+            ).fetchall()
+            self._rewrite(keep)
+        return count - len(keep)
+
+    def hit_rate(self) -> float:
+        """The share of texts that didn't have to be embedded."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
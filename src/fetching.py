@@ -0,0 +1,224 @@
+"""## This file contains the HTTP layer used by the scraping functions in helpers.py
+
+All requests go through a single pooled requests.Session, so connections to ATP are kept alive
+and reused instead of doing a new TCP/TLS handshake for every video."""
+
+import codecs
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from urllib.parse import urlsplit
+
+import polars as pl
+import requests
+from requests.adapters import HTTPAdapter
+
+import http_cache
+import metrics
+from config import *
+
+_session = None
+_session_lock = threading.Lock()
+_host_semaphores = {}
+
+
+def get_session() -> requests.Session:
+    """Returns the shared session, creating it on first use.
+
+    The connection pool of each host is sized to fetch_max_connections_per_host."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=fetch_max_workers,
+                pool_maxsize=fetch_max_connections_per_host,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def _get_host_semaphore(host: str) -> threading.BoundedSemaphore:
+    """Returns the semaphore limiting the concurrent requests to host."""
+    with _session_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                fetch_max_connections_per_host
+            )
+        return _host_semaphores[host]
+
+
+def fetch(url: str, **kwargs) -> requests.Response:
+    """GETs the url using the shared session.
+
+    - Waits for a free slot of the url's host, so no more than fetch_max_connections_per_host requests run against it.
+    - Retries connection errors, timeouts and fetch_retry_status_codes with exponential backoff.
+    - Records the latency and status of every attempt in metrics.
+    - Closes the responses that are retried or not successful, so their connections go back to the pool.
+    - Raises requests.HTTPError if the final response is not successful.
+
+    Extra kwargs (e.g. headers) are passed to Session.get"""
+    session = get_session()
+    host = urlsplit(url).netloc
+    host_semaphore = _get_host_semaphore(host)
+    kwargs.setdefault("timeout", fetch_timeout)
+    for attempt in range(fetch_retries + 1):
+        last_attempt = attempt == fetch_retries
+        try:
+            with host_semaphore:
+                start = time.perf_counter()
+                try:
+                    response = session.get(url, **kwargs)
+                except requests.RequestException as e:
+                    metrics.record_request(
+                        host, type(e).__name__, time.perf_counter() - start
+                    )
+                    raise
+                metrics.record_request(
+                    host, response.status_code, time.perf_counter() - start
+                )
+        except (requests.ConnectionError, requests.Timeout):
+            if last_attempt:
+                raise
+        else:
+            if response.status_code not in fetch_retry_status_codes or last_attempt:
+                try:
+                    response.raise_for_status()
+                except requests.HTTPError:
+                    response.close()
+                    raise
+                return response
+            # Gives the connection back to the pool, which a streamed response only does once closed
+            response.close()
+        time.sleep(fetch_backoff_factor * 2**attempt)
+
+
+def get_text(url: str) -> str:
+    """Returns the decoded body of the url.
+
+    If http_cache_enabled, a fresh cached response is returned without any request.
+    A stale one is revalidated with a conditional GET, and only downloaded again if it changed.
+    """
+    if not http_cache_enabled:
+        response = fetch(url)
+        return _decode(response.content, response_encoding(response))
+    cache = http_cache.get_cache()
+    entry = cache.lookup(url)
+    if entry is not None and cache.is_fresh(entry):
+        return _decode(entry["body"], entry["encoding"])
+    headers = cache.conditional_headers(entry) if entry is not None else {}
+    response = fetch(url, headers=headers)
+    if entry is not None and response.status_code == 304:
+        cache.refresh(url)
+        return _decode(entry["body"], entry["encoding"])
+    encoding = response_encoding(response)
+    cache.store(
+        url,
+        response.content,
+        encoding=encoding,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return _decode(response.content, encoding)
+
+
+def iter_text(url: str, chunk_size: int = 64 * 1024):
+    """Yields the decoded body of the url piece by piece, as it is downloaded.
+
+    Uses the cache like get_text: a fresh or revalidated cached body is yielded from disk,
+    and a downloaded body is stored once it has been fully read."""
+    cache = http_cache.get_cache() if http_cache_enabled else None
+    entry = cache.lookup(url) if cache is not None else None
+    if entry is not None and cache.is_fresh(entry):
+        yield _decode(entry["body"], entry["encoding"])
+        return
+    headers = cache.conditional_headers(entry) if entry is not None else {}
+    with fetch(url, headers=headers, stream=True) as response:
+        if entry is not None and response.status_code == 304:
+            cache.refresh(url)
+            yield _decode(entry["body"], entry["encoding"])
+            return
+        encoding = response_encoding(response)
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        body = []
+        for piece in response.iter_content(chunk_size):
+            body.append(piece)
+            yield decoder.decode(piece)
+        yield decoder.decode(b"", final=True)
+        if cache is not None:
+            cache.store(
+                url,
+                b"".join(body),
+                encoding=encoding,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+
+
+def response_encoding(response: requests.Response) -> str:
+    """Returns the encoding of the response body: the charset of its Content-Type, or utf-8.
+
+    Unlike requests.Response.apparent_encoding, it doesn't need the whole body, so get_text and iter_text decode
+    (and cache) a body the same way whether it is streamed or not."""
+    for param in response.headers.get("Content-Type", "").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.strip().lower() == "charset":
+            try:
+                return codecs.lookup(value.strip("\"' ")).name
+            except LookupError:
+                break
+    return "utf-8"
+
+
+def _decode(body: bytes, encoding: str | None) -> str:
+    """Decodes a body with the encoding given by response_encoding, which is stored with it in the cache."""
+    return str(body, encoding or "utf-8", errors="replace")
+
+
+def fetch_urls(
+    urls: list[str] | pl.Series,
+    parse: Callable[[str], str] | None = None,
+    max_workers: int = fetch_max_workers,
+) -> pl.DataFrame:
+    """Fetches all urls concurrently and returns a df with one row per url, in the same order:
+
+    - url: str - The requested url.
+    - content: str - The body of the response, or parse(body) if parse is given. Null if the request failed.
+    - error: str - The error that was raised for this url. Null on success.
+    - elapsed: float - Seconds spent on this url, including retries.
+
+    A failing url does not abort the batch, its error is recorded instead."""
+    urls = list(urls)
+
+    def fetch_one(url: str) -> tuple:
+        start = time.perf_counter()
+        try:
+            content = get_text(url)
+            if parse is not None:
+                content = parse(content)
+            error = None
+        except Exception as e:
+            content = None
+            error = f"{type(e).__name__}: {e}"
+        return content, error, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch_one, urls))
+
+    return pl.DataFrame(
+        {
+            "url": urls,
+            "content": [result[0] for result in results],
+            "error": [result[1] for result in results],
+            "elapsed": [result[2] for result in results],
+        },
+        schema={
+            "url": pl.String,
+            "content": pl.String,
+            "error": pl.String,
+            "elapsed": pl.Float64,
+        },
+    )
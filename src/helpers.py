@@ -1,17 +1,27 @@
-"""## This file contains functions for the data pipeline powering the dataset behind ATP search tools"""
-
-from bs4 import BeautifulSoup
-import requests
-from datetime import datetime
-import chromadb
-from tqdm import tqdm
-import webvtt
-import io
+"""## This file contains functions for the data pipeline powering the dataset behind ATP search tools
+
+Heavy dependencies (bs4, transformers) are imported inside the functions that need them,
+so importing this module stays fast for runs that don't use every stage."""
+
+import bisect
+import codecs
+import fetching
+import functools
+import html
+import metrics
+import multiprocessing
+import re
+import time
+from contextlib import contextmanager
+from typing import Callable
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
 import patito as pt
 import polars as pl
+from polars.io.plugins import register_io_source
 from config import *
-import semchunk
-from transformers import AutoTokenizer
+from state import ProcessedIndex
+import validation
 
 # Regex patterns for validating urls
 video_url_pattern = r"^https://allthepreaching.com/pages/video.php\?id=\d+$"
@@ -92,8 +102,13 @@ class ChunkedRecordDataFrameModel(PreScrapingDataFrameModel):
 
     - chunk_id: str - The video_id concatenated with chunk_number. Must be unique
     - chunk_number: int - The chronological number of the chunk made from chunking the transcript.
+    - chunks_count: int - The number of chunks of the video that passed validation.
     - mp4_url: str - Must be unique. Must conform to mp4_url_pattern.
     - token_count: int - The number of tokens in the chunk.
+    - char_start: int - The offset in the transcript of the first character of the chunk.
+    - char_end: int - The offset in the transcript after the last character of the chunk.
+    - start_seconds: float - When the chunk starts in the video, from the vtt cues. Null if the transcript had no cues.
+    - end_seconds: float - When the chunk ends in the video, from the vtt cues. Null if the transcript had no cues.
     - chunk: str - The chunk to be embedded in vector search.
 
     (inherited fields:)
@@ -119,79 +134,394 @@ class ChunkedRecordDataFrameModel(PreScrapingDataFrameModel):
         pattern=mp4_url_pattern,
     )
     token_count: int = pt.Field()
+    char_start: int = pt.Field(ge=0)
+    char_end: int = pt.Field(gt=0)
+    start_seconds: float | None = pt.Field(ge=0)
+    end_seconds: float | None = pt.Field(ge=0)
     chunk: str = pt.Field(unique=True, min_length=5)
 
 
+chunk_columns = [
+    "chunk_id",
+    "chunk_number",
+    "chunks_count",
+    "token_count",
+    "char_start",
+    "char_end",
+    "start_seconds",
+    "end_seconds",
+    "chunk",
+]
+"""The columns of ChunkedRecordDataFrameModel made by the chunker, the others come from TranscriptDataFrameModel"""
+
+video_columns = [
+    column
+    for column in ChunkedRecordDataFrameModel.columns
+    if column not in chunk_columns
+]
+"""The columns of ChunkedRecordDataFrameModel that belong to the video, stored once per video in the video table"""
+
+cleaned_columns = ["section", "title", "preacher"]
+"""The columns of the video table derived by the cleaning_rules, patched in place when the rules change"""
+
+
+class _ArchiveParser(HTMLParser):
+    """Event based parser of the archive page. Collects a record for every <a> with a title and a href,
+    under the section of the last <h2>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.records = []
+        self._section = ""
+        self._section_text = None
+        # The pieces of the current text node, which feed() may split anywhere
+        self._text_node = []
+
+    def _end_text_node(self):
+        if self._section_text is not None and self._text_node:
+            self._section_text.append("".join(self._text_node).strip())
+        self._text_node = []
+
+    def handle_starttag(self, tag, attrs):
+        self._end_text_node()
+        if tag == "h2":
+            self._section_text = []
+        elif tag == "a":
+            attrs = dict(attrs)
+            if attrs.get("title") and attrs.get("href"):
+                self.records.append(
+                    {
+                        "section": self._section.lower(),
+                        "title": attrs["title"].strip("'\" ").lower(),
+                        "video_url": attrs["href"],
+                    }
+                )
+
+    def handle_endtag(self, tag):
+        self._end_text_node()
+        if tag == "h2" and self._section_text is not None:
+            # Same as BeautifulSoup's get_text(strip=True), which strips every text node
+            self._section = "".join(self._section_text)
+            self._section_text = None
+
+    def handle_data(self, data):
+        if self._section_text is not None:
+            self._text_node.append(data)
+
+
+def _iter_archive_text(source: str | bytes, chunk_size: int = 64 * 1024):
+    """Yields the html of the archive page piece by piece, from a url, a file path or bytes."""
+    if isinstance(source, bytes):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for i in range(0, len(source), chunk_size):
+            yield decoder.decode(source[i : i + chunk_size])
+        yield decoder.decode(b"", final=True)
+    elif source.startswith(("http://", "https://")):
+        yield from fetching.iter_text(source, chunk_size)
+    else:
+        with open(source, "r") as f:
+            while piece := f.read(chunk_size):
+                yield piece
+
+
+def iter_archive_records(
+    source: str | bytes = "https://allthepreaching.com/pages/archive.php",
+    batch_size: int = 1000,
+    chunk_size: int = 64 * 1024,
+):
+    """Yields lists of [section, title, video_url] records from the archive page, without building a DOM.
+
+    The source can be a url, a file path or the page's bytes, fed to the parser chunk_size at a time.
+    A url is parsed while it downloads, so the first batches are available before the download finishes.
+    """
+    parser = _ArchiveParser()
+    for piece in _iter_archive_text(source, chunk_size):
+        parser.feed(piece)
+        while len(parser.records) >= batch_size:
+            yield parser.records[:batch_size]
+            del parser.records[:batch_size]
+    parser.close()
+    if parser.records:
+        yield parser.records
+
+
+archive_schema = {"section": pl.String, "title": pl.String, "video_url": pl.String}
+"""The schema of the records scraped from the archive page"""
+
+
+def scan_archive_records(
+    source: str | bytes = "https://allthepreaching.com/pages/archive.php",
+) -> pl.LazyFrame:
+    """Lazily scans the archive records, e.g. to feed them directly to to_pre_scraping_df.
+
+    The page is only parsed when the LazyFrame is collected, and is streamed in batches.
+    """
+
+    def source_generator(with_columns, predicate, n_rows, batch_size):
+        for records in iter_archive_records(source, batch_size or 1000):
+            df = pl.DataFrame(records, schema=archive_schema)
+            if n_rows is not None:
+                df = df.head(n_rows)
+                n_rows -= df.height
+            if with_columns is not None:
+                df = df.select(with_columns)
+            if predicate is not None:
+                df = df.filter(predicate)
+            yield df
+            if n_rows is not None and n_rows <= 0:
+                break
+
+    return register_io_source(source_generator, schema=archive_schema)
+
+
+@metrics.instrument("get_records_from_archive_url")
 def get_records_from_archive_url(
     atp_videos_archive_url: str = "https://allthepreaching.com/pages/archive.php",
 ) -> list[dict]:
     """Directly scrapes the [video_url, title, section] fields from the given url."""
-    response = requests.get(atp_videos_archive_url)
-    html_content = response.text
-    soup = BeautifulSoup(html_content, "html.parser")
-    records = []
-    for tag in soup.find_all(["h2", "a"]):
-        if tag.name == "h2":
-            current_section = tag.get_text(strip=True)
-        elif tag.name == "a" and tag.get("title") and tag.get("href"):
-            records.append(
-                {
-                    "section": str(current_section).lower(),
-                    "title": str(tag.get("title", "").strip("'\" ")).lower(),
-                    # "text": tag.get_text(strip=True).lower().strip(),
-                    "video_url": str(tag["href"]),
-                }
-            )
-    return records
+    return [
+        record
+        for records in iter_archive_records(atp_videos_archive_url)
+        for record in records
+    ]
 
 
+@metrics.instrument("get_records_from_html_file")
 def get_records_from_html_file(file: str) -> list[dict]:
     """Scrapes the [video_url, title, section] fields from the given html file."""
-    with open(file, "r") as f:
-        html_content = f.read()
-    soup = BeautifulSoup(html_content, "html.parser")
-    records = []
-    for tag in soup.find_all(["h2", "a"]):
-        if tag.name == "h2":
-            current_section = tag.get_text(strip=True)
-        elif tag.name == "a" and tag.get("title") and tag.get("href"):
-            records.append(
-                {
-                    "section": str(current_section).lower(),
-                    "title": str(tag.get("title", "").strip("'\" ")).lower(),
-                    # "text": tag.get_text(strip=True).lower().strip(),
-                    "video_url": str(tag["href"]),
-                }
-            )
-    return records
+    return [record for records in iter_archive_records(file) for record in records]
 
 
-def get_mp4_url_from_video_url(video_url: str) -> str:
-    """Scrapes the mp4_url from the video_url page"""
-    html_content = requests.get(video_url).text
+def get_mp4_url_from_html(html_content: str) -> str:
+    """Extracts the mp4_url from the html of a video_url page"""
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_content, "html.parser")
     mp4_url = soup.find("video").get_attribute_list("src")
     mp4_url = mp4_url[0]
     return mp4_url
 
 
+def get_mp4_url_from_video_url(video_url: str) -> str:
+    """Scrapes the mp4_url from the video_url page"""
+    html_content = fetching.get_text(video_url)
+    return get_mp4_url_from_html(html_content)
+
+
 def get_html_content_from_url(url: str) -> str:
     """Scrapes the html content from the given url"""
-    response = requests.get(url)
-    content = response.text
+    content = fetching.get_text(url)
     return content
 
 
+@metrics.instrument("get_mp4_urls_from_video_urls")
+def get_mp4_urls_from_video_urls(video_urls: list[str] | pl.Series) -> pl.DataFrame:
+    """Concurrently scrapes the mp4_url of every video_url (e.g. the video_url column of the pre-scraping df).
+
+    Returns a df with ["video_url", "mp4_url", "error"] fields, one row per video_url.
+    mp4_url is null and error is set for the pages that could not be scraped."""
+    return fetching.fetch_urls(video_urls, parse=get_mp4_url_from_html).select(
+        pl.col("url").alias("video_url"),
+        pl.col("content").alias("mp4_url"),
+        "error",
+    )
+
+
+@metrics.instrument("get_vtts_from_vtt_urls")
+def get_vtts_from_vtt_urls(vtt_urls: list[str] | pl.Series) -> pl.DataFrame:
+    """Concurrently downloads the WebVTT file of every vtt_url.
+
+    Returns a df with ["vtt_url", "vtt", "error"] fields, one row per vtt_url.
+    vtt is null and error is set for the files that could not be downloaded."""
+    return fetching.fetch_urls(vtt_urls).select(
+        pl.col("url").alias("vtt_url"),
+        pl.col("content").alias("vtt"),
+        "error",
+    )
+
+
+_vtt_tag_pattern = re.compile(r"<[^>]*>")
+_vtt_skipped_blocks = ("WEBVTT", "NOTE", "STYLE", "REGION")
+
+
+def _vtt_timestamp_seconds(timestamp: str) -> float:
+    """Converts a WebVTT timestamp ("hh:mm:ss.ttt" or "mm:ss.ttt") to seconds."""
+    seconds = 0.0
+    for part in timestamp.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _iter_vtt_captions(vtt_text: str):
+    """Yields the (start, end, text lines) of every cue of the WebVTT, without the header, notes, cue ids or tags.
+
+    start and end are in seconds, None if the timing line is malformed."""
+    lines = vtt_text.splitlines()
+    i = 0
+    while i < len(lines):
+        # Skip the blank lines between blocks
+        if not lines[i].strip():
+            i += 1
+            continue
+        block_start = i
+        while i < len(lines) and lines[i].strip():
+            i += 1
+        block = lines[block_start:i]
+        if block[0].startswith(_vtt_skipped_blocks):
+            continue
+        for timing_index, line in enumerate(block):
+            if "-->" in line:
+                break
+        else:
+            continue
+        start, _, end = block[timing_index].partition("-->")
+        try:
+            start, end = _vtt_timestamp_seconds(start), _vtt_timestamp_seconds(
+                end.split()[0]
+            )
+        except (ValueError, IndexError):
+            start = end = None
+        caption = []
+        for line in block[timing_index + 1 :]:
+            if "<" in line:
+                line = _vtt_tag_pattern.sub("", line)
+            if "&" in line:
+                line = html.unescape(line)
+            caption.append(line)
+        yield start, end, caption
+
+
+def _append_caption(words: list[str], caption_words: list[str]) -> int:
+    """Appends the words of a caption to the transcript, without the words it repeats from the end of the transcript.
+    Returns the number of words appended.
+
+    Auto-generated captions roll: each cue repeats the last line(s) of the previous one before adding new words.
+    The longest overlap between the end of the transcript and the start of the caption is dropped,
+    if it is at least vtt_min_overlap_words long or if it is the whole caption."""
+    max_overlap = min(len(words), len(caption_words))
+    for overlap in range(max_overlap, 0, -1):
+        if overlap < vtt_min_overlap_words and overlap != len(caption_words):
+            break
+        if words[-overlap:] == caption_words[:overlap]:
+            words.extend(caption_words[overlap:])
+            return len(caption_words) - overlap
+    words.extend(caption_words)
+    return len(caption_words)
+
+
+def vtt_to_text_with_cues(
+    vtt_text: str,
+) -> tuple[str, list[tuple[int, float, float]]]:
+    """Converts WebVTT to text like vtt_to_text, and also returns the offset index of its cues.
+
+    The index is a list of (offset, start, end): the character offset in the text of the first word a cue added,
+    and the start and end of the cue in seconds. Cues adding no words (repeats) or with a malformed timing are left out,
+    so the words of a cue are the text between its offset and the offset of the next one.
+    """
+    words = []
+    cues = []
+    length = 0
+    for start, end, caption in _iter_vtt_captions(vtt_text):
+        added = _append_caption(words, " ".join(caption).split())
+        if not added:
+            continue
+        # The words are joined by single spaces
+        offset = length + 1 if length else 0
+        if start is not None:
+            cues.append((offset, start, end))
+        length = offset + sum(map(len, words[-added:])) + added - 1
+    return " ".join(words), cues
+
+
 def vtt_to_text(vtt_text: str) -> str:
-    """Converts WebVTT to text. Skips repeating captions."""
-    text_captions = [""]
-    vtt_buffer = io.StringIO(vtt_text)
-    captions = webvtt.from_buffer(vtt_buffer)
-    for caption in captions:
-        if caption.text != text_captions[-1]:
-            text_captions.append(caption.text)
-    text = " ".join(text_captions).strip()
-    return text
+    """Converts WebVTT to text. Strips the header, timings and tags, and collapses repeated and rolling captions."""
+    return vtt_to_text_with_cues(vtt_text)[0]
+
+
+def _vtts_to_transcripts(
+    vtt_texts: list[str | None],
+) -> list[tuple[str, list[tuple[int, float, float]]] | None]:
+    """Runs vtt_to_text_with_cues over a batch, inside a worker process."""
+    return [
+        None if vtt_text is None else vtt_to_text_with_cues(vtt_text)
+        for vtt_text in vtt_texts
+    ]
+
+
+cues_dtype = pl.List(
+    pl.Struct({"offset": pl.Int64, "start": pl.Float64, "end": pl.Float64})
+)
+"""The dtype of the "cues" column, the offset index of the transcript (see vtt_to_text_with_cues)"""
+
+
+def _process_pool(
+    workers: int | None, initializer: Callable | None = None
+) -> ProcessPoolExecutor:
+    """Returns a process pool whose workers are started by a fork server (spawned where there is none), never forked
+    from this process, which runs the pipeline stages in several threads."""
+    method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(method),
+        initializer=initializer,
+    )
+
+
+@metrics.instrument("vtt_column_to_transcript")
+def vtt_column_to_transcript(
+    vtt: pl.Series,
+    workers: int | None = vtt_workers,
+    batch_size: int = vtt_batch_size,
+) -> pl.DataFrame:
+    """Converts a whole column of WebVTT files (e.g. the vtt column) into a df with the "transcript" and "cues" columns.
+
+    - cues: list[struct] - The offset index of the transcript, which the chunker uses to timestamp the chunks.
+
+    The column is converted in batches of batch_size across a pool of workers processes (os.cpu_count() by default).
+    With workers=0 it is converted in this process. Nulls stay null."""
+    vtt_texts = vtt.to_list()
+    batches = [
+        vtt_texts[i : i + batch_size] for i in range(0, len(vtt_texts), batch_size)
+    ]
+    if workers == 0 or len(batches) <= 1:
+        results = _vtts_to_transcripts(vtt_texts)
+    else:
+        with _process_pool(workers) as executor:
+            results = [
+                result
+                for batch in executor.map(_vtts_to_transcripts, batches)
+                for result in batch
+            ]
+    return pl.DataFrame(
+        {
+            "transcript": [None if result is None else result[0] for result in results],
+            "cues": [
+                (
+                    None
+                    if result is None
+                    else [
+                        {"offset": offset, "start": start, "end": end}
+                        for offset, start, end in result[1]
+                    ]
+                )
+                for result in results
+            ],
+        },
+        schema={"transcript": pl.String, "cues": cues_dtype},
+    )
+
+
+def vtt_column_to_text(
+    vtt: pl.Series,
+    workers: int | None = vtt_workers,
+    batch_size: int = vtt_batch_size,
+) -> pl.Series:
+    """Converts a whole column of WebVTT files into a "transcript" column, see vtt_column_to_transcript."""
+    return vtt_column_to_transcript(vtt, workers, batch_size)["transcript"]
 
 
 def get_section_preacher_df() -> pl.LazyFrame:
@@ -219,8 +549,77 @@ def evaluate_preacher(title: str) -> str:
     return preacher
 
 
+def live_replacements(values: pl.Series, replacements: dict) -> dict:
+    """Returns the replacements that change at least one of the values, when applied in order like str.replace_all.
+
+    Rules that can never fire on these values are left out."""
+    return _replacement_mapping(values, replacements)[2]
+
+
+def _replacement_mapping(
+    values: pl.Series, replacements: dict
+) -> tuple[pl.Series, pl.Series, dict]:
+    """Applies the replacements in order to the distinct values.
+
+    Returns the values that changed, what they changed into, and the rules that fired.
+    """
+    distinct_values = values.drop_nulls().unique()
+    if not replacements:
+        return distinct_values.clear(), distinct_values.clear(), {}
+    # A value that matches none of the patterns is never changed by any rule,
+    # so only the values matching the alternation of all patterns go through the rules.
+    any_pattern = "|".join(f"(?:{pattern})" for pattern in replacements)
+    distinct_values = distinct_values.filter(distinct_values.str.contains(any_pattern))
+    replaced_values = distinct_values
+    fired = {}
+    for pattern, replacement in replacements.items():
+        new_values = replaced_values.str.replace_all(pattern, replacement)
+        if (new_values != replaced_values).any():
+            fired[pattern] = replacement
+            replaced_values = new_values
+    changed = distinct_values != replaced_values
+    return distinct_values.filter(changed), replaced_values.filter(changed), fired
+
+
+def compile_replacements(values: pl.Series, replacements: dict) -> pl.Expr:
+    """Compiles regex replacements (e.g. section_replacements) into a single expression for the values' column.
+
+    The rules run in order over the distinct values that match at least one pattern, and rules that don't fire are skipped.
+    The resulting expression rewrites the whole column in one hash lookup pass, whatever the number of rules.
+    It gives the same result as applying each rule with str.replace_all, as long as it is used on the same values.
+    """
+    old_values, new_values, _ = _replacement_mapping(values, replacements)
+    return pl.col(values.name).replace(old_values, new_values)
+
+
+def evaluate_preacher_expr(title: pl.Expr) -> pl.Expr:
+    """Vectorized evaluate_preacher, for a whole column of titles.
+
+    Every name of preacher_names_replacements found in the title is extracted in one Aho-Corasick pass.
+    The proper name of the first of them in dict order is returned, like evaluate_preacher does.
+    """
+    names = list(preacher_names_replacements.keys())
+    priorities = list(range(len(names)))
+    return (
+        title.str.extract_many(names, overlapping=True)
+        .list.eval(
+            pl.element().replace_strict(names, priorities, return_dtype=pl.UInt32)
+        )
+        .list.min()
+        .replace_strict(
+            priorities,
+            list(preacher_names_replacements.values()),
+            default=None,
+            return_dtype=pl.String,
+        )
+        .fill_null("unknown")
+    )
+
+
+@metrics.instrument("to_pre_scraping_df")
 def to_pre_scraping_df(
-    scraped_records: list | pl.DataFrame,
+    scraped_records: list | pl.DataFrame | pl.LazyFrame,
+    processed_index: ProcessedIndex | None = None,
 ) -> pt.DataFrame:  # changed this row to include df
     """Takes a df with ["section", "title", "video_url"] fields and returns a df with:
 
@@ -229,12 +628,21 @@ def to_pre_scraping_df(
     - preacher: str - The name of the preacher. Infers the name based on the section and evaluates when needed. Defaults to "unknown"
     - title: str - If the title was originally just the name of the preacher, such as at a conference, it will change to the section + preacher
     - video_url: str - Reprocesses it to make sure that partial links won't break the url.
+
+    Records whose video_id is in existing_video_ids, or already completed the pipeline according to processed_index, are skipped.
+    Videos ingested with other chunk parameters than the current ones are kept, so they get rechunked.
     """
     section_preacher_df = get_section_preacher_df()
 
+    if isinstance(scraped_records, pl.LazyFrame):
+        # e.g. scan_archive_records()
+        scraped_records = scraped_records.collect()
+    records_df = PreScrapingDataFrameModel.DataFrame(scraped_records).filter(
+        ~pl.col("section").is_in(disallowed_sections)
+    )
+
     df = (
-        PreScrapingDataFrameModel.DataFrame(scraped_records)
-        .lazy()
+        records_df.lazy()
         .select(
             [
                 "section",
@@ -242,16 +650,11 @@ def to_pre_scraping_df(
                 "video_url",
             ]
         )
-        .filter(~pl.col("section").is_in(disallowed_sections))
-    )
-
-    for pattern, replacement in section_replacements.items():
-        df = df.with_columns(pl.col("section").str.replace_all(pattern, replacement))
-    for pattern, replacement in title_replacements.items():
-        df = df.with_columns(pl.col("title").str.replace_all(pattern, replacement))
-
-    df = (
-        df.with_columns(
+        .with_columns(
+            compile_replacements(records_df["section"], section_replacements),
+            compile_replacements(records_df["title"], title_replacements),
+        )
+        .with_columns(
             # This extracts the video_id and remakes it, to avoid breaking if the video_url is incomplete (the site may have incomplete urls)
             pl.col("video_url")
             .str.extract(r"id=(\d+)", 1)
@@ -260,26 +663,23 @@ def to_pre_scraping_df(
         )
         .unique("video_id")
         .filter(~pl.col("video_id").is_in(existing_video_ids))
-        .with_columns(
-            [
-                (
-                    pl.lit("https://allthepreaching.com/pages/video.php?id=")
-                    + pl.col("video_id").cast(str)
-                ).alias("video_url"),
-            ]
-        )
-        .join(section_preacher_df, pl.col("section"))
     )
+    if processed_index is not None:
+        df = processed_index.filter_unprocessed(df)
+    df = df.with_columns(
+        [
+            (
+                pl.lit("https://allthepreaching.com/pages/video.php?id=")
+                + pl.col("video_id").cast(str)
+            ).alias("video_url"),
+        ]
+    ).join(section_preacher_df, pl.col("section"))
 
     evaluate_preacher_df = (
         df.filter(pl.col("preacher") == "evaluate")
-        # Apply the function directly to the "title" column
+        # Evaluate the whole "title" column at once
         # and overwrite the "preacher" column with the result.
-        .with_columns(
-            pl.col("title")
-            .map_elements(evaluate_preacher, return_dtype=pl.String)
-            .alias("preacher")
-        )
+        .with_columns(evaluate_preacher_expr(pl.col("title")).alias("preacher"))
         # Use the newly updated "preacher" column to create the new "title".
         .with_columns(
             pl.when(pl.col("preacher") != "unknown")
@@ -301,103 +701,308 @@ def to_pre_scraping_df(
                 "video_url",
             ]
         )
-        # Collect at the very end
-        .collect()
     )
-
-    try:
-        df.validate()
-    except pt.DataFrameValidationError as e:
-        # print(e)
-        raise (e)
-    return df
+    # Validated while the plan is collected, invalid records go to the quarantine
+    return PreScrapingDataFrameModel.DataFrame(
+        validation.validate(
+            df,
+            PreScrapingDataFrameModel,
+            "to_pre_scraping_df",
+            processed_index=processed_index,
+        )
+    )
 
 
-def to_transcript_df(df: pt.DataFrame) -> pt.DataFrame:
+@metrics.instrument("to_transcript_df")
+def to_transcript_df(
+    df: pt.DataFrame, processed_index: ProcessedIndex | None = None
+) -> pt.DataFrame:
     """Validates the data for the record. Does not validate the transcript.
 
     - transcript_hash: int - This is a number to be used for detecting duplicate transcripts, rather than comparing entire transcripts.
+
+    Records breaking TranscriptDataFrameModel (e.g. duplicate video_id, mp4_url or transcript_hash) go to the quarantine.
+    With a processed_index, a mp4_url or transcript_hash already recorded for another video is a duplicate too.
     """
-    df = (
+    lf = (
         TranscriptDataFrameModel.LazyFrame(df)
         .derive()
-        .unique(
-            "video_id"
-        )  # TODO: shouldn't need this when scraping. I used it because I am adapting the existing dataset to the new format, and it has dupes.
-        # Filters must match TranscriptDataFrameModel field validation definitions
-        .filter([pl.col("mp4_url").str.contains(mp4_url_pattern)])
-        .filter([pl.col("mp3_url").str.contains(mp3_url_pattern)])
-        .filter([pl.col("vtt_url").str.contains(vtt_url_pattern)])
-        .filter([pl.col("transcript") != "."])
-        .filter([pl.col("vtt").str.len_chars() > 5])
-        .filter([pl.col("transcript").str.len_chars() > 5])
         .with_columns(pl.col("transcript").hash().alias("transcript_hash"))
-        .unique(
-            [
-                "mp4_url",
-            ],
-            keep="first",
-        )
-        .unique(
-            [
-                "transcript_hash",
-            ],
-            keep="first",
+    )
+    return TranscriptDataFrameModel.DataFrame(
+        validation.validate(
+            lf,
+            TranscriptDataFrameModel,
+            "to_transcript_df",
+            processed_index=processed_index,
         )
-        .collect()
     )
+
+
+@functools.cache
+def get_tokenizer():
+    """Loads the tokenizer_name tokenizer. It is only loaded once per process."""
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+_sentence_ends = (".", "?", "!")
+_tokenizer_stats = {"texts": 0, "tokens": 0, "characters": 0, "seconds": 0.0}
+
+
+def _chunk_bounds(
+    text: str, offsets: list[tuple[int, int]], size: int, overlap: int
+) -> list[tuple[int, int]]:
+    """Returns the [start, end) token indices of the chunks of a tokenized text.
+
+    A chunk holds at most size tokens and ends at a word boundary, at the end of a sentence if there is one in the
+    second half of the chunk. The next chunk starts overlap tokens before its end, at a word boundary too.
+    """
+    n = len(offsets)
+    # word_start[i]: token i starts a word, i.e. there is a space before it
+    word_start = [i == 0 or offsets[i][0] > offsets[i - 1][1] for i in range(n)]
+    bounds = []
+    start = 0
+    while start < n:
+        end = min(start + size, n)
+        if end < n:
+            boundaries = [e for e in range(end, start, -1) if word_start[e]]
+            sentence_ends = [
+                e
+                for e in boundaries
+                if e - start >= size // 2
+                and text[offsets[e - 1][1] - 1] in _sentence_ends
+            ]
+            # A single word longer than size tokens is cut where it overflows
+            end = (sentence_ends or boundaries or [end])[0]
+        bounds.append((start, end))
+        if end == n:
+            break
+        next_start = max(end - overlap, start + 1)
+        while next_start < end and not word_start[next_start]:
+            next_start += 1
+        start = next_start
+    return bounds
+
+
+def chunk_transcript(
+    transcript: str,
+    cues: list[dict] | None = None,
+    size: int = chunk_size,
+    overlap: int = chunk_overlap,
+) -> list[dict]:
+    """Splits a transcript into chunks of at most size tokens, overlapping by about overlap tokens.
+
+    The transcript is tokenized once, and the chunks are cut from the token offsets, so they don't have to be
+    tokenized again to be counted. Returns per chunk:
+
+    - chunk: str - The text of the chunk.
+    - token_count: int - Its number of tokens.
+    - char_start, char_end: int - Its [start, end) character offsets in the transcript.
+    - start_seconds, end_seconds: float - The start of the cue of its first word and the end of the cue of its
+      last word, from the cues offset index (see vtt_to_text_with_cues). None without cues.
+    """
+    start_time = time.perf_counter()
+    offsets = get_tokenizer()(
+        transcript,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+        verbose=False,
+    )["offset_mapping"]
+    _tokenizer_stats["seconds"] += time.perf_counter() - start_time
+    _tokenizer_stats["texts"] += 1
+    _tokenizer_stats["tokens"] += len(offsets)
+    _tokenizer_stats["characters"] += len(transcript)
+
+    cue_offsets = [cue["offset"] for cue in cues or []]
+    chunks = []
+    for start, end in _chunk_bounds(transcript, offsets, size, overlap):
+        char_start, char_end = offsets[start][0], offsets[end - 1][1]
+        start_seconds = end_seconds = None
+        if cue_offsets:
+            first_cue = max(bisect.bisect_right(cue_offsets, char_start) - 1, 0)
+            last_cue = max(bisect.bisect_right(cue_offsets, char_end - 1) - 1, 0)
+            start_seconds = cues[first_cue]["start"]
+            end_seconds = cues[last_cue]["end"]
+        chunks.append(
+            {
+                "chunk": transcript[char_start:char_end],
+                "token_count": end - start,
+                "char_start": char_start,
+                "char_end": char_end,
+                "start_seconds": start_seconds,
+                "end_seconds": end_seconds,
+            }
+        )
+    return chunks
+
+
+_chunking_executor = None
+"""The (workers, pool) of the chunking_pool() block being run, if any"""
+
+
+@contextmanager
+def chunking_pool(workers: int | None = chunking_workers):
+    """Keeps one chunking process pool for every to_chunk_df call with these workers inside the with block, e.g. every
+    batch of a pipeline run, so the workers only load the tokenizer once. The pool is shut down when the block exits.
+    """
+    global _chunking_executor
+    executor = _process_pool(workers, initializer=get_tokenizer)
+    previous = _chunking_executor
+    _chunking_executor = (workers, executor)
     try:
-        df.validate()
-    except pt.DataFrameValidationError as e:
-        # print(e)
-        raise (e)
-    return df
-
-
-def to_chunked_record_df(df_transcript: pt.DataFrame) -> pt.DataFrame:
-    # Load tokenizer
-    tokenizer = AutoTokenizer.from_pretrained("sentence-transformers/all-MiniLM-L6-v2")
-    chunk_overlap = 30
-    chunk_size = 256  # max tokens per chunk
-    chunker = semchunk.chunkerify(tokenizer, chunk_size)
-    df_chunks = ChunkedRecordDataFrameModel.DataFrame()
-    for i, transcript in enumerate(df_transcript["transcript"]):
-        video_id = df_transcript.item(i, 0)
-        chunks = chunker(transcript, overlap=chunk_overlap)
-        indexes = list(range(1, len(chunks) + 1))
-        token_counts = [len(tokenizer.tokenize(chunk)) for chunk in chunks]
-        chunks_count = [len(chunks) for chunk in chunks]
-        df_chunks.vstack(
-            pl.DataFrame(
-                {
-                    "chunk": chunks,
-                    "chunk_number": indexes,
-                    "token_count": token_counts,
-                    "chunks_count": chunks_count,
-                }
-            ).join(
-                df_transcript.filter(pl.col("video_id").eq(video_id)).drop(
-                    ["vtt", "transcript", "mp3_url", "vtt_url", "transcript_hash"]
-                ),
-                how="cross",
-            ),
-            in_place=True,
+        yield executor
+    finally:
+        _chunking_executor = previous
+        executor.shutdown()
+
+
+_chunk_schema = {
+    "video_id": pl.Int64,
+    "chunk_number": pl.Int64,
+    "chunks_count": pl.Int64,
+    "token_count": pl.Int64,
+    "char_start": pl.Int64,
+    "char_end": pl.Int64,
+    "start_seconds": pl.Float64,
+    "end_seconds": pl.Float64,
+    "chunk": pl.String,
+}
+
+
+def _chunk_transcripts(
+    batch: tuple[list[int], list[str], list[list[dict] | None]],
+) -> tuple[pl.DataFrame, dict]:
+    """Chunks a batch of (video_ids, transcripts, cues) inside a worker process.
+
+    Returns a df with the _chunk_schema fields, and the tokenizer stats of the batch,
+    since the worker's metrics aren't those of the main process.
+    """
+    columns = {column: [] for column in _chunk_schema}
+    for video_id, transcript, cues in zip(*batch):
+        chunks = chunk_transcript(transcript, cues)
+        columns["video_id"].extend([video_id] * len(chunks))
+        columns["chunk_number"].extend(range(1, len(chunks) + 1))
+        columns["chunks_count"].extend([len(chunks)] * len(chunks))
+        for chunk in chunks:
+            for column, value in chunk.items():
+                columns[column].append(value)
+    tokenizer_stats = dict(_tokenizer_stats)
+    _tokenizer_stats.update(texts=0, tokens=0, characters=0, seconds=0.0)
+    return pl.DataFrame(columns, schema=_chunk_schema), tokenizer_stats
+
+
+@metrics.instrument("to_chunk_df")
+def to_chunk_df(
+    df_transcript: pt.DataFrame,
+    workers: int | None = chunking_workers,
+    batch_size: int = chunking_batch_size,
+) -> pl.DataFrame:
+    """Splits every transcript into chunks of at most chunk_size tokens, overlapping by chunk_overlap tokens.
+
+    Returns the chunk table, "video_id" and the chunk_columns of ChunkedRecordDataFrameModel. The metadata of the
+    videos is left in the video table (see to_video_df), instead of being copied into each of their chunks.
+
+    The chunks are timestamped from the "cues" column (see vtt_column_to_transcript), if df_transcript has one.
+    Transcripts are chunked in batches of batch_size across a pool of workers processes (os.cpu_count() by default),
+    the pool of the enclosing chunking_pool() block if there is one, or a pool started for this call.
+    With workers=0 the batches are chunked in this process instead.
+    """
+    video_ids = df_transcript["video_id"].to_list()
+    transcripts = df_transcript["transcript"].to_list()
+    cues = (
+        df_transcript["cues"].to_list()
+        if "cues" in df_transcript.columns
+        else [None] * len(video_ids)
+    )
+    batches = [
+        (
+            video_ids[i : i + batch_size],
+            transcripts[i : i + batch_size],
+            cues[i : i + batch_size],
         )
+        for i in range(0, len(video_ids), batch_size)
+    ]
+    if workers == 0:
+        results = [_chunk_transcripts(batch) for batch in batches]
+    elif _chunking_executor is not None and _chunking_executor[0] == workers:
+        results = list(_chunking_executor[1].map(_chunk_transcripts, batches))
+    else:
+        with _process_pool(workers, initializer=get_tokenizer) as executor:
+            results = list(executor.map(_chunk_transcripts, batches))
+    for _, tokenizer_stats in results:
+        metrics.record_tokenizer(**tokenizer_stats)
+    chunk_dfs = [chunk_df for chunk_df, _ in results]
+    df_chunks = (
+        pl.concat(chunk_dfs) if chunk_dfs else pl.DataFrame(schema=_chunk_schema)
+    )
     df_chunks = df_chunks.with_columns(
         (
             pl.col("video_id").cast(pl.String)
             + pl.lit("_")
             + pl.col("chunk_number").cast(pl.String)
         ).alias("chunk_id")
-    )
-    try:
-        df_chunks.validate()
-    except pt.DataFrameValidationError as e:
-        print(e)
-        # raise(e)
+    ).select("video_id", *chunk_columns)
     # (Pandas version, irrelevant now) took 48.5 minutes to run with 16122 transcripts, 30 overlap, 256 size, resulting in 985480 chunks
-    # Projected to take 90 minutes with 16k transcripts, have not tested. Maybe it's slower due to patito validation.
-    return df_chunks
+    # The metadata columns were validated by to_transcript_df, only the chunk columns are left
+    df_chunks = validation.validate(
+        df_chunks, ChunkedRecordDataFrameModel, "to_chunk_df", columns=chunk_columns
+    )
+    # The quarantined chunks (e.g. duplicate texts) aren't ingested, so chunks_count only counts the valid ones
+    return df_chunks.with_columns(
+        pl.len().over("video_id").cast(pl.Int64).alias("chunks_count")
+    )
+
+
+def to_video_df(df_transcript: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame:
+    """Returns the video table of the chunks, the video_columns of the transcripts, one row per video.
+
+    The categorical_columns (e.g. preacher, section) are dictionary encoded, they only have a few hundred values.
+    """
+    return (
+        df_transcript.lazy()
+        .select(video_columns)
+        .with_columns(pl.col(categorical_columns).cast(pl.Categorical))
+        .collect()
+    )
+
+
+def join_chunk_videos(
+    df_chunks: pl.DataFrame | pl.LazyFrame, df_videos: pl.DataFrame | pl.LazyFrame
+) -> pl.LazyFrame:
+    """The wide view of the chunks, every chunk with the metadata of its video, as a lazy join.
+
+    Only consumers needing the wide rows (e.g. the Chroma metadata) should collect it, and only for the rows they need.
+    Columns df_chunks already has are not joined again."""
+    columns = df_chunks.lazy().collect_schema().names()
+    return df_chunks.lazy().join(
+        df_videos.lazy().select(
+            "video_id", *[column for column in video_columns if column not in columns]
+        ),
+        on="video_id",
+        how="left",
+        maintain_order="left",
+    )
+
+
+def to_chunked_record_df(
+    df_transcript: pt.DataFrame,
+    workers: int | None = chunking_workers,
+    batch_size: int = chunking_batch_size,
+) -> pt.DataFrame:
+    """Chunks the transcripts with to_chunk_df, and joins every chunk with the metadata of its video.
+
+    The wide frame copies the metadata strings into every chunk, prefer to_chunk_df and to_video_df.
+    """
+    df_chunks = to_chunk_df(df_transcript, workers, batch_size)
+    return ChunkedRecordDataFrameModel.DataFrame(
+        join_chunk_videos(df_chunks, df_transcript)
+        .select(ChunkedRecordDataFrameModel.columns)
+        .collect()
+    )
 
 
 # message_404 = """<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">\n<html><head>\n<title>404 Not Found</title>\n</head><body>\n<h1>Not Found</h1>\n<p>The requested URL was not found on this server.</p>\n</body></html>\n"""
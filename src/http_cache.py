@@ -0,0 +1,226 @@
+"""## This file contains the on-disk response cache used by fetching.py
+
+Bodies are stored zlib-compressed under the sha256 of their content, so identical responses are only stored once.
+A sqlite index maps each url to its body, validators (ETag / Last-Modified) and timestamps.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from config import *
+
+
+class HTTPCache:
+    """A size-bounded, content-addressed cache of GET responses.
+
+    - lookup(url) returns the cached entry of the url, if any.
+    - is_fresh(entry) tells whether the entry can be used without revalidation, based on http_cache_ttls.
+    - store(...) saves a new response, refresh(url) marks a revalidated (304) entry as fresh again.
+
+    The least recently used entries are evicted once the bodies exceed max_bytes."""
+
+    def __init__(
+        self,
+        cache_dir: str = http_cache_dir,
+        max_bytes: int = http_cache_max_bytes,
+        ttls: dict = http_cache_ttls,
+        default_ttl: float | None = http_cache_default_ttl,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls.items()]
+        self.default_ttl = default_ttl
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), check_same_thread=False
+        )
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                body_hash TEXT NOT NULL,
+                encoding TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+            CREATE INDEX IF NOT EXISTS entries_body_hash ON entries (body_hash);
+            CREATE TABLE IF NOT EXISTS blobs (
+                body_hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+            """)
+        self._total_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()[0]
+
+    def _blob_path(self, body_hash: str) -> str:
+        return os.path.join(self.cache_dir, "blobs", body_hash[:2], body_hash + ".z")
+
+    def ttl(self, url: str) -> float | None:
+        """Returns the TTL of the url, from the first matching pattern in ttls."""
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def is_fresh(self, entry: dict) -> bool:
+        """Whether the entry can be served without revalidating it with the origin."""
+        ttl = self.ttl(entry["url"])
+        return ttl is None or time.time() - entry["fetched_at"] < ttl
+
+    def lookup(self, url: str) -> dict | None:
+        """Returns the cached entry of the url, with its decompressed body, or None on a miss.
+
+        The lock only covers the index lookup and the last_access update, the blob is read and decompressed
+        outside of it, so concurrent hits don't wait for each other."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body_hash, encoding, etag, last_modified, fetched_at FROM entries WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE entries SET last_access = ? WHERE url = ?", (time.time(), url)
+            )
+            self._db.commit()
+        body_hash, encoding, etag, last_modified, fetched_at = row
+        try:
+            with open(self._blob_path(body_hash), "rb") as f:
+                body = zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            # The blob is missing or corrupt, treat it as a miss so it gets fetched again.
+            # The url may have been stored again since the lookup, only its entry for this blob is deleted.
+            with self._lock:
+                self._db.execute(
+                    "DELETE FROM entries WHERE url = ? AND body_hash = ?",
+                    (url, body_hash),
+                )
+                self._db.commit()
+            return None
+        return {
+            "url": url,
+            "body": body,
+            "encoding": encoding,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": fetched_at,
+        }
+
+    def conditional_headers(self, entry: dict) -> dict:
+        """Returns the If-None-Match / If-Modified-Since headers needed to revalidate the entry."""
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(
+        self,
+        url: str,
+        body: bytes,
+        encoding: str | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ):
+        """Saves the response body of the url, replacing the previous entry."""
+        body_hash = hashlib.sha256(body).hexdigest()
+        blob_path = self._blob_path(body_hash)
+        now = time.time()
+        with self._lock:
+            known = self._db.execute(
+                "SELECT 1 FROM blobs WHERE body_hash = ?", (body_hash,)
+            ).fetchone()
+            if known is None:
+                compressed = zlib.compress(body, 6)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                # Write to a temp file first, so a crash never leaves a truncated blob behind.
+                tmp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(compressed)
+                os.replace(tmp_path, blob_path)
+                self._db.execute(
+                    "INSERT INTO blobs (body_hash, size) VALUES (?, ?)",
+                    (body_hash, len(compressed)),
+                )
+                self._total_bytes += len(compressed)
+            old = self._db.execute(
+                "SELECT body_hash FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, body_hash, encoding, etag, last_modified, now, now),
+            )
+            if old is not None and old[0] != body_hash:
+                self._delete_unreferenced_blob(old[0])
+            self._evict()
+            self._db.commit()
+
+    def refresh(self, url: str):
+        """Marks the entry of the url as fresh, after the origin answered 304 Not Modified."""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE entries SET fetched_at = ?, last_access = ? WHERE url = ?",
+                (now, now, url),
+            )
+            self._db.commit()
+
+    def _delete_unreferenced_blob(self, body_hash: str):
+        """Deletes the blob if no url points at it anymore. Must be called with the lock held."""
+        referenced = self._db.execute(
+            "SELECT 1 FROM entries WHERE body_hash = ? LIMIT 1", (body_hash,)
+        ).fetchone()
+        if referenced is not None:
+            return
+        row = self._db.execute(
+            "SELECT size FROM blobs WHERE body_hash = ?", (body_hash,)
+        ).fetchone()
+        if row is None:
+            return
+        self._db.execute("DELETE FROM blobs WHERE body_hash = ?", (body_hash,))
+        self._total_bytes -= row[0]
+        try:
+            os.remove(self._blob_path(body_hash))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Evicts the least recently used entries until the cache fits in max_bytes. Must be called with the lock held."""
+        while self._total_bytes > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT url, body_hash FROM entries ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for url, body_hash in rows:
+                self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self._delete_unreferenced_blob(body_hash)
+                if self._total_bytes <= self.max_bytes:
+                    break
+
+    def size(self) -> int:
+        """Returns the total compressed size of the cached bodies, in bytes."""
+        return self._total_bytes
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> HTTPCache:
+    """Returns the shared cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = HTTPCache()
+    return _cache
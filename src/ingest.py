@@ -0,0 +1,289 @@
+"""## This file contains the ingestion stage, which loads the chunk records into the atp_chunks Chroma collection
+
+Batches are embedded on a background thread while the previous ones are upserted, through a bounded queue.
+Progress is checkpointed after every upsert, so an interrupted ingestion resumes instead of restarting.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+import polars as pl
+
+import helpers
+import metrics
+from config import *
+from embedding_cache import EmbeddingCache
+from query_cache import bump_collection_version
+
+metadata_columns = [
+    "video_id",
+    "chunk_number",
+    "chunks_count",
+    "token_count",
+    "start_seconds",
+    "end_seconds",
+    "section",
+    "title",
+    "preacher",
+    "video_url",
+    "mp4_url",
+]
+"""The fields of ChunkedRecordDataFrameModel stored as Chroma metadata"""
+
+
+def get_chunk_collection(path: str = chroma_db_path, name: str = chunk_collection_name):
+    """Opens (or creates) the chunk collection of the persistent Chroma database at path."""
+    import chromadb
+    from chromadb import Settings
+
+    client = chromadb.PersistentClient(
+        path=path,
+        settings=Settings(is_persistent=True, anonymized_telemetry=False),
+    )
+    return client.get_or_create_collection(name=name)
+
+
+def get_embedding_function():
+    """Returns Chroma's default embedding function (all-MiniLM-L6-v2, on CPU)."""
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+
+    return DefaultEmbeddingFunction()
+
+
+def _fingerprint(df_chunks: pl.DataFrame) -> str:
+    """Identifies the chunk frame, so a checkpoint is only resumed for the frame it was made for."""
+    return f"{df_chunks.height}:{df_chunks['chunk_id'].hash(seed=0).sum()}"
+
+
+def _load_checkpoint(checkpoint_path: str, fingerprint: str) -> int:
+    """Returns the number of chunks already upserted for this frame."""
+    try:
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint.get("fingerprint") != fingerprint:
+        return 0
+    return checkpoint["done"]
+
+
+def _save_checkpoint(checkpoint_path: str, fingerprint: str, done: int):
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"fingerprint": fingerprint, "done": done}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+@metrics.instrument("ingest_chunks")
+def ingest_chunks(
+    df_chunks: pl.DataFrame,
+    collection=None,
+    embedding_function=None,
+    batch_size: int = ingest_batch_size,
+    queue_size: int = ingest_queue_size,
+    checkpoint_path: str = ingest_checkpoint_path,
+    embedding_cache: EmbeddingCache | None = None,
+    keyword_index=None,
+    df_videos: pl.DataFrame | None = None,
+) -> dict:
+    """Upserts the chunk records (see ChunkedRecordDataFrameModel) into the chunk collection, using chunk_id as the id.
+
+    - collection: defaults to get_chunk_collection().
+    - embedding_function: called with a list of chunks, returns their embeddings. Defaults to get_embedding_function().
+    - embedding_cache: only the chunks missing from it are embedded. Defaults to the embedding_model_name cache if embedding_cache_enabled.
+    - keyword_index: the upserted chunks are also added to it. Defaults to the BM25Index if keyword_index_enabled.
+    - df_videos: the video table (see to_video_df), if df_chunks is the chunk table of to_chunk_df.
+      Each batch is joined with it for its metadata.
+
+    The chunks of the videos of df_chunks that df_chunks doesn't have anymore, e.g. after rechunking a video into
+    fewer chunks, are deleted once every batch is upserted (see delete_orphaned_chunks). The embedding cache is then
+    evicted down to embedding_cache_max_rows.
+
+    Returns the number of upserted and orphaned chunks, the seconds it took, the throughput in chunks per second,
+    the share of embeddings that came from the cache and the number of embeddings evicted from it.
+    """
+    if collection is None:
+        collection = get_chunk_collection()
+    if embedding_function is None:
+        embedding_function = get_embedding_function()
+    if embedding_cache is None and embedding_cache_enabled:
+        embedding_cache = EmbeddingCache()
+    if keyword_index is None and keyword_index_enabled:
+        from keyword_index import BM25Index
+
+        keyword_index = BM25Index()
+
+    # A stable order makes "the first done rows" mean the same chunks after a restart
+    df_chunks = df_chunks.sort("video_id", "chunk_number")
+    fingerprint = _fingerprint(df_chunks)
+    done = _load_checkpoint(checkpoint_path, fingerprint)
+    total = df_chunks.height
+    if done:
+        print(f"Resuming ingestion at chunk {done}/{total}")
+
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def embed_batches():
+        try:
+            for offset in range(done, total, batch_size):
+                if stop.is_set():
+                    return
+                batch = df_chunks.slice(offset, batch_size)
+                documents = batch["chunk"].to_list()
+                if embedding_cache is not None:
+                    embeddings = embedding_cache.embed(documents, embedding_function)
+                else:
+                    embeddings = embedding_function(documents)
+                batches.put((offset + batch.height, batch, documents, embeddings))
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    producer = threading.Thread(target=embed_batches, daemon=True)
+    producer.start()
+    start = time.perf_counter()
+    upserted = 0
+    try:
+        while (item := batches.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            end, batch, documents, embeddings = item
+            metadata = batch
+            if df_videos is not None:
+                metadata = helpers.join_chunk_videos(batch, df_videos).collect()
+            collection.upsert(
+                ids=batch["chunk_id"].to_list(),
+                documents=documents,
+                embeddings=embeddings,
+                metadatas=metadata.select(metadata_columns).to_dicts(),
+            )
+            if keyword_index is not None:
+                keyword_index.add(batch["chunk_id"].to_list(), documents)
+            # The cached search results may miss these chunks now
+            bump_collection_version()
+            _save_checkpoint(checkpoint_path, fingerprint, end)
+            upserted += batch.height
+            elapsed = time.perf_counter() - start
+            print(f"{end}/{total} chunks, {upserted / elapsed:.1f} chunks/s")
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting for room in the queue
+        while producer.is_alive():
+            try:
+                batches.get_nowait()
+            except queue.Empty:
+                producer.join(0.1)
+
+    orphaned = delete_orphaned_chunks(df_chunks, collection, keyword_index)
+    evicted = embedding_cache.evict() if embedding_cache is not None else 0
+    seconds = time.perf_counter() - start
+    return {
+        "chunks": upserted,
+        "orphaned_chunks": orphaned,
+        "seconds": seconds,
+        "chunks_per_second": upserted / seconds if seconds else 0.0,
+        "embedding_cache_hit_rate": (
+            embedding_cache.hit_rate() if embedding_cache is not None else 0.0
+        ),
+        "evicted_embeddings": evicted,
+    }
+
+
+def compact_embedding_cache(
+    collection=None,
+    embedding_cache: EmbeddingCache | None = None,
+    batch_size: int = vector_index_build_batch_size,
+) -> int:
+    """Drops the embeddings of the cache (the embedding_model_name cache by default) that no chunk of the collection
+    (get_chunk_collection() by default) has anymore, e.g. after rechunking. Returns the number of dropped embeddings.
+
+    The documents are read batch_size at a time, only their hashes are kept."""
+    if collection is None:
+        collection = get_chunk_collection()
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache()
+    total = collection.count()
+
+    def iter_documents():
+        for offset in range(0, total, batch_size):
+            page = collection.get(
+                limit=batch_size, offset=offset, include=["documents"]
+            )
+            if not page["ids"]:
+                return
+            yield from page["documents"]
+
+    return embedding_cache.compact(iter_documents())
+
+
+def delete_orphaned_chunks(
+    df_chunks: pl.DataFrame,
+    collection=None,
+    keyword_index=None,
+    batch_size: int = ingest_batch_size,
+) -> int:
+    """Deletes the chunks of the videos of df_chunks that aren't in df_chunks, from the collection and the keyword index.
+
+    Returns the number of deleted chunks."""
+    if collection is None:
+        collection = get_chunk_collection()
+    chunk_ids = set(df_chunks["chunk_id"].to_list())
+    video_ids = df_chunks["video_id"].unique().to_list()
+    orphaned = []
+    for offset in range(0, len(video_ids), batch_size):
+        page = collection.get(
+            where={"video_id": {"$in": video_ids[offset : offset + batch_size]}},
+            include=[],
+        )
+        orphaned += [chunk_id for chunk_id in page["ids"] if chunk_id not in chunk_ids]
+    for i in range(0, len(orphaned), batch_size):
+        collection.delete(ids=orphaned[i : i + batch_size])
+    if orphaned:
+        if keyword_index is not None:
+            keyword_index.delete(orphaned)
+        bump_collection_version()
+    return len(orphaned)
+
+
+@metrics.instrument("update_chunk_metadata")
+def update_chunk_metadata(
+    df_videos: pl.DataFrame, collection=None, batch_size: int = ingest_batch_size
+) -> dict:
+    """Patches the metadata of the chunks of the videos of df_videos in the collection, with its columns other than video_id.
+
+    The chunks keep their documents and embeddings, and only those whose metadata differs are updated.
+    Returns the number of videos and of updated chunks."""
+    if collection is None:
+        collection = get_chunk_collection()
+    columns = [column for column in df_videos.columns if column != "video_id"]
+    videos = {row["video_id"]: row for row in df_videos.to_dicts()}
+    video_ids = list(videos)
+    updated = 0
+    for offset in range(0, len(video_ids), batch_size):
+        page = collection.get(
+            where={"video_id": {"$in": video_ids[offset : offset + batch_size]}},
+            include=["metadatas"],
+        )
+        ids = []
+        metadatas = []
+        for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+            video = videos[metadata["video_id"]]
+            if any(metadata.get(column) != video[column] for column in columns):
+                ids.append(chunk_id)
+                metadatas.append({column: video[column] for column in columns})
+        for i in range(0, len(ids), batch_size):
+            collection.update(
+                ids=ids[i : i + batch_size], metadatas=metadatas[i : i + batch_size]
+            )
+        updated += len(ids)
+        print(
+            f"{min(offset + batch_size, len(video_ids))}/{len(video_ids)} videos, {updated} chunks updated"
+        )
+    if updated:
+        bump_collection_version()
+    return {"videos": len(video_ids), "chunks": updated}
@@ -0,0 +1,518 @@
+"""## This file contains the BM25 keyword index of the chunks
+
+Embedding search ranks exact words poorly (scripture references like "romans 1", rare words like "reprobate"),
+so the chunks are also indexed in an on-disk inverted index, updated incrementally by the ingestion stage.
+
+- index.sqlite: the docs (doc_id -> chunk_id, text hash, deleted flag), and the postings of every term,
+  one compressed blob per term and segment. Each add() writes a new segment, and segments of similar size
+  are merged, so there are about log2(docs / batch) of them and a term is a few blobs.
+- lengths.u32: the length in words of every doc, by doc_id.
+
+A posting blob is the zlib compressed doc_id deltas (uint32) followed by the term frequencies (uint16),
+so it is decoded by numpy instead of a Python loop, and scored for every doc at once."""
+
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections import Counter
+
+import numpy as np
+import polars as pl
+
+from config import *
+
+_token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits the text into lowercase words, e.g. "Romans 1:18" -> ["romans", "1", "18"]."""
+    return _token_pattern.findall(text.lower())
+
+
+def _text_hash(text: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(text.encode(), digest_size=8).digest(), "little", signed=True
+    )
+
+
+def _pack(raw: bytes) -> bytes:
+    """Prefixes the raw postings with a flag byte, compressing them unless they are too short to gain anything."""
+    if len(raw) < 64:
+        return b"\x00" + raw
+    return b"\x01" + zlib.compress(raw)
+
+
+def encode_postings(doc_ids: np.ndarray, tfs: np.ndarray) -> bytes:
+    """Compresses the postings of a term. doc_ids must be sorted."""
+    deltas = np.diff(doc_ids, prepend=0).astype(np.uint32)
+    return _pack(deltas.tobytes() + np.minimum(tfs, 65535).astype(np.uint16).tobytes())
+
+
+def decode_postings(data: bytes, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the (doc_ids, tfs) of a posting blob of count docs."""
+    raw = zlib.decompress(data[1:]) if data[0] else data[1:]
+    doc_ids = np.cumsum(
+        np.frombuffer(raw, dtype=np.uint32, count=count), dtype=np.int64
+    )
+    tfs = np.frombuffer(raw, dtype=np.uint16, count=count, offset=4 * count)
+    return doc_ids, tfs
+
+
+def _encode_segment(
+    term_codes: np.ndarray, terms: list[str], doc_ids: np.ndarray, tfs: np.ndarray
+) -> list[tuple[str, int, bytes]]:
+    """Returns the (term, count, blob) postings rows of a segment, given one (term code, doc_id, tf) per posting.
+
+    Like encode_postings for every term, but the deltas are computed for the whole segment at once,
+    since a segment has tens of thousands of terms, most with a handful of postings."""
+    order = np.lexsort((doc_ids, term_codes))
+    term_codes, doc_ids, tfs = term_codes[order], doc_ids[order], tfs[order]
+    starts = np.flatnonzero(np.r_[True, term_codes[1:] != term_codes[:-1]])
+    ends = np.r_[starts[1:], len(term_codes)]
+    deltas = np.diff(doc_ids, prepend=0)
+    deltas[starts] = doc_ids[starts]
+    deltas = deltas.astype(np.uint32).tobytes()
+    tfs = np.minimum(tfs, 65535).astype(np.uint16).tobytes()
+    return [
+        (
+            terms[code],
+            end - start,
+            _pack(deltas[4 * start : 4 * end] + tfs[2 * start : 2 * end]),
+        )
+        for code, start, end in zip(
+            term_codes[starts].tolist(), starts.tolist(), ends.tolist()
+        )
+    ]
+
+
+class BM25Index:
+    """An incremental BM25 index of chunk texts, keyed by chunk_id.
+
+    - add(chunk_ids, texts) indexes new chunks. A known chunk_id with a new text replaces the old one,
+      the same text is skipped, so re-adding the same chunks is a no-op.
+    - search(query, k, doc_ids) returns the top k ["chunk_id", "score"], among doc_ids if given.
+    - doc_ids(chunk_ids) returns the doc_id of every chunk_id, e.g. to map the rows of the vector index once.
+    - delete(chunk_ids) removes chunks.
+    - compact() merges every segment into one, dropping the postings of the replaced and deleted chunks.
+
+    The doc lengths and deleted flags are kept in memory. They are reloaded when another handle or process committed
+    changes to the index (see refresh), and generation is incremented every time they change.
+    """
+
+    def __init__(
+        self, path: str = bm25_index_dir, k1: float = bm25_k1, b: float = bm25_b
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._lengths_path = os.path.join(path, "lengths.u32")
+        self._db = sqlite3.connect(
+            os.path.join(path, "index.sqlite"), check_same_thread=False
+        )
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY,
+                chunk_id TEXT NOT NULL,
+                text_hash INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS docs_chunk_id ON docs (chunk_id);
+            CREATE TABLE IF NOT EXISTS segments (
+                segment INTEGER PRIMARY KEY,
+                docs INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                segment INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (term, segment)
+            ) WITHOUT ROWID;
+            """)
+        doc_count = self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+        if os.path.exists(self._lengths_path):
+            lengths = np.fromfile(self._lengths_path, dtype=np.uint32)
+            if len(lengths) > doc_count:
+                # The lengths are appended before the docs are committed, an interrupted add() leaves extra lengths
+                lengths[:doc_count].tofile(self._lengths_path)
+        self.generation = 0
+        self._load()
+
+    def _load(self):
+        """Loads the lengths and deleted flags of the committed docs. Must be called with the lock held."""
+        self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        doc_count = self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+        lengths = (
+            np.fromfile(self._lengths_path, dtype=np.uint32)
+            if os.path.exists(self._lengths_path)
+            else np.empty(0, dtype=np.uint32)
+        )
+        # Another handle may be appending the lengths of docs it hasn't committed yet
+        self.lengths = lengths[:doc_count].astype(np.float64)
+        self.deleted = np.zeros(doc_count, dtype=bool)
+        self.deleted[
+            [
+                doc_id
+                for (doc_id,) in self._db.execute(
+                    "SELECT doc_id FROM docs WHERE deleted = 1"
+                )
+            ]
+        ] = True
+        self._update_norms()
+        self._chunk_docs = None
+        self.generation += 1
+
+    def _refresh(self) -> bool:
+        """Reloads the docs if another connection committed changes since they were loaded. Must be called with the
+        lock held. sqlite's data_version only changes with the commits of other connections, so it is cheap to check.
+        """
+        if self._db.execute("PRAGMA data_version").fetchone()[0] == self._data_version:
+            return False
+        self._load()
+        return True
+
+    def refresh(self) -> bool:
+        """Reloads the docs if another handle or process changed the index since. Returns True if it did."""
+        with self._lock:
+            return self._refresh()
+
+    def __len__(self) -> int:
+        """The number of indexed chunks, without the replaced ones."""
+        return int((~self.deleted).sum())
+
+    def _update_norms(self):
+        """Precomputes k1 * (1 - b + b * length / average length) for every doc, the length part of BM25."""
+        live_lengths = self.lengths[~self.deleted]
+        average_length = live_lengths.mean() if len(live_lengths) else 1.0
+        self._norms = self.k1 * (1 - self.b + self.b * self.lengths / average_length)
+
+    def add(self, chunk_ids: list[str], texts: list[str]) -> int:
+        """Indexes the chunks, as one new segment. Returns the number of chunks indexed."""
+        latest = dict(zip(chunk_ids, texts))
+        with self._lock:
+            self._refresh()
+            known = {}
+            keys = list(latest)
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                for doc_id, chunk_id, text_hash in self._db.execute(
+                    f"SELECT doc_id, chunk_id, text_hash FROM docs WHERE deleted = 0 AND chunk_id IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ):
+                    known[chunk_id] = (doc_id, text_hash)
+            replaced = []
+            new_docs = []
+            for chunk_id, text in latest.items():
+                text_hash = _text_hash(text)
+                if chunk_id in known:
+                    if known[chunk_id][1] == text_hash:
+                        continue
+                    replaced.append(known[chunk_id][0])
+                new_docs.append((chunk_id, text, text_hash))
+            if not new_docs:
+                return 0
+
+            first_doc_id = len(self.lengths)
+            term_codes = {}
+            # One (term code, doc_id, tf) per posting
+            postings = ([], [], [])
+            lengths = np.empty(len(new_docs), dtype=np.uint32)
+            for i, (_, text, _) in enumerate(new_docs):
+                words = tokenize(text)
+                lengths[i] = len(words)
+                for term, tf in Counter(words).items():
+                    postings[0].append(term_codes.setdefault(term, len(term_codes)))
+                    postings[1].append(first_doc_id + i)
+                    postings[2].append(tf)
+            segment = (
+                self._db.execute("SELECT MAX(segment) FROM segments").fetchone()[0] or 0
+            ) + 1
+            with open(self._lengths_path, "ab") as f:
+                f.write(lengths.tobytes())
+            with self._db:
+                self._db.executemany(
+                    "UPDATE docs SET deleted = 1 WHERE doc_id = ?",
+                    [(doc_id,) for doc_id in replaced],
+                )
+                self._db.executemany(
+                    "INSERT INTO docs (doc_id, chunk_id, text_hash) VALUES (?, ?, ?)",
+                    [
+                        (first_doc_id + i, chunk_id, text_hash)
+                        for i, (chunk_id, _, text_hash) in enumerate(new_docs)
+                    ],
+                )
+                self._db.executemany(
+                    "INSERT INTO postings (term, segment, count, data) VALUES (?, ?, ?, ?)",
+                    [
+                        (term, segment, count, data)
+                        for term, count, data in _encode_segment(
+                            np.array(postings[0]),
+                            list(term_codes),
+                            np.array(postings[1]),
+                            np.array(postings[2]),
+                        )
+                    ],
+                )
+                self._db.execute(
+                    "INSERT INTO segments (segment, docs) VALUES (?, ?)",
+                    (segment, len(new_docs)),
+                )
+            self.lengths = np.concatenate([self.lengths, lengths])
+            self.deleted = np.concatenate(
+                [self.deleted, np.zeros(len(new_docs), dtype=bool)]
+            )
+            self.deleted[replaced] = True
+            self._update_norms()
+            self._chunk_docs = None
+            self.generation += 1
+            self._merge_segments()
+        return len(new_docs)
+
+    def delete(self, chunk_ids: list[str]) -> int:
+        """Removes the chunks from the index, e.g. the chunks a rechunked video doesn't have anymore.
+
+        Their postings are dropped by the next merge of their segment. Returns the number of deleted chunks.
+        """
+        with self._lock:
+            self._refresh()
+            doc_ids = []
+            for i in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[i : i + 500]
+                doc_ids += [
+                    doc_id
+                    for (doc_id,) in self._db.execute(
+                        f"SELECT doc_id FROM docs WHERE deleted = 0 AND chunk_id IN ({', '.join('?' * len(batch))})",
+                        batch,
+                    )
+                ]
+            with self._db:
+                self._db.executemany(
+                    "UPDATE docs SET deleted = 1 WHERE doc_id = ?",
+                    [(doc_id,) for doc_id in doc_ids],
+                )
+            self.deleted[doc_ids] = True
+            self._update_norms()
+            self._chunk_docs = None
+            self.generation += 1
+        return len(doc_ids)
+
+    def _merge(self, segments: list[int]):
+        """Merges the segments into the first one, dropping the deleted docs. Must be called with the lock held."""
+        term_codes = {}
+        codes = []
+        counts = []
+        deltas = []
+        tfs = []
+        for term, count, data in self._db.execute(
+            f"SELECT term, count, data FROM postings WHERE segment IN ({', '.join('?' * len(segments))})",
+            segments,
+        ):
+            raw = zlib.decompress(data[1:]) if data[0] else data[1:]
+            codes.append(term_codes.setdefault(term, len(term_codes)))
+            counts.append(count)
+            deltas.append(raw[: 4 * count])
+            tfs.append(raw[4 * count :])
+        rows = []
+        if codes:
+            # Decodes every blob at once, the doc_ids restart at the first delta of each blob
+            counts = np.array(counts)
+            codes = np.repeat(np.array(codes), counts)
+            deltas = np.frombuffer(b"".join(deltas), dtype=np.uint32).astype(np.int64)
+            tfs = np.frombuffer(b"".join(tfs), dtype=np.uint16)
+            doc_ids = np.cumsum(deltas)
+            starts = np.cumsum(counts) - counts
+            doc_ids -= np.repeat(doc_ids[starts] - deltas[starts], counts)
+            live = ~self.deleted[doc_ids]
+            rows = [
+                (term, segments[0], count, data)
+                for term, count, data in _encode_segment(
+                    codes[live], list(term_codes), doc_ids[live], tfs[live]
+                )
+            ]
+        doc_count = self._db.execute(
+            f"SELECT SUM(docs) FROM segments WHERE segment IN ({', '.join('?' * len(segments))})",
+            segments,
+        ).fetchone()[0]
+        with self._db:
+            self._db.execute(
+                f"DELETE FROM postings WHERE segment IN ({', '.join('?' * len(segments))})",
+                segments,
+            )
+            self._db.execute(
+                f"DELETE FROM segments WHERE segment IN ({', '.join('?' * len(segments))})",
+                segments,
+            )
+            self._db.executemany(
+                "INSERT INTO postings (term, segment, count, data) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._db.execute(
+                "INSERT INTO segments (segment, docs) VALUES (?, ?)",
+                (segments[0], doc_count),
+            )
+
+    def _merge_segments(self):
+        """Merges the newest segment into the previous one while it is at least as big, like a binary counter,
+        so each doc is rewritten about log2(segments) times. Must be called with the lock held.
+        """
+        while True:
+            segments = self._db.execute(
+                "SELECT segment, docs FROM segments ORDER BY segment DESC LIMIT 2"
+            ).fetchall()
+            if len(segments) < 2 or segments[0][1] < segments[1][1]:
+                return
+            self._merge([segments[1][0], segments[0][0]])
+
+    def compact(self):
+        """Merges every segment into one, dropping the postings of the replaced chunks."""
+        with self._lock:
+            self._refresh()
+            segments = [
+                segment
+                for (segment,) in self._db.execute(
+                    "SELECT segment FROM segments ORDER BY segment"
+                )
+            ]
+            if segments:
+                self._merge(segments)
+            self._db.execute("VACUUM")
+
+    def doc_ids(self, chunk_ids: list[str] | pl.Series) -> np.ndarray:
+        """Returns the doc_id of every chunk_id, -1 for the chunks that aren't indexed.
+
+        The doc_ids stay valid until generation changes. The chunk_id -> doc_id table is read on the first call
+        after a change, not on every call."""
+        with self._lock:
+            self._refresh()
+            if self._chunk_docs is None:
+                self._chunk_docs = pl.DataFrame(
+                    self._db.execute(
+                        "SELECT chunk_id, doc_id FROM docs WHERE deleted = 0"
+                    ).fetchall(),
+                    schema={"chunk_id": pl.String, "doc_id": pl.Int64},
+                    orient="row",
+                )
+            chunk_docs = self._chunk_docs
+        return (
+            pl.DataFrame({"chunk_id": chunk_ids}, schema={"chunk_id": pl.String})
+            .join(chunk_docs, on="chunk_id", how="left", maintain_order="left")[
+                "doc_id"
+            ]
+            .fill_null(-1)
+            .to_numpy()
+        )
+
+    def search(
+        self, query: str, k: int = 10, doc_ids: np.ndarray | None = None
+    ) -> pl.DataFrame:
+        """Returns the BM25 top k ["chunk_id", "score"] of the query, best first.
+
+        With doc_ids (see doc_ids()), only these docs are ranked, e.g. the chunks matching the search filters, so the
+        top k are taken among them. The IDF is still the one of the whole index.
+
+        Terms found in more than bm25_max_df_ratio of the chunks are ignored, unless the query has only such terms,
+        since their long postings cost the most and barely change the ranking."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            self._refresh()
+            postings = {term: [] for term in terms}
+            for i in range(0, len(terms), 500):
+                batch = terms[i : i + 500]
+                for term, count, data in self._db.execute(
+                    f"SELECT term, count, data FROM postings WHERE term IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ):
+                    postings[term].append((count, data))
+            deleted = self.deleted
+            norms = self._norms
+            doc_count = len(deleted) - int(deleted.sum())
+        allowed = None
+        if doc_ids is not None:
+            allowed = np.zeros(len(deleted), dtype=bool)
+            allowed[doc_ids[(doc_ids >= 0) & (doc_ids < len(deleted))]] = True
+        counts = {
+            term: sum(count for count, _ in term_postings)
+            for term, term_postings in postings.items()
+            if term_postings
+        }
+        rare_terms = [
+            term for term in counts if counts[term] <= bm25_max_df_ratio * doc_count
+        ]
+        doc_ids = []
+        scores = []
+        for term in rare_terms or list(counts):
+            decoded = [decode_postings(data, count) for count, data in postings[term]]
+            term_doc_ids = np.concatenate([ids for ids, _ in decoded])
+            tfs = np.concatenate([tfs for _, tfs in decoded]).astype(np.float64)
+            # Docs committed by another handle after the refresh are left out until the next one
+            known = term_doc_ids < len(deleted)
+            term_doc_ids, tfs = term_doc_ids[known], tfs[known]
+            live = ~deleted[term_doc_ids]
+            # The document frequency counts every live doc, allowed or not
+            document_frequency = int(live.sum())
+            if allowed is not None:
+                live &= allowed[term_doc_ids]
+            term_doc_ids, tfs = term_doc_ids[live], tfs[live]
+            idf = math.log(
+                1 + (doc_count - document_frequency + 0.5) / (document_frequency + 0.5)
+            )
+            doc_ids.append(term_doc_ids)
+            scores.append(idf * tfs * (self.k1 + 1) / (tfs + norms[term_doc_ids]))
+        if not doc_ids:
+            return pl.DataFrame(schema={"chunk_id": pl.String, "score": pl.Float64})
+        doc_ids, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        top = (
+            np.argpartition(-scores, k - 1)[:k]
+            if len(scores) > k
+            else np.arange(len(scores))
+        )
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top_doc_ids = doc_ids[top].tolist()
+        with self._lock:
+            chunk_ids = dict(
+                self._db.execute(
+                    f"SELECT doc_id, chunk_id FROM docs WHERE doc_id IN ({', '.join('?' * len(top_doc_ids))})",
+                    top_doc_ids,
+                ).fetchall()
+            )
+        return pl.DataFrame(
+            {
+                "chunk_id": [chunk_ids[doc_id] for doc_id in top_doc_ids],
+                "score": scores[top],
+            },
+            schema={"chunk_id": pl.String, "score": pl.Float64},
+        )
+
+    def close(self):
+        self._db.close()
+
+
+def build_keyword_index(
+    collection=None,
+    index: BM25Index | None = None,
+    batch_size: int = vector_index_build_batch_size,
+) -> BM25Index:
+    """Adds every chunk of the Chroma collection (get_chunk_collection() by default) to the index.
+
+    Chunks already indexed with the same text are skipped, so it can be re-run to backfill the index.
+    """
+    if collection is None:
+        import ingest
+
+        collection = ingest.get_chunk_collection()
+    index = index or BM25Index()
+    total = collection.count()
+    for offset in range(0, total, batch_size):
+        page = collection.get(limit=batch_size, offset=offset, include=["documents"])
+        if not page["ids"]:
+            break
+        index.add(page["ids"], page["documents"])
+        print(f"keyword index: {offset + len(page['ids'])}/{total} chunks")
+    return index
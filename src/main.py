@@ -1,8 +1,667 @@
-"""This file will contain the streamlit app"""
+"""This file runs the data pipeline. It will also contain the streamlit app
 
-import polars as pl
-import patito as pt
+The pipeline is a graph of stages, each persisting its output as Parquet checkpoints under checkpoint_dir:
+
+    archive -> pre_scraping -> scrape -> transcripts -> chunks -> ingest
+            -> refresh_metadata
+
+scrape, transcripts and chunks run concurrently on batches of pipeline_batch_size videos, connected by bounded queues,
+so chunking starts on the first transcripts while later VTTs are still downloading.
+
+Each checkpoint records a fingerprint of the config values its stage depends on (stage_config_dependencies), and
+a stage whose config changed is recomputed, with the stages downstream of it. refresh_metadata patches the chunks
+of the videos of earlier runs when the cleaning_rules change.
+
+Usage (from the src directory):
+
+    python main.py run                  # Runs the pipeline, resuming the last run if it didn't finish
+    python main.py run --fresh          # Discards the checkpoints of the unfinished run and starts over
+    python main.py resume               # Resumes the last run from its last completed stage / batch
+    python main.py stage transcripts    # Re-runs a single stage from the checkpoints of its inputs
+    python main.py status               # Prints the state of the checkpoints
+    python main.py stream-transcripts "data/checkpoints/scrape/*.parquet"   # Out of core transcripts, see streaming.py
+    python main.py vector-index         # Builds the vector index of the Chroma collection, see vector_index.py
+    python main.py keyword-index        # Adds the chunks of the Chroma collection missing from the keyword index
+    python main.py embedding-cache --compact   # Drops the cached embeddings of chunks gone from Chroma, see embedding_cache.py
+    python main.py search "the reprobate doctrine" --preacher "Steven Anderson"   # Hybrid search, see search.py
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import queue
+import shutil
+import threading
 import time
-import tqdm
+from typing import Callable, NamedTuple
+
+import polars as pl
+
 import helpers
+import metrics
+import near_duplicates
+import query_cache
+import search
 from config import *
+from state import ProcessedIndex, stage_fingerprint
+
+
+class Stage(NamedTuple):
+    """A stage of the pipeline.
+
+    - name: str - Also the name of its checkpoint.
+    - inputs: list[str] - The stages whose output it consumes.
+    - run: Callable - Takes the input dfs (whole, or one batch for batched stages) and returns the output df.
+    - batched: bool - If True, the stage runs on batches of videos, pipelined with the other batched stages.
+    - input_columns: dict[str, list[str]] | None - The columns read from the checkpoint of an input, all by default.
+    """
+
+    name: str
+    inputs: list[str]
+    run: Callable
+    batched: bool = False
+    input_columns: dict[str, list[str]] | None = None
+
+
+def run_archive(inputs: dict, processed_index: ProcessedIndex) -> pl.DataFrame:
+    """Scrapes the [section, title, video_url] records of the archive page."""
+    return helpers.scan_archive_records(atp_archive_url).collect()
+
+
+def run_pre_scraping(inputs: dict, processed_index: ProcessedIndex) -> pl.DataFrame:
+    """Cleans the archive records, skipping the videos that already went through the pipeline."""
+    return helpers.to_pre_scraping_df(inputs["archive"], processed_index)
+
+
+def run_refresh_metadata(
+    inputs: dict, processed_index: ProcessedIndex
+) -> pl.DataFrame | None:
+    """Re-cleans the metadata of the videos processed with other cleaning_rules, and patches their chunks in place.
+
+    The cleaned_columns are derived again from the archive records, so nothing is fetched, chunked or embedded.
+    Videos the rules now filter out, or gone from the archive, are left as they are."""
+    stale = processed_index.stale_metadata_video_ids()
+    if stale.is_empty():
+        return None
+    import ingest
+
+    df = helpers.to_pre_scraping_df(inputs["archive"]).filter(
+        pl.col("video_id").is_in(stale.implode())
+    )
+    metrics.record_dropped(
+        "refresh_metadata", {"not_in_archive": stale.len() - df.height}
+    )
+    df = df.select("video_id", *helpers.cleaned_columns)
+    summary = ingest.update_chunk_metadata(df)
+    processed_index.record_metadata_version(df["video_id"])
+    print(
+        f"refresh_metadata: {summary['chunks']} chunks of {summary['videos']} videos updated"
+    )
+    if summary["chunks"]:
+        print(
+            "The vector index is outdated, rebuild it with `python main.py vector-index`"
+        )
+    return df
+
+
+def run_scrape(inputs: dict, processed_index: ProcessedIndex) -> pl.DataFrame:
+    """Scrapes the mp4_url of every video, derives the mp3_url and vtt_url, and downloads the vtt.
+
+    Videos whose page or vtt could not be fetched are left out, and will be retried by the next run.
+    """
+    df = inputs["pre_scraping"]
+    mp4_urls = helpers.get_mp4_urls_from_video_urls(df["video_url"])
+    rows_in = df.height
+    df = df.join(
+        mp4_urls.filter(pl.col("error").is_null()).drop("error"), on="video_url"
+    ).with_columns(
+        pl.col("mp4_url").str.replace("mp4", "mp3").alias("mp3_url"),
+        pl.col("mp4_url").str.replace("mp4", "vtt").alias("vtt_url"),
+    )
+    vtts = helpers.get_vtts_from_vtt_urls(df["vtt_url"])
+    df = df.join(
+        vtts.filter(pl.col("error").is_null()).drop("error").unique("vtt_url"),
+        on="vtt_url",
+    )
+    metrics.record_dropped(
+        "scrape",
+        {
+            "video_page_error": rows_in - vtts.height,
+            "vtt_error": vtts["error"].drop_nulls().len(),
+        },
+    )
+    processed_index.record(df, "scraped")
+    return df
+
+
+def run_transcripts(inputs: dict, processed_index: ProcessedIndex) -> pl.DataFrame:
+    """Converts the vtt into the transcript and its cues, and validates the records."""
+    df = inputs["scrape"]
+    df = helpers.to_transcript_df(
+        df.with_columns(helpers.vtt_column_to_transcript(df["vtt"]).get_columns()),
+        processed_index,
+    )
+    if near_duplicate_action is not None:
+        df = near_duplicates.flag_near_duplicates(df, near_duplicates.get_index())
+    processed_index.record(df, "transcribed")
+    return df
+
+
+def run_chunks(inputs: dict, processed_index: ProcessedIndex) -> pl.DataFrame:
+    """Chunks the transcripts. Near-duplicates of earlier transcripts are skipped if near_duplicate_action is "skip"."""
+    df = inputs["transcripts"]
+    df_originals = df
+    if near_duplicate_action == "skip" and "duplicate_of" in df.columns:
+        df_originals = df.filter(pl.col("duplicate_of").is_null())
+        metrics.record_dropped(
+            "chunks", {"near_duplicate": df.height - df_originals.height}
+        )
+    df_chunks = helpers.to_chunk_df(df_originals)
+    processed_index.record(df, "chunked")
+    return df_chunks
+
+
+def run_ingest(inputs: dict, processed_index: ProcessedIndex) -> None:
+    """Upserts the chunks into the Chroma collection, with the metadata of their video from the transcripts.
+
+    The videos are only recorded as "ingested" once ingest_chunks returned, so a run that stops before, or skips the
+    ingestion, leaves them to the next run."""
+    import ingest
+
+    if inputs["chunks"].height:
+        ingest.ingest_chunks(
+            inputs["chunks"], df_videos=helpers.to_video_df(inputs["transcripts"])
+        )
+    # The near-duplicates skipped by run_chunks are done too, so they aren't scraped again by the next run
+    processed_index.record(inputs["transcripts"], "ingested")
+
+
+pipeline_stages = [
+    Stage("archive", [], run_archive),
+    Stage("pre_scraping", ["archive"], run_pre_scraping),
+    Stage("refresh_metadata", ["archive"], run_refresh_metadata),
+    Stage("scrape", ["pre_scraping"], run_scrape, batched=True),
+    Stage("transcripts", ["scrape"], run_transcripts, batched=True),
+    Stage("chunks", ["transcripts"], run_chunks, batched=True),
+    Stage(
+        "ingest",
+        ["chunks", "transcripts"],
+        run_ingest,
+        input_columns={"transcripts": helpers.video_columns},
+    ),
+]
+"""The stages of the pipeline, in order"""
+
+stages_by_name = {stage.name: stage for stage in pipeline_stages}
+
+
+class Checkpoints:
+    """The Parquet outputs of the stages, and a manifest of the completed stages.
+
+    A whole stage writes <stage>.parquet, a batched stage writes <stage>/part-<batch>.parquet per batch.
+    """
+
+    def __init__(self, directory: str = checkpoint_dir):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {"completed": {}, "finished": False}
+        self.manifest.setdefault("fingerprints", {})
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def is_completed(self, stage: str) -> bool:
+        return stage in self.manifest["completed"]
+
+    def mark_completed(self, stage: str):
+        self.manifest["completed"][stage] = time.time()
+        self.manifest["fingerprints"][stage] = stage_fingerprint(stage)
+        self._save_manifest()
+
+    def mark_finished(self, finished: bool = True):
+        self.manifest["finished"] = finished
+        self._save_manifest()
+
+    def part_path(self, stage: str, batch: int) -> str:
+        return os.path.join(self.directory, stage, f"part-{batch:05}.parquet")
+
+    def has_part(self, stage: str, batch: int) -> bool:
+        return os.path.exists(self.part_path(stage, batch))
+
+    def write(self, stage: str, df: pl.DataFrame | None, batch: int | None = None):
+        """Writes the output of a stage, or of one of its batches. Written to a temp file first, so a part is never half written."""
+        if df is None:
+            return
+        if batch is None:
+            path = os.path.join(self.directory, f"{stage}.parquet")
+        else:
+            path = self.part_path(stage, batch)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.write_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        if self.manifest["fingerprints"].get(stage) != stage_fingerprint(stage):
+            self.manifest["fingerprints"][stage] = stage_fingerprint(stage)
+            self._save_manifest()
+
+    def write_part(self, path: str, df: pl.DataFrame):
+        """Rewrites an existing part, e.g. to patch some of its columns."""
+        df.write_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def is_stale(self, stage: str) -> bool:
+        """True if the output of the stage was made with other values of its stage_config_dependencies."""
+        fingerprint = self.manifest["fingerprints"].get(stage)
+        return fingerprint is not None and fingerprint != stage_fingerprint(stage)
+
+    def read_part(self, stage: str, batch: int) -> pl.DataFrame:
+        return pl.read_parquet(self.part_path(stage, batch))
+
+    def read(self, stage: str, columns: list[str] | None = None) -> pl.DataFrame:
+        """Reads the whole output of a stage, or only its columns, concatenating the parts of a batched stage."""
+        if stages_by_name[stage].batched:
+            paths = sorted(glob.glob(os.path.join(self.directory, stage, "*.parquet")))
+            if not paths:
+                return pl.DataFrame()
+            return pl.concat(
+                [pl.read_parquet(path, columns=columns) for path in paths],
+                how="diagonal_relaxed",
+            )
+        return pl.read_parquet(
+            os.path.join(self.directory, f"{stage}.parquet"), columns=columns
+        )
+
+    def read_inputs(self, stage: Stage) -> dict[str, pl.DataFrame]:
+        """Reads the outputs of the inputs of a stage, with its input_columns."""
+        return {
+            input: self.read(input, (stage.input_columns or {}).get(input))
+            for input in stage.inputs
+        }
+
+    def clear(self, stage: str):
+        """Deletes the output of a stage and marks it as not completed."""
+        self.manifest["completed"].pop(stage, None)
+        self.manifest["fingerprints"].pop(stage, None)
+        self.manifest["finished"] = False
+        self._save_manifest()
+        shutil.rmtree(os.path.join(self.directory, stage), ignore_errors=True)
+        path = os.path.join(self.directory, f"{stage}.parquet")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def clear_all(self):
+        for stage in pipeline_stages:
+            self.clear(stage.name)
+
+
+def downstream_stages(name: str) -> list[str]:
+    """Returns the stages that depend, directly or not, on the stage."""
+    downstream = []
+    for stage in pipeline_stages:
+        if any(input in downstream or input == name for input in stage.inputs):
+            downstream.append(stage.name)
+    return downstream
+
+
+def patch_cleaned_columns(checkpoints: Checkpoints) -> bool:
+    """Cleans the archive records again, and patches the cleaned_columns of the pre_scraping output
+    and of the parts of the batched stages, instead of recomputing them.
+
+    Returns False, patching nothing, if the rules changed which videos are kept (e.g. disallowed_sections).
+    """
+    old = checkpoints.read("pre_scraping")
+    new = helpers.to_pre_scraping_df(checkpoints.read("archive")).filter(
+        pl.col("video_id").is_in(old["video_id"].implode())
+    )
+    if new.height != old.height:
+        return False
+    checkpoints.write("pre_scraping", new)
+    cleaned = new.select("video_id", *helpers.cleaned_columns)
+    for stage in pipeline_stages:
+        if not stage.batched:
+            continue
+        for path in glob.glob(
+            os.path.join(checkpoints.directory, stage.name, "*.parquet")
+        ):
+            part = pl.read_parquet(path)
+            if set(helpers.cleaned_columns) <= set(part.columns):
+                checkpoints.write_part(path, part.update(cleaned, on="video_id"))
+    return True
+
+
+def clear_stale_stages(checkpoints: Checkpoints):
+    """Clears the stages whose config changed since their output was made, and the stages downstream of them.
+
+    The other checkpoints are kept, so e.g. a new chunk_size re-chunks the transcripts without fetching them again.
+    When only the cleaning_rules changed, the cleaned columns are patched instead (see patch_cleaned_columns).
+    """
+    for stage in pipeline_stages:
+        if not checkpoints.is_stale(stage.name):
+            continue
+        if (
+            stage.name == "pre_scraping"
+            and checkpoints.is_completed("pre_scraping")
+            and patch_cleaned_columns(checkpoints)
+        ):
+            print("pre_scraping: cleaning rules changed, cleaned columns patched")
+            continue
+        cleared = [stage.name] + downstream_stages(stage.name)
+        print(f"{stage.name}: config changed, recomputing {', '.join(cleared)}")
+        for name in cleared:
+            checkpoints.clear(name)
+
+
+def get_batches(pre_scraping: pl.DataFrame) -> list[pl.DataFrame]:
+    """Splits the pre-scraping df into the batches flowing through the batched stages, in a stable order."""
+    pre_scraping = pre_scraping.sort("video_id")
+    return [
+        pre_scraping.slice(offset, pipeline_batch_size)
+        for offset in range(0, pre_scraping.height, pipeline_batch_size)
+    ]
+
+
+def run_batched_stages(
+    stages: list[Stage], checkpoints: Checkpoints, processed_index: ProcessedIndex
+):
+    """Runs a chain of batched stages, one thread per stage, connected by bounded queues.
+
+    A batch whose part already exists for a stage is read back instead of being recomputed.
+    """
+    batches = get_batches(checkpoints.read("pre_scraping"))
+    first_input = stages_by_name[stages[0].inputs[0]]
+    queues = [queue.Queue(maxsize=pipeline_queue_size) for _ in range(len(stages) + 1)]
+    errors = []
+    stop = threading.Event()
+
+    def put(q: queue.Queue, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run_stage(stage: Stage, inbox: queue.Queue, outbox: queue.Queue):
+        try:
+            while not stop.is_set():
+                try:
+                    item = inbox.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                batch, df = item
+                if checkpoints.has_part(stage.name, batch):
+                    output = checkpoints.read_part(stage.name, batch)
+                else:
+                    output = stage.run({stage.inputs[0]: df}, processed_index)
+                    checkpoints.write(stage.name, output, batch)
+                print(f"{stage.name}: batch {batch + 1}/{len(batches)} done")
+                put(outbox, (batch, output))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        put(outbox, None)
+
+    threads = [
+        threading.Thread(
+            target=run_stage, args=(stage, queues[i], queues[i + 1]), daemon=True
+        )
+        for i, stage in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+    for batch, df in enumerate(batches):
+        if first_input.batched:
+            df = checkpoints.read_part(first_input.name, batch)
+        put(queues[0], (batch, df))
+    put(queues[0], None)
+    # Drain the last queue, its outputs are already checkpointed
+    while not stop.is_set():
+        try:
+            if queues[-1].get(timeout=0.1) is None:
+                break
+        except queue.Empty:
+            pass
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def run_pipeline(
+    checkpoints: Checkpoints, processed_index: ProcessedIndex, skip_ingest: bool = False
+):
+    """Runs every stage that isn't completed yet. Completed stages are skipped, and their checkpoints used as inputs."""
+    clear_stale_stages(checkpoints)
+    stages = [
+        stage
+        for stage in pipeline_stages
+        if not (skip_ingest and stage.name in ["refresh_metadata", "ingest"])
+    ]
+    i = 0
+    while i < len(stages):
+        stage = stages[i]
+        if stage.batched:
+            # Consecutive batched stages run together, pipelined
+            group = []
+            while i < len(stages) and stages[i].batched:
+                group.append(stages[i])
+                i += 1
+            pending = [s for s in group if not checkpoints.is_completed(s.name)]
+            if pending:
+                # One chunking pool for every batch, owned by the run instead of living until the process exits
+                with (
+                    helpers.chunking_pool()
+                    if "chunks" in [s.name for s in pending]
+                    else contextlib.nullcontext()
+                ):
+                    run_batched_stages(pending, checkpoints, processed_index)
+                for pending_stage in pending:
+                    checkpoints.mark_completed(pending_stage.name)
+            continue
+        i += 1
+        if checkpoints.is_completed(stage.name):
+            print(f"{stage.name}: already completed")
+            continue
+        print(f"{stage.name}: running")
+        inputs = checkpoints.read_inputs(stage)
+        checkpoints.write(stage.name, stage.run(inputs, processed_index))
+        checkpoints.mark_completed(stage.name)
+    if not skip_ingest:
+        checkpoints.mark_finished()
+
+
+def run_single_stage(
+    name: str, checkpoints: Checkpoints, processed_index: ProcessedIndex
+):
+    """Re-runs one stage from the checkpoints of its inputs.
+
+    The stages downstream of it are cleared, so the next resume recomputes them from the new output.
+    """
+    stage = stages_by_name[name]
+    for input in stage.inputs:
+        if not checkpoints.is_completed(input):
+            raise RuntimeError(f"{name} needs the {input} stage to be completed first")
+    for downstream in downstream_stages(name):
+        checkpoints.clear(downstream)
+    checkpoints.clear(name)
+    if stage.batched:
+        run_batched_stages([stage], checkpoints, processed_index)
+    else:
+        inputs = checkpoints.read_inputs(stage)
+        checkpoints.write(name, stage.run(inputs, processed_index))
+    checkpoints.mark_completed(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Runs the pipeline")
+    run_parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="Discards the checkpoints of the unfinished run",
+    )
+    resume_parser = subparsers.add_parser("resume", help="Resumes the last run")
+    for subparser in [run_parser, resume_parser]:
+        subparser.add_argument(
+            "--skip-ingest", action="store_true", help="Stops after the chunks stage"
+        )
+    stage_parser = subparsers.add_parser("stage", help="Re-runs a single stage")
+    stage_parser.add_argument("name", choices=list(stages_by_name))
+    subparsers.add_parser("status", help="Prints the state of the checkpoints")
+    stream_parser = subparsers.add_parser(
+        "stream-transcripts",
+        help="Converts scraped records in Parquet files into a partitioned transcript dataset, out of core",
+    )
+    stream_parser.add_argument(
+        "source", help="Parquet file(s) with a vtt column, globs allowed"
+    )
+    stream_parser.add_argument("output", nargs="?", default=stream_output_dir)
+    stream_parser.add_argument(
+        "--partition-by", choices=["section", "video_id"], default=stream_partition_by
+    )
+    stream_parser.add_argument(
+        "--memory-budget", type=int, default=stream_memory_budget, help="In bytes"
+    )
+    vector_index_parser = subparsers.add_parser(
+        "vector-index", help="Builds the vector index of the chunk collection"
+    )
+    vector_index_parser.add_argument(
+        "--quantize",
+        action="store_true",
+        default=vector_index_quantize,
+        help="Stores the embeddings as int8",
+    )
+    keyword_index_parser = subparsers.add_parser(
+        "keyword-index", help="Backfills the keyword index from the chunk collection"
+    )
+    keyword_index_parser.add_argument(
+        "--compact", action="store_true", help="Merges the index into one segment"
+    )
+    embedding_cache_parser = subparsers.add_parser(
+        "embedding-cache",
+        help="Evicts the least recently used embeddings beyond --max-rows",
+    )
+    embedding_cache_parser.add_argument(
+        "--max-rows", type=int, default=embedding_cache_max_rows
+    )
+    embedding_cache_parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="First drops the embeddings of the chunks that aren't in the chunk collection anymore",
+    )
+    search_parser = subparsers.add_parser("search", help="Searches the chunks")
+    search_parser.add_argument("query")
+    search_parser.add_argument("-k", type=int, default=10)
+    search_parser.add_argument(
+        "--mode", choices=search.search_modes, default=search_mode
+    )
+    for column in vector_index_filter_columns:
+        search_parser.add_argument(
+            f"--{column}", action="append", help="Repeat to allow several values"
+        )
+    args = parser.parse_args()
+
+    if args.command == "vector-index":
+        import vector_index
+
+        print(f"Built {vector_index.build_vector_index(quantize=args.quantize)}")
+        query_cache.bump_collection_version()
+        return
+    if args.command == "keyword-index":
+        import keyword_index
+
+        index = keyword_index.build_keyword_index()
+        if args.compact:
+            index.compact()
+        query_cache.bump_collection_version()
+        print(f"{len(index)} chunks in the keyword index")
+        return
+    if args.command == "embedding-cache":
+        import ingest
+        from embedding_cache import EmbeddingCache
+
+        cache = EmbeddingCache()
+        if args.compact:
+            print(
+                f"{ingest.compact_embedding_cache(embedding_cache=cache)} unused embeddings dropped"
+            )
+        print(f"{cache.evict(args.max_rows)} embeddings evicted")
+        return
+    if args.command == "search":
+        filters = {
+            column: getattr(args, column)
+            for column in vector_index_filter_columns
+            if getattr(args, column)
+        }
+        results = search.SearchEngine().search(args.query, args.k, filters, args.mode)
+        with pl.Config(fmt_str_lengths=80, tbl_rows=args.k):
+            print(
+                results.select(
+                    "score", "preacher", "title", "start_seconds", "video_url", "chunk"
+                )
+            )
+        return
+
+    if args.command == "stream-transcripts":
+        import streaming
+
+        try:
+            print(
+                streaming.stream_transcripts(
+                    args.source, args.output, args.partition_by, args.memory_budget
+                )
+            )
+        finally:
+            metrics.write_report()
+        return
+
+    checkpoints = Checkpoints()
+    processed_index = ProcessedIndex()
+
+    if args.command in ["run", "resume", "stage"]:
+        try:
+            if args.command == "run":
+                if args.fresh or checkpoints.manifest["finished"]:
+                    checkpoints.clear_all()
+                run_pipeline(checkpoints, processed_index, args.skip_ingest)
+            elif checkpoints.manifest["finished"] and args.command == "resume":
+                print("The last run finished, there is nothing to resume")
+            elif args.command == "resume":
+                run_pipeline(checkpoints, processed_index, args.skip_ingest)
+            else:
+                run_single_stage(args.name, checkpoints, processed_index)
+        finally:
+            # Also written when a stage fails, since that is when the report is needed most
+            metrics.write_report()
+            print(f"Run report saved to {metrics_report_path}")
+    elif args.command == "status":
+        for stage in pipeline_stages:
+            completed_at = checkpoints.manifest["completed"].get(stage.name)
+            state = time.ctime(completed_at) if completed_at else "not completed"
+            if checkpoints.is_stale(stage.name):
+                state += " (config changed, will be recomputed)"
+            print(f"{stage.name}: {state}")
+        print(f"finished: {checkpoints.manifest['finished']}")
+        print(
+            f"videos with outdated metadata: {processed_index.stale_metadata_video_ids().len()}, "
+            f"ingested with other chunk parameters: {processed_index.stale_chunk_video_ids().len()}, "
+            f"chunked but not ingested: {processed_index.video_ids('chunked').len() - processed_index.video_ids('ingested').len()}"
+        )
+
+
+if __name__ == "__main__":
+    main()
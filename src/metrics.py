@@ -0,0 +1,380 @@
+"""## This file contains the instrumentation of the pipeline
+
+Every stage decorated with @instrument records its wall time, CPU time, peak RSS and rows in and out,
+fetching.fetch records the latency and status of every request, and the chunker records the tokenizer throughput.
+write_report() saves it all as a JSON run report and as a Prometheus text file (e.g. for the node_exporter textfile collector).
+
+Recording only takes a lock and a few additions, and the RSS is sampled by one background thread every
+metrics_sample_interval seconds while a stage runs, so it can stay on in production."""
+
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+import psutil
+
+from config import *
+
+
+class Histogram:
+    """A Prometheus style histogram, counting the observations falling in each bucket."""
+
+    def __init__(self, buckets: list[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list[tuple[str, int]]:
+        """Returns the (le, count of observations <= le) pairs, ending with +Inf."""
+        pairs = []
+        total = 0
+        for bucket, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            pairs.append(("+Inf" if bucket == float("inf") else repr(bucket), total))
+        return pairs
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": dict(self.cumulative_counts()),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class _StageRun:
+    """The measurements of one running call of a stage."""
+
+    def __init__(self, process: psutil.Process):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = _cpu_seconds(process)
+        self.peak_rss = rss_bytes(process)
+
+
+def rss_bytes(process: psutil.Process | None = None) -> int:
+    """The RSS of the process (this one by default) and its children (e.g. the chunking and VTT workers)."""
+    process = process or psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def _cpu_seconds(process: psutil.Process) -> float:
+    """The user + system CPU time of the process and its children."""
+    times = process.cpu_times()
+    seconds = times.user + times.system
+    for child in process.children(recursive=True):
+        try:
+            child_times = child.cpu_times()
+            seconds += child_times.user + child_times.system
+        except psutil.Error:
+            pass
+    return seconds
+
+
+def _escape_label(value) -> str:
+    """Escapes a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """The measurements of one pipeline run.
+
+    - stages: name -> calls, wall_seconds, cpu_seconds, peak_rss_bytes, rows_in, rows_out.
+    - dropped_rows: stage -> filter -> number of rows it removed.
+    - http: host -> latency Histogram and status -> count. Exceptions are counted under their class name.
+    - tokenizer: texts, tokens, characters and seconds spent encoding.
+
+    CPU time and RSS are those of the whole process, so stages running concurrently overlap.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = {}
+        self.dropped_rows = {}
+        self.http_latency = {}
+        self.http_status = {}
+        self.tokenizer = {"texts": 0, "tokens": 0, "characters": 0, "seconds": 0.0}
+        self._lock = threading.Lock()
+        self._process = psutil.Process()
+        self._running = set()
+        self._sampler = None
+        self._wake = threading.Event()
+
+    def _sample_rss(self):
+        """Background thread updating the peak RSS of the running stages."""
+        while True:
+            self._wake.wait()
+            try:
+                rss = rss_bytes(self._process)
+            except psutil.Error:
+                rss = 0
+            with self._lock:
+                for run in self._running:
+                    run.peak_rss = max(run.peak_rss, rss)
+                if not self._running:
+                    self._wake.clear()
+            time.sleep(metrics_sample_interval)
+
+    def start_stage(self) -> _StageRun:
+        run = _StageRun(self._process)
+        with self._lock:
+            self._running.add(run)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+                self._sampler.start()
+        self._wake.set()
+        return run
+
+    def end_stage(
+        self, name: str, run: _StageRun, rows_in: int | None, rows_out: int | None
+    ):
+        wall_seconds = time.perf_counter() - run.start_wall
+        cpu_seconds = _cpu_seconds(self._process) - run.start_cpu
+        peak_rss = max(run.peak_rss, rss_bytes(self._process))
+        with self._lock:
+            self._running.discard(run)
+            stage = self.stages.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "peak_rss_bytes": 0,
+                    "rows_in": 0,
+                    "rows_out": 0,
+                },
+            )
+            stage["calls"] += 1
+            stage["wall_seconds"] += wall_seconds
+            stage["cpu_seconds"] += cpu_seconds
+            stage["peak_rss_bytes"] = max(stage["peak_rss_bytes"], peak_rss)
+            stage["rows_in"] += rows_in or 0
+            stage["rows_out"] += rows_out or 0
+
+    def record_dropped(self, stage: str, dropped: dict[str, int]):
+        """Adds the number of rows removed by each filter of the stage."""
+        with self._lock:
+            counts = self.dropped_rows.setdefault(stage, {})
+            for name, count in dropped.items():
+                counts[name] = counts.get(name, 0) + count
+
+    def record_request(self, host: str, status: int | str, seconds: float):
+        """Records one HTTP request attempt. status is the status code, or the exception class name."""
+        with self._lock:
+            if host not in self.http_latency:
+                self.http_latency[host] = Histogram(metrics_latency_buckets)
+                self.http_status[host] = {}
+            self.http_latency[host].observe(seconds)
+            self.http_status[host][str(status)] = (
+                self.http_status[host].get(str(status), 0) + 1
+            )
+
+    def record_tokenizer(
+        self, texts: int, tokens: int, characters: int, seconds: float
+    ):
+        with self._lock:
+            self.tokenizer["texts"] += texts
+            self.tokenizer["tokens"] += tokens
+            self.tokenizer["characters"] += characters
+            self.tokenizer["seconds"] += seconds
+
+    def to_dict(self) -> dict:
+        """Returns the JSON run report."""
+        with self._lock:
+            tokenizer = dict(self.tokenizer)
+            tokenizer["tokens_per_second"] = (
+                tokenizer["tokens"] / tokenizer["seconds"]
+                if tokenizer["seconds"]
+                else None
+            )
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": time.time() - self.started_at,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "dropped_rows": {
+                    name: dict(counts) for name, counts in self.dropped_rows.items()
+                },
+                "http": {
+                    host: {
+                        "latency_seconds": histogram.to_dict(),
+                        "status": dict(self.http_status[host]),
+                    }
+                    for host, histogram in self.http_latency.items()
+                },
+                "tokenizer": tokenizer,
+            }
+
+    def to_prometheus(self, prefix: str = "atp_pipeline") -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        report = self.to_dict()
+        lines = []
+
+        def metric(name: str, kind: str, help: str, samples: list[tuple[dict, float]]):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{_escape_label(label)}"' for key, label in labels.items()
+                )
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{prefix}_{name}{suffix} {value}")
+
+        stages = report["stages"]
+        for field, kind, help in [
+            ("calls", "counter", "Number of calls of the stage"),
+            ("wall_seconds", "counter", "Wall time spent in the stage"),
+            ("cpu_seconds", "counter", "CPU time of the process during the stage"),
+            ("peak_rss_bytes", "gauge", "Peak RSS of the process during the stage"),
+            ("rows_in", "counter", "Rows given to the stage"),
+            ("rows_out", "counter", "Rows returned by the stage"),
+        ]:
+            metric(
+                f"stage_{field}",
+                kind,
+                help,
+                [({"stage": name}, stage[field]) for name, stage in stages.items()],
+            )
+        metric(
+            "dropped_rows",
+            "counter",
+            "Rows removed by each filter of a stage",
+            [
+                ({"stage": stage, "filter": name}, count)
+                for stage, counts in report["dropped_rows"].items()
+                for name, count in counts.items()
+            ],
+        )
+
+        name = f"{prefix}_http_request_seconds"
+        lines.append(f"# HELP {name} Latency of the HTTP request attempts")
+        lines.append(f"# TYPE {name} histogram")
+        for host, histogram in self.http_latency.items():
+            for le, count in histogram.cumulative_counts():
+                lines.append(
+                    f'{name}_bucket{{host="{_escape_label(host)}",le="{le}"}} {count}'
+                )
+            lines.append(f'{name}_sum{{host="{_escape_label(host)}"}} {histogram.sum}')
+            lines.append(
+                f'{name}_count{{host="{_escape_label(host)}"}} {histogram.count}'
+            )
+        metric(
+            "http_requests",
+            "counter",
+            "HTTP request attempts by status code, or exception class name",
+            [
+                ({"host": host, "status": status}, count)
+                for host, http in report["http"].items()
+                for status, count in http["status"].items()
+            ],
+        )
+
+        for field in ["texts", "tokens", "characters", "seconds"]:
+            metric(
+                f"tokenizer_{field}",
+                "counter",
+                f"Tokenizer {field} of the chunker",
+                [({}, report["tokenizer"][field])],
+            )
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Returns the metrics of the current run."""
+    return _metrics
+
+
+def reset() -> Metrics:
+    """Starts the metrics of a new run."""
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def count_rows(value) -> int | None:
+    """The number of rows of a df, series or list. None for lazy frames and other values."""
+    if hasattr(value, "height"):
+        return value.height
+    if hasattr(value, "len") and callable(value.len):
+        return value.len()
+    if isinstance(value, (list, tuple)):
+        return len(value)
+    return None
+
+
+def instrument(name: str):
+    """Decorator recording the wall time, CPU time, peak RSS and rows in and out of every call of a stage.
+
+    Rows in are counted from the first argument, rows out from the return value (see count_rows).
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled:
+                return function(*args, **kwargs)
+            metrics = _metrics
+            run = metrics.start_stage()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                metrics.end_stage(
+                    name,
+                    run,
+                    count_rows(args[0]) if args else None,
+                    count_rows(result),
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def record_dropped(stage: str, dropped: dict[str, int]):
+    if metrics_enabled:
+        _metrics.record_dropped(stage, dropped)
+
+
+def record_request(host: str, status: int | str, seconds: float):
+    if metrics_enabled:
+        _metrics.record_request(host, status, seconds)
+
+
+def record_tokenizer(texts: int, tokens: int, characters: int, seconds: float):
+    if metrics_enabled:
+        _metrics.record_tokenizer(texts, tokens, characters, seconds)
+
+
+def write_report(
+    report_path: str = metrics_report_path,
+    prometheus_path: str = metrics_prometheus_path,
+):
+    """Writes the JSON run report and the Prometheus text file of the current run.
+
+    The Prometheus file is written to a temporary file first, so a scraper never reads a partial file.
+    """
+    for path, content in [
+        (report_path, json.dumps(_metrics.to_dict(), indent=2)),
+        (prometheus_path, _metrics.to_prometheus()),
+    ]:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,285 @@
+"""## This file contains the near-duplicate detection of transcripts
+
+The archive re-posts the same sermon as clips, in conference sections and as re-uploads, with slightly different
+captions, so their transcript_hash differ. Every transcript gets a MinHash signature of its word shingles, and an
+LSH banding index persisted in sqlite finds the earlier transcripts that share a band with it, so a new transcript
+is only compared with a few candidates instead of every transcript seen so far."""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+import polars as pl
+
+from config import *
+
+_word_pattern = re.compile(r"\w+")
+
+
+def _permutations(num_perm: int, seed: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """The (a, b) coefficients of the num_perm multiply-shift hash functions ((a * x + b) mod 2**64) >> 32.
+
+    They need no modulo by a prime, the uint64 arithmetic of numpy wrapping around on its own.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(
+        1
+    )
+    b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingle_hashes(text: str, shingle_size: int = minhash_shingle_size) -> np.ndarray:
+    """Returns the distinct 32 bit hashes of the shingles (runs of shingle_size words) of the text.
+
+    Words are hashed with crc32, which is stable across processes, and combined with a polynomial rolling hash.
+    """
+    words = _word_pattern.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    vocabulary = {word: zlib.crc32(word.encode()) for word in set(words)}
+    word_hashes = np.fromiter(
+        (vocabulary[word] for word in words), dtype=np.uint64, count=len(words)
+    )
+    size = min(shingle_size, len(words))
+    hashes = np.zeros(len(words) - size + 1, dtype=np.uint64)
+    for i in range(size):
+        hashes = (
+            hashes * np.uint64(1_000_003) + word_hashes[i : i + len(hashes)]
+        ) & np.uint64(0xFFFFFFFF)
+    return np.unique(hashes)
+
+
+def minhash_signature(
+    text: str,
+    num_perm: int = minhash_num_perm,
+    shingle_size: int = minhash_shingle_size,
+) -> np.ndarray:
+    """Returns the MinHash signature of the text, num_perm uint32. Two signatures agree on a share of their values
+    that estimates the Jaccard similarity of the shingles of the two texts."""
+    a, b = _permutations(num_perm)
+    signature = np.full(num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+    hashes = shingle_hashes(text, shingle_size)
+    # In blocks, so a long transcript doesn't allocate a shingles * num_perm matrix at once
+    for i in range(0, len(hashes), 4096):
+        block = hashes[i : i + 4096, None]
+        block_min = ((block * a + b) >> np.uint64(32)).min(axis=0)
+        signature = np.minimum(signature, block_min.astype(np.uint32))
+    return signature
+
+
+def minhash_column(
+    transcripts: pl.Series,
+    num_perm: int = minhash_num_perm,
+    shingle_size: int = minhash_shingle_size,
+) -> pl.Series:
+    """Returns the "minhash" column of a transcript column, as an Array of num_perm UInt32."""
+    return pl.Series(
+        "minhash",
+        (
+            np.stack(
+                [
+                    minhash_signature(text or "", num_perm, shingle_size)
+                    for text in transcripts
+                ]
+            )
+            if transcripts.len()
+            else np.empty((0, num_perm), dtype=np.uint32)
+        ),
+        dtype=pl.Array(pl.UInt32, num_perm),
+    )
+
+
+def lsh_bands(
+    threshold: float, num_perm: int = minhash_num_perm, min_recall: float = 0.95
+) -> tuple[int, int]:
+    """Returns the (bands, rows per band) of the LSH index.
+
+    Two transcripts with Jaccard similarity s become candidates with probability 1 - (1 - s**rows)**bands.
+    The most rows (so the fewest false candidates) keeping that probability >= min_recall at the threshold is chosen.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold**rows) ** bands >= min_recall:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateIndex:
+    """The LSH index of every transcript checked so far, in sqlite.
+
+    - signatures: video_id -> MinHash signature, group_id (the video_id of the first transcript of its group)
+      and similarity (the estimated Jaccard similarity to the transcript it matched, null for originals).
+    - buckets: bucket -> video_id, one row per band of every signature.
+
+    The index is rebuilt from scratch if num_perm, shingle_size or the banding change, since old signatures
+    can't be compared with new ones."""
+
+    def __init__(
+        self,
+        path: str = near_duplicate_db_path,
+        threshold: float = near_duplicate_threshold,
+        num_perm: int = minhash_num_perm,
+        shingle_size: int = minhash_shingle_size,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        params = f"{num_perm}:{shingle_size}:{self.bands}:{self.rows}"
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (params TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS signatures (
+                video_id INTEGER PRIMARY KEY,
+                signature BLOB NOT NULL,
+                group_id INTEGER NOT NULL,
+                similarity REAL
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                bucket INTEGER NOT NULL,
+                video_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (bucket);
+            """)
+        row = self._db.execute("SELECT params FROM meta").fetchone()
+        if row is None or row[0] != params:
+            with self._db:
+                self._db.execute("DELETE FROM meta")
+                self._db.execute("DELETE FROM signatures")
+                self._db.execute("DELETE FROM buckets")
+                self._db.execute("INSERT INTO meta (params) VALUES (?)", (params,))
+
+    def _buckets(self, signature: np.ndarray) -> list[int]:
+        """Returns the bucket of every band of the signature. The band number is hashed too, so buckets never collide across bands."""
+        return [
+            int.from_bytes(
+                hashlib.blake2b(
+                    signature[band * self.rows : (band + 1) * self.rows].tobytes(),
+                    digest_size=8,
+                    salt=band.to_bytes(8, "little"),
+                ).digest(),
+                "little",
+                signed=True,
+            )
+            for band in range(self.bands)
+        ]
+
+    def _candidates(self, buckets: list[int]) -> list[tuple[int, bytes, int]]:
+        """Returns the (video_id, signature, group_id) of the indexed transcripts sharing a bucket."""
+        return self._db.execute(
+            f"""
+            SELECT video_id, signature, group_id FROM signatures WHERE video_id IN (
+                SELECT video_id FROM buckets WHERE bucket IN ({', '.join('?' * len(buckets))})
+            )
+            """,
+            buckets,
+        ).fetchall()
+
+    def add(
+        self, video_ids: list[int], signatures: np.ndarray
+    ) -> list[tuple[int, float | None]]:
+        """Checks the signatures against the index in order, then adds them to it.
+
+        Returns the (group_id, similarity) of every video_id. group_id is the video_id itself and similarity None
+        when no indexed transcript reaches the threshold. A video_id that is already indexed keeps its group,
+        so re-running a batch gives the same result."""
+        results = []
+        with self._lock, self._db:
+            for video_id, signature in zip(video_ids, signatures):
+                signature = np.ascontiguousarray(signature, dtype=np.uint32)
+                known = self._db.execute(
+                    "SELECT group_id, similarity FROM signatures WHERE video_id = ?",
+                    (video_id,),
+                ).fetchone()
+                if known is not None:
+                    results.append(known)
+                    continue
+                buckets = self._buckets(signature)
+                group_id, similarity = video_id, None
+                for candidate_id, candidate, candidate_group_id in self._candidates(
+                    buckets
+                ):
+                    candidate_similarity = float(
+                        np.mean(np.frombuffer(candidate, dtype=np.uint32) == signature)
+                    )
+                    if candidate_similarity >= self.threshold and (
+                        similarity is None or candidate_similarity > similarity
+                    ):
+                        group_id, similarity = candidate_group_id, candidate_similarity
+                self._db.execute(
+                    "INSERT INTO signatures (video_id, signature, group_id, similarity) VALUES (?, ?, ?, ?)",
+                    (video_id, signature.tobytes(), group_id, similarity),
+                )
+                self._db.executemany(
+                    "INSERT INTO buckets (bucket, video_id) VALUES (?, ?)",
+                    [(bucket, video_id) for bucket in buckets],
+                )
+                results.append((group_id, similarity))
+        return results
+
+    def groups(self) -> pl.DataFrame:
+        """Returns the ["video_id", "group_id", "similarity"] of every transcript that has near-duplicates."""
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT video_id, group_id, similarity FROM signatures
+                WHERE group_id IN (SELECT group_id FROM signatures WHERE group_id != video_id)
+                ORDER BY group_id, video_id
+                """).fetchall()
+        return pl.DataFrame(
+            rows,
+            schema={
+                "video_id": pl.Int64,
+                "group_id": pl.Int64,
+                "similarity": pl.Float64,
+            },
+            orient="row",
+        )
+
+    def close(self):
+        self._db.close()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> NearDuplicateIndex:
+    """Returns the shared near-duplicate index, opening it on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = NearDuplicateIndex()
+    return _index
+
+
+def flag_near_duplicates(df: pl.DataFrame, index: NearDuplicateIndex) -> pl.DataFrame:
+    """Adds to a transcript df:
+
+    - minhash: Array[UInt32] - The MinHash signature of the transcript.
+    - duplicate_of: int - The video_id of the first transcript of its near-duplicate group. Null for originals.
+    - duplicate_similarity: float - The estimated Jaccard similarity to the transcript it matched. Null for originals.
+
+    The transcripts are added to the index, so later batches are checked against them.
+    """
+    df = df.with_columns(
+        minhash_column(df["transcript"], index.num_perm, index.shingle_size)
+    )
+    results = index.add(df["video_id"].to_list(), df["minhash"].to_numpy())
+    group_ids = pl.Series([group_id for group_id, _ in results], dtype=pl.Int64)
+    return df.with_columns(
+        pl.when(group_ids != pl.col("video_id")).then(group_ids).alias("duplicate_of"),
+        pl.Series(
+            "duplicate_similarity",
+            [similarity for _, similarity in results],
+            dtype=pl.Float64,
+        ),
+    )
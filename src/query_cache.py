@@ -0,0 +1,192 @@
+"""## This file contains the query cache of the search app
+
+Popular queries, and the preacher filtered variants of the same query, come back again and again,
+so CachedSearchEngine keeps in memory:
+
+- the query embeddings, keyed by normalized query text, so the encoder runs once per distinct query.
+- the results, keyed by (mode, normalized query, k, filters), in an LRU bounded by query_cache_max_entries
+  and query_cache_ttl.
+
+The results are only valid for the chunks they were computed on, so they are tagged with the collection version,
+a counter in collection_version_path that the ingestion bumps whenever chunks land. When it changes, the indexes,
+opened before the change, are reopened or reloaded and the results are dropped.
+Results of a search during which the version changed aren't cached.
+The embeddings don't depend on the chunks and are kept."""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import polars as pl
+
+from config import *
+from embedding_cache import normalize_text
+from search import SearchEngine
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes the query before caching it, so case and whitespace differences hit the same entry."""
+    return normalize_text(query).lower()
+
+
+def collection_version(path: str = collection_version_path) -> int:
+    """Returns the version of the chunk collection, 0 if it was never bumped."""
+    try:
+        with open(path, "r") as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_collection_version(path: str = collection_version_path) -> int:
+    """Increments the version of the chunk collection, invalidating the cached results. Returns the new version."""
+    version = collection_version(path) + 1
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(version))
+    os.replace(tmp_path, path)
+    return version
+
+
+class LRUCache:
+    """A thread safe LRU of at most max_entries, whose entries expire ttl seconds after they are put (never if None)."""
+
+    def __init__(self, max_entries: int, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value of key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _filters_key(filters: dict | None) -> tuple:
+    """A hashable key of the filters, independent of their order, e.g. {"preacher": ["b", "a"]} -> (("preacher", ("a", "b")),)."""
+    return tuple(
+        sorted(
+            (column, tuple(sorted([values] if isinstance(values, str) else values)))
+            for column, values in (filters or {}).items()
+        )
+    )
+
+
+class CachedSearchEngine(SearchEngine):
+    """A SearchEngine caching the query embeddings and the results.
+
+    search() returns the cached DataFrame itself on a hit, polars DataFrames being immutable.
+    stats() returns the hit rates and the latency of the hits and misses.
+    """
+
+    def __init__(
+        self,
+        vector_index=None,
+        keyword_index=None,
+        embedding_function=None,
+        candidates: int = hybrid_candidates,
+        max_entries: int = query_cache_max_entries,
+        ttl: float | None = query_cache_ttl,
+        max_embeddings: int = query_cache_max_embeddings,
+        version_path: str = collection_version_path,
+    ):
+        super().__init__(vector_index, keyword_index, embedding_function, candidates)
+        self.results = LRUCache(max_entries, ttl)
+        self.embeddings = LRUCache(max_embeddings)
+        self.version_path = version_path
+        self.version = collection_version(version_path)
+        self._latencies = {
+            "hit": deque(maxlen=query_cache_latency_window),
+            "miss": deque(maxlen=query_cache_latency_window),
+        }
+
+    def embed(self, query: str) -> np.ndarray:
+        key = normalize_query(query)
+        embedding = self.embeddings.get(key)
+        if embedding is None:
+            embedding = super().embed(key)
+            self.embeddings.put(key, embedding)
+        return embedding
+
+    def _check_version(self):
+        """If the collection changed since the results were computed, refreshes the indexes (see SearchEngine.refresh)
+        and drops the cached results."""
+        version = collection_version(self.version_path)
+        if version != self.version:
+            self.refresh()
+            self.results.clear()
+            self.version = version
+
+    def search(
+        self,
+        query: str,
+        k: int = 10,
+        filters: dict | None = None,
+        mode: str = search_mode,
+    ) -> pl.DataFrame:
+        start = time.perf_counter()
+        self._check_version()
+        key = (mode, normalize_query(query), k, _filters_key(filters))
+        results = self.results.get(key)
+        outcome = "hit"
+        if results is None:
+            outcome = "miss"
+            version = self.version
+            results = super().search(query, k, filters, mode)
+            # Chunks that landed during the search may or may not be in the results, so they aren't cached
+            if collection_version(self.version_path) == version:
+                self.results.put(key, results)
+        self._latencies[outcome].append(time.perf_counter() - start)
+        return results
+
+    def stats(self) -> dict:
+        """Returns the hit rates of the result and embedding caches, their sizes and the p50/p95 latency in
+        milliseconds of the last query_cache_latency_window hits and misses."""
+        stats = {
+            "version": self.version,
+            "results": len(self.results),
+            "result_hit_rate": self.results.hit_rate(),
+            "embeddings": len(self.embeddings),
+            "embedding_hit_rate": self.embeddings.hit_rate(),
+        }
+        for outcome, latencies in self._latencies.items():
+            for percentile in [50, 95]:
+                stats[f"{outcome}_p{percentile}_ms"] = (
+                    1000 * float(np.percentile(latencies, percentile))
+                    if latencies
+                    else None
+                )
+        return stats
@@ -0,0 +1,151 @@
+"""## This file contains the search of the chunks, for the search app
+
+- vector: by meaning, the cosine similarity of the query embedding in the vector index (see vector_index.py).
+- keyword: by words, the BM25 score of the query in the keyword index (see keyword_index.py).
+- hybrid: both, merged by reciprocal rank fusion, so a chunk ranked well by either one comes up.
+
+The metadata of the results (and the filters on it) come from the vector index rows."""
+
+import numpy as np
+import polars as pl
+
+from config import *
+
+search_modes = ["vector", "keyword", "hybrid"]
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[str]], k: int = hybrid_rrf_k
+) -> list[tuple[str, float]]:
+    """Merges rankings of chunk_ids into one, scoring every chunk_id with the sum of 1 / (k + rank) over the rankings.
+
+    Only ranks are used, so BM25 and cosine scores don't need to be on the same scale.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class SearchEngine:
+    """Searches the vector and keyword indexes. They are opened on first use, unless given.
+
+    search(query, k, filters, mode) returns the result_columns of vector_index and the "score" of the top k chunks.
+    """
+
+    def __init__(
+        self,
+        vector_index=None,
+        keyword_index=None,
+        embedding_function=None,
+        candidates: int = hybrid_candidates,
+    ):
+        self._vector_index = vector_index
+        self._keyword_index = keyword_index
+        self._embedding_function = embedding_function
+        self.candidates = candidates
+        self._row_doc_ids = None
+
+    @property
+    def vector_index(self):
+        if self._vector_index is None:
+            import vector_index
+
+            self._vector_index = vector_index.VectorIndex()
+        return self._vector_index
+
+    @property
+    def keyword_index(self):
+        if self._keyword_index is None:
+            import keyword_index
+
+            self._keyword_index = keyword_index.BM25Index()
+        return self._keyword_index
+
+    def refresh(self):
+        """Reopens the vector index if it was rebuilt, and reloads the keyword index if another handle changed it.
+
+        Indexes that weren't opened yet are left to be opened on first use."""
+        if self._vector_index is not None and self._vector_index.is_outdated():
+            self._vector_index = self._vector_index.reopen()
+        if self._keyword_index is not None:
+            self._keyword_index.refresh()
+
+    def embed(self, query: str) -> np.ndarray:
+        """Returns the embedding of the query, with the embedding function of the ingestion by default."""
+        if self._embedding_function is None:
+            import ingest
+
+            self._embedding_function = ingest.get_embedding_function()
+        return np.asarray(self._embedding_function([query]), dtype=np.float32)[0]
+
+    def vector_search(
+        self, query: str, k: int = 10, filters: dict | None = None
+    ) -> pl.DataFrame:
+        return self.vector_index.search(self.embed(query), k, filters)[0]
+
+    def row_doc_ids(self) -> np.ndarray:
+        """Returns the keyword index doc_id of every vector index row (-1 if it isn't indexed), so the rows matched by
+        VectorIndex.filter_rows map to docs by indexing. Computed again when either index changed.
+        """
+        self.keyword_index.refresh()
+        key = (self.vector_index, self.keyword_index, self.keyword_index.generation)
+        cached = self._row_doc_ids
+        if cached is None or cached[0] != key:
+            cached = (
+                key,
+                self.keyword_index.doc_ids(self.vector_index.rows["chunk_id"]),
+            )
+            self._row_doc_ids = cached
+        return cached[1]
+
+    def _ranked_rows(self, ranked: pl.DataFrame) -> pl.DataFrame:
+        """Returns the vector index rows of the ranked ["chunk_id", "score"] with their score, in the order of ranked.
+
+        The order comes from ranked being the left side of the join, not from the order lookup returns the rows in.
+        Chunks missing from the vector index are left out."""
+        rows = self.vector_index.lookup(ranked["chunk_id"].to_list())
+        return ranked.join(
+            rows, on="chunk_id", how="inner", maintain_order="left"
+        ).select(*rows.columns, "score")
+
+    def keyword_search(
+        self, query: str, k: int = 10, filters: dict | None = None
+    ) -> pl.DataFrame:
+        """BM25 top k. With filters, only the chunks matching them (VectorIndex.filter_rows) are ranked,
+        so k chunks are returned as long as k of them contain query terms."""
+        doc_ids = None
+        rows = self.vector_index.filter_rows(filters)
+        if rows is not None:
+            doc_ids = self.row_doc_ids()[rows]
+        return self._ranked_rows(self.keyword_index.search(query, k, doc_ids))
+
+    def hybrid_search(
+        self, query: str, k: int = 10, filters: dict | None = None
+    ) -> pl.DataFrame:
+        """Fuses the top candidates of the vector and keyword searches. score is the reciprocal rank fusion score."""
+        vector_ids = self.vector_search(query, self.candidates, filters)["chunk_id"]
+        keyword_ids = self.keyword_search(query, self.candidates, filters)["chunk_id"]
+        fused = reciprocal_rank_fusion([vector_ids.to_list(), keyword_ids.to_list()])[
+            :k
+        ]
+        scores = pl.DataFrame(
+            fused, schema={"chunk_id": pl.String, "score": pl.Float64}, orient="row"
+        )
+        return self._ranked_rows(scores)
+
+    def search(
+        self,
+        query: str,
+        k: int = 10,
+        filters: dict | None = None,
+        mode: str = search_mode,
+    ) -> pl.DataFrame:
+        if mode == "vector":
+            return self.vector_search(query, k, filters)
+        if mode == "keyword":
+            return self.keyword_search(query, k, filters)
+        if mode == "hybrid":
+            return self.hybrid_search(query, k, filters)
+        raise ValueError(f"mode must be one of {search_modes}, not {mode!r}")
@@ -0,0 +1,246 @@
+"""## This file contains the processed index, the local record of which videos went through the pipeline
+
+It replaces checking new records against a hard-coded list of existing video_ids, so delta runs only process new sermons.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import polars as pl
+
+import config
+from config import *
+
+stages = ["scraped", "transcribed", "chunked", "ingested"]
+"""The pipeline stages recorded in the index, in order. "ingested" is only recorded once the chunks are in Chroma"""
+
+
+def chunk_params_version() -> str:
+    """Identifies the chunking parameters and chunker_version, so chunks made with different parameters can be detected."""
+    return f"{tokenizer_name}:{chunk_size}:{chunk_overlap}:v{chunker_version}"
+
+
+def config_fingerprint(names: list[str]) -> str:
+    """Returns a hash of the current values of the config names, e.g. of stage_config_dependencies["chunks"]."""
+    values = {name: getattr(config, name) for name in names}
+    return hashlib.blake2b(
+        json.dumps(values, sort_keys=True, default=repr).encode(), digest_size=8
+    ).hexdigest()
+
+
+def stage_fingerprint(stage: str) -> str:
+    """Identifies the config values a pipeline stage depends on (stage_config_dependencies), to detect outdated checkpoints."""
+    return config_fingerprint(stage_config_dependencies.get(stage, []))
+
+
+def metadata_version() -> str:
+    """Identifies the cleaning_rules, so videos cleaned with other rules can be detected."""
+    return config_fingerprint(cleaning_rules)
+
+
+class ProcessedIndex:
+    """A sqlite table keyed by video_id, with one row per video that got through at least one stage.
+
+    - video_id: int - Primary key.
+    - mp4_url: str - Recorded once the video page was scraped.
+    - transcript_hash: int - Recorded once the transcript was made. Stored as a signed int, since sqlite has no u64.
+    - chunk_params_version: str - The chunk_params_version() of the chunks of the video that were ingested.
+    - metadata_version: str - The metadata_version() of the rules that cleaned the section, title and preacher.
+    - stage: str - The last completed stage, one of stages.
+    - processed_at: float - Unix timestamp of the last update.
+    """
+
+    def __init__(self, path: str = state_db_path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._in_transaction = False
+        # The pipeline stages record their progress from different threads
+        self._lock = threading.RLock()
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS processed (
+                video_id INTEGER PRIMARY KEY,
+                mp4_url TEXT,
+                transcript_hash INTEGER,
+                chunk_params_version TEXT,
+                stage TEXT NOT NULL,
+                processed_at REAL NOT NULL
+            )
+            """)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(processed)")]
+        if "metadata_version" not in columns:
+            # Indexes made before it was recorded, their videos count as cleaned with other rules
+            self._db.execute("ALTER TABLE processed ADD COLUMN metadata_version TEXT")
+        # validation looks the videos up by these columns, see find()
+        for column in ["mp4_url", "transcript_hash"]:
+            self._db.execute(
+                f"CREATE INDEX IF NOT EXISTS processed_{column} ON processed ({column})"
+            )
+        self._db.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Groups several record() calls, which are all committed together or not at all."""
+        with self._lock, self._db:
+            self._in_transaction = True
+            try:
+                yield self
+            finally:
+                self._in_transaction = False
+
+    def record(self, df: pl.DataFrame, stage: str):
+        """Marks every video_id of df as having completed stage.
+
+        The mp4_url and transcript_hash columns are saved when df has them.
+        The current metadata_version() is saved, and when stage is "ingested", the current chunk_params_version() too,
+        so it always describes the chunks that are in Chroma.
+        Runs as a single transaction, unless called inside transaction()."""
+        if stage not in stages:
+            raise ValueError(f"Unknown stage {stage!r}, expected one of {stages}")
+        if df.height == 0:
+            # e.g. the checkpoint of a batch without new videos, which may not even have the columns
+            return
+        columns = ["video_id"] + [
+            column for column in ["mp4_url", "transcript_hash"] if column in df.columns
+        ]
+        df = df.select(columns).unique("video_id")
+        if "transcript_hash" in columns:
+            df = df.with_columns(pl.col("transcript_hash").reinterpret(signed=True))
+        df = df.with_columns(
+            pl.lit(stage).alias("stage"),
+            pl.lit(time.time()).alias("processed_at"),
+            pl.lit(metadata_version()).alias("metadata_version"),
+        )
+        if stage == "ingested":
+            df = df.with_columns(
+                pl.lit(chunk_params_version()).alias("chunk_params_version")
+            )
+        columns = df.columns
+        updates = ", ".join(
+            f"{column} = excluded.{column}"
+            for column in columns
+            if column != "video_id"
+        )
+        sql = (
+            f"INSERT INTO processed ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT (video_id) DO UPDATE SET {updates}"
+        )
+        with self._lock:
+            if self._in_transaction:
+                self._db.executemany(sql, df.iter_rows())
+            else:
+                with self._db:
+                    self._db.executemany(sql, df.iter_rows())
+
+    def video_ids(self, stage: str = stages[-1]) -> pl.Series:
+        """Returns the video_ids that completed stage (or any later stage)."""
+        done_stages = stages[stages.index(stage) :]
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT video_id FROM processed WHERE stage IN ({', '.join('?' * len(done_stages))})",
+                done_stages,
+            ).fetchall()
+        return pl.Series("video_id", [row[0] for row in rows], dtype=pl.Int64)
+
+    def stale_chunk_video_ids(self) -> pl.Series:
+        """Returns the video_ids whose ingested chunks were made with other parameters than the current ones."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT video_id FROM processed WHERE stage = 'ingested' AND chunk_params_version != ?",
+                (chunk_params_version(),),
+            ).fetchall()
+        return pl.Series("video_id", [row[0] for row in rows], dtype=pl.Int64)
+
+    def stale_metadata_video_ids(self) -> pl.Series:
+        """Returns the video_ids whose metadata was cleaned with other rules than the current ones."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT video_id FROM processed WHERE metadata_version IS NULL OR metadata_version != ?",
+                (metadata_version(),),
+            ).fetchall()
+        return pl.Series("video_id", [row[0] for row in rows], dtype=pl.Int64)
+
+    def record_metadata_version(self, video_ids: pl.Series):
+        """Marks the metadata of the videos as cleaned with the current rules, e.g. once their chunks were patched."""
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE processed SET metadata_version = ? WHERE video_id = ?",
+                [(metadata_version(), video_id) for video_id in video_ids.to_list()],
+            )
+
+    def filter_unprocessed(
+        self, lf: pl.LazyFrame, stage: str = stages[-1]
+    ) -> pl.LazyFrame:
+        """Removes the rows whose video_id already completed stage, using a hash anti join.
+
+        Videos whose ingested chunks were made with other parameters than the current ones (stale_chunk_video_ids)
+        are kept, so they go through the pipeline again and get rechunked. Videos that were chunked but not ingested
+        (e.g. by a run with --skip-ingest) haven't completed the pipeline, so they are kept too.
+        """
+        processed = self.video_ids(stage).to_frame().lazy()
+        if stage == "ingested":
+            processed = processed.join(
+                self.stale_chunk_video_ids().to_frame().lazy(),
+                on="video_id",
+                how="anti",
+            )
+        return lf.join(processed, on="video_id", how="anti")
+
+    def find(self, column: str, values: pl.Series) -> pl.DataFrame:
+        """Returns the (column, video_id) of the videos whose mp4_url or transcript_hash is one of values.
+
+        Only the matching rows are read, through the index on column, instead of the whole table.
+        """
+        if column not in ["mp4_url", "transcript_hash"]:
+            raise ValueError(f"Unknown column {column!r}")
+        values = values.drop_nulls().unique()
+        if column == "transcript_hash":
+            values = values.cast(pl.UInt64).reinterpret(signed=True)
+        values = values.to_list()
+        rows = []
+        with self._lock:
+            for i in range(0, len(values), 500):
+                batch = values[i : i + 500]
+                rows += self._db.execute(
+                    f"SELECT {column}, video_id FROM processed WHERE {column} IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+        df = pl.DataFrame(
+            rows,
+            schema={
+                column: pl.Int64 if column == "transcript_hash" else pl.String,
+                "video_id": pl.Int64,
+            },
+            orient="row",
+        )
+        if column == "transcript_hash":
+            df = df.with_columns(pl.col(column).reinterpret(signed=False))
+        return df
+
+    def to_df(self) -> pl.DataFrame:
+        """Returns the whole index as a df."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT video_id, mp4_url, transcript_hash, chunk_params_version, metadata_version, stage, processed_at FROM processed"
+            ).fetchall()
+        return pl.DataFrame(
+            rows,
+            schema={
+                "video_id": pl.Int64,
+                "mp4_url": pl.String,
+                "transcript_hash": pl.Int64,
+                "chunk_params_version": pl.String,
+                "metadata_version": pl.String,
+                "stage": pl.String,
+                "processed_at": pl.Float64,
+            },
+            orient="row",
+        ).with_columns(pl.col("transcript_hash").reinterpret(signed=False))
+
+    def close(self):
+        self._db.close()
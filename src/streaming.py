@@ -0,0 +1,189 @@
+"""## This file contains the streaming mode of the transcripts stage, for corpora that don't fit in memory
+
+The scraped records (e.g. the scrape checkpoints, or a legacy transcript.parquet with its vtt column) are scanned
+lazily and processed in batches sized to stream_memory_budget. The vtt of a batch is dropped as soon as the batch
+is validated, the uniqueness of the records across batches is checked against compact sorted arrays of hashes,
+and every batch is sunk straight to a hive partitioned Parquet dataset, so no step holds the whole corpus.
+
+    python main.py stream-transcripts "data/checkpoints/scrape/*.parquet" data/transcripts --memory-budget 1000000000
+"""
+
+import os
+import shutil
+from urllib.parse import quote
+
+import numpy as np
+import polars as pl
+
+import helpers
+import metrics
+import validation
+from config import *
+
+
+class SeenValues:
+    """The values already seen of one unique column, kept as a sorted array of their 64 bit hashes.
+
+    A million values take 8 MB, instead of the values themselves (e.g. whole vtt files).
+    """
+
+    def __init__(self):
+        self._hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Returns a boolean mask of the hashes that were already added."""
+        return np.isin(hashes, self._hashes, assume_unique=False)
+
+    def add(self, hashes: np.ndarray):
+        self._hashes = np.union1d(self._hashes, hashes)
+
+
+def estimate_batch_rows(
+    lf: pl.LazyFrame,
+    memory_budget: int = stream_memory_budget,
+    row_overhead: float = stream_row_overhead,
+) -> int:
+    """Returns the number of rows per batch that fit in memory_budget.
+
+    A row takes about row_overhead times its vtt while its batch is processed (vtt, transcript, worker copies).
+    The budget left after the current RSS is used, the mean vtt size is computed by a streaming scan.
+    """
+    mean_vtt_bytes = (
+        lf.select(pl.col("vtt").str.len_bytes().mean())
+        .collect(engine="streaming")
+        .item()
+        or 1
+    )
+    available = max(memory_budget - metrics.rss_bytes(), memory_budget // 4)
+    return max(1, int(available / (mean_vtt_bytes * row_overhead)))
+
+
+def _write_partitions(
+    df: pl.DataFrame, output_dir: str, partition_by: str, batch_number: int
+):
+    """Writes one batch into the hive partitions of output_dir, e.g. output_dir/section=<section>/part-00001.parquet.
+
+    Each partition is sunk from a lazy filter of the batch, so the partitions are never all copied at once like
+    DataFrame.partition_by does. The batch itself is in memory: the vtt conversion and the validation need it whole,
+    which is why it is sized by estimate_batch_rows."""
+    lf = df.lazy()
+    if partition_by == "video_id":
+        lf = lf.with_columns(
+            (pl.col("video_id") // stream_video_id_range * stream_video_id_range).alias(
+                "video_id_range"
+            )
+        )
+        partition_by = "video_id_range"
+    keys = lf.select(pl.col(partition_by).unique(maintain_order=True)).collect()
+    for key in keys[partition_by]:
+        directory = os.path.join(
+            output_dir, f"{partition_by}={quote(str(key), safe='')}"
+        )
+        os.makedirs(directory, exist_ok=True)
+        lf.filter(pl.col(partition_by).eq_missing(key)).drop(partition_by).sink_parquet(
+            os.path.join(directory, f"part-{batch_number:05}.parquet")
+        )
+
+
+@metrics.instrument("stream_transcripts")
+def stream_transcripts(
+    source: str | list[str],
+    output_dir: str = stream_output_dir,
+    partition_by: str = stream_partition_by,
+    memory_budget: int = stream_memory_budget,
+) -> dict:
+    """Converts the vtt of the scraped records in the source Parquet files into validated transcripts, out of core.
+
+    - Batches are sliced from a lazy scan of the source, sized by estimate_batch_rows, and halved whenever the RSS
+      goes over memory_budget after a batch.
+    - Each batch goes through vtt_column_to_transcript and to_transcript_df, then its vtt is dropped.
+    - Records duplicating a unique column of an earlier batch are quarantined, like the duplicates within a batch.
+    - The transcripts are written to output_dir, partitioned by "section" or by "video_id" range (stream_video_id_range).
+      output_dir is replaced. Read it back with scan_transcripts(output_dir).
+
+    Returns the rows read, written and quarantined, the number of batches and the peak RSS.
+    """
+    if partition_by not in ["section", "video_id"]:
+        raise ValueError(
+            f"partition_by must be 'section' or 'video_id', not {partition_by!r}"
+        )
+    lf = pl.scan_parquet(source)
+    total_rows = lf.select(pl.len()).collect(engine="streaming").item()
+    batch_rows = estimate_batch_rows(lf, memory_budget)
+    unique_columns = [
+        column
+        for column in helpers.TranscriptDataFrameModel.columns
+        if column in helpers.TranscriptDataFrameModel.unique_columns
+    ]
+    seen = {column: SeenValues() for column in unique_columns}
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    summary = {
+        "rows_in": 0,
+        "rows_out": 0,
+        "quarantined": 0,
+        "batches": 0,
+        "peak_rss_bytes": 0,
+    }
+    offset = 0
+    while offset < total_rows:
+        batch = lf.slice(offset, batch_rows).collect()
+        offset += batch.height
+        summary["rows_in"] += batch.height
+        batch = helpers.to_transcript_df(
+            batch.with_columns(
+                helpers.vtt_column_to_transcript(batch["vtt"]).get_columns()
+            )
+        )
+        hashes = {column: batch[column].hash().to_numpy() for column in unique_columns}
+        # Nothing needs the vtt past validation, its hash is all the dedup state keeps
+        batch = batch.drop("vtt")
+
+        duplicate = np.zeros(batch.height, dtype=bool)
+        violations = [[] for _ in range(batch.height)]
+        for column in unique_columns:
+            column_duplicate = seen[column].contains(hashes[column])
+            for i in np.flatnonzero(column_duplicate):
+                violations[i].append(f"{column}.unique")
+            duplicate |= column_duplicate
+        if duplicate.any():
+            validation.quarantine(
+                batch.filter(pl.Series(duplicate)).with_columns(
+                    pl.Series(
+                        "violations",
+                        [violations[i] for i in np.flatnonzero(duplicate)],
+                        dtype=pl.List(pl.String),
+                    )
+                ),
+                "stream_transcripts",
+            )
+            summary["quarantined"] += int(duplicate.sum())
+            batch = batch.filter(pl.Series(~duplicate))
+        for column in unique_columns:
+            seen[column].add(hashes[column][~duplicate])
+
+        _write_partitions(batch, output_dir, partition_by, summary["batches"])
+        summary["rows_out"] += batch.height
+        summary["batches"] += 1
+        del batch, hashes
+
+        rss = metrics.rss_bytes()
+        summary["peak_rss_bytes"] = max(summary["peak_rss_bytes"], rss)
+        if rss > memory_budget and batch_rows > 1:
+            batch_rows = max(1, batch_rows // 2)
+        print(
+            f"stream_transcripts: {offset}/{total_rows} rows, "
+            f"{rss / 2**20:.0f} MiB RSS, next batch {batch_rows} rows"
+        )
+    return summary
+
+
+def scan_transcripts(output_dir: str = stream_output_dir) -> pl.LazyFrame:
+    """Lazily scans the partitioned transcript dataset written by stream_transcripts."""
+    return pl.scan_parquet(
+        os.path.join(output_dir, "**", "*.parquet"), hive_partitioning=True
+    )
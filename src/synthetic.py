@@ -0,0 +1,290 @@
+"""## This file contains the synthetic ATP corpus used by the benchmarks
+
+Everything is generated from a seed, so a benchmark sees the same data on every run and needs no network access.
+iter_chunk_embeddings and iter_chunk_texts generate chunks for the search benchmarks.
+StubServer serves the corpus over HTTP, mimicking the archive.php, video.php?id= and .vtt endpoints of ATP.
+"""
+
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import polars as pl
+
+from config import *
+
+vocabulary = (
+    "the lord jesus christ said unto them verily i say unto you that whosoever believeth "
+    "in him should not perish but have everlasting life and god so loved the world amen "
+    "for by grace are ye saved through faith and that not of yourselves it is the gift of god"
+).split()
+"""Words used to generate synthetic titles and transcripts"""
+
+
+def _raw_section(rng: random.Random, section: str) -> str:
+    """Reintroduces the kind of typos that section_replacements fixes, e.g. 'sermons pastor x' -> 'sermonspastor x'."""
+    if rng.random() < 0.3:
+        for word in ["sermons ", "clips ", "seminar ", "conference "]:
+            if word in section:
+                return section.replace(word, word.strip(), 1)
+    return section
+
+
+def make_archive_records(rng: random.Random, n_videos: int) -> list[dict]:
+    """Generates the [section, title, video_url] records of an archive page with n_videos videos.
+
+    Sections come from section_preacher_map and disallowed_sections, and some titles name a preacher.
+    """
+    sections = list(section_preacher_map) + disallowed_sections
+    preacher_names = list(preacher_names_replacements)
+    video_ids = rng.sample(range(1, n_videos * 10), n_videos)
+    records = []
+    for video_id in video_ids:
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(2, 7))]
+        if rng.random() < 0.3:
+            words.insert(0, rng.choice(preacher_names))
+        if rng.random() < 0.1:
+            words.append(f"{rng.choice(vocabulary)}{rng.randint(2000, 2025)}")
+        video_url = (
+            f"video.php?id={video_id}"
+            if rng.random() < 0.5
+            else f"https://allthepreaching.com/pages/video.php?id={video_id}"
+        )
+        records.append(
+            {
+                "section": _raw_section(rng, rng.choice(sections)),
+                "title": " ".join(words),
+                "video_url": video_url,
+            }
+        )
+    records.sort(key=lambda record: record["section"])
+    return records
+
+
+def make_archive_html(
+    rng: random.Random, n_videos: int, video_url_prefix: str = ""
+) -> str:
+    """Generates an archive page with n_videos links, grouped under <h2> sections like archive.php."""
+    parts = ["<!DOCTYPE html><html><head><title>Archive</title></head><body>"]
+    parts.append(
+        '<nav><a href="/">Home</a><a href="/pages/archive.php">Archive</a></nav>'
+    )
+    current_section = None
+    for record in make_archive_records(rng, n_videos):
+        if record["section"] != current_section:
+            if current_section is not None:
+                parts.append("</ul></div>")
+            current_section = record["section"]
+            parts.append(f"<div class='section'><h2>{current_section.title()}</h2><ul>")
+        parts.append(
+            f"<li><a href=\"{video_url_prefix}{record['video_url']}\" title=\"{record['title'].title()}\">"
+            f"<img src='/thumbs/{record['video_url'][-5:]}.jpg'>{record['title']}</a></li>"
+        )
+    parts.append("</ul></div></body></html>")
+    return "\n".join(parts)
+
+
+def make_vtt(rng: random.Random, n_cues: int = 600) -> str:
+    """Generates an auto-generated style WebVTT, where every cue rolls the previous line over and adds a new one."""
+
+    def timestamp(seconds: float) -> str:
+        return f"{int(seconds // 3600):02}:{int(seconds % 3600 // 60):02}:{seconds % 60:06.3f}"
+
+    lines = ["WEBVTT", "Kind: captions", "Language: en", ""]
+    previous_line = ""
+    for i in range(n_cues):
+        line = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(4, 9)))
+        lines.append(
+            f"{timestamp(i * 2.0)} --> {timestamp(i * 2.0 + 2.0)} align:start position:0%"
+        )
+        if previous_line:
+            lines.append(previous_line)
+        lines.append(line)
+        lines.append("")
+        previous_line = line
+    return "\n".join(lines)
+
+
+def make_scraped_df(
+    rng: random.Random, n_videos: int, n_cues: int = 200
+) -> pl.DataFrame:
+    """Generates the output of the scrape stage (pre-scraping fields, media urls and vtt) for n_videos videos."""
+    import helpers
+
+    df = helpers.to_pre_scraping_df(make_archive_records(rng, n_videos))
+    return df.with_columns(
+        (
+            pl.lit("https://cdn.allthepreaching.com/media/")
+            + pl.col("video_id").cast(pl.String)
+            + pl.lit(".mp4")
+        ).alias("mp4_url"),
+    ).with_columns(
+        pl.col("mp4_url").str.replace("mp4", "mp3").alias("mp3_url"),
+        pl.col("mp4_url").str.replace("mp4", "vtt").alias("vtt_url"),
+        pl.Series("vtt", [make_vtt(rng, n_cues) for _ in range(df.height)]),
+    )
+
+
+def iter_chunk_embeddings(
+    n_chunks: int,
+    dim: int = 384,
+    seed: int = 0,
+    batch_size: int = 50_000,
+    n_preachers: int = 50,
+    n_sections: int = 20,
+):
+    """Yields (rows, embeddings) batches of n_chunks synthetic chunk records and their embeddings, for the search benchmarks.
+
+    Videos have 20 chunks and belong to one of n_preachers preachers and n_sections sections. The embeddings of a video
+    are scattered around one of 1000 topic vectors, so searches have near neighbours like real embeddings do.
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((1000, dim), dtype=np.float32)
+    words = np.array(vocabulary)
+    for start in range(0, n_chunks, batch_size):
+        chunk_ids = np.arange(start, min(start + batch_size, n_chunks))
+        video_ids = chunk_ids // 20
+        embeddings = topics[video_ids % len(topics)] + rng.standard_normal(
+            (len(chunk_ids), dim), dtype=np.float32
+        )
+        chunks = [
+            " ".join(row)
+            for row in words[rng.integers(0, len(words), (len(chunk_ids), 12))]
+        ]
+        rows = pl.DataFrame(
+            {
+                "video_id": video_ids,
+                "chunk_number": chunk_ids % 20 + 1,
+                "chunk": chunks,
+            }
+        ).with_columns(
+            (
+                pl.col("video_id").cast(pl.String)
+                + "_"
+                + pl.col("chunk_number").cast(pl.String)
+            ).alias("chunk_id"),
+            ("preacher " + (pl.col("video_id") % n_preachers).cast(pl.String)).alias(
+                "preacher"
+            ),
+            ("section " + (pl.col("video_id") % n_sections).cast(pl.String)).alias(
+                "section"
+            ),
+            ("title " + pl.col("video_id").cast(pl.String)).alias("title"),
+        )
+        yield rows, embeddings
+
+
+def iter_chunk_texts(
+    n_chunks: int,
+    words_per_chunk: int = 200,
+    vocabulary_size: int = 50_000,
+    seed: int = 0,
+    batch_size: int = 10_000,
+):
+    """Yields (chunk_ids, texts) batches of n_chunks synthetic chunk texts, for the keyword search benchmarks.
+
+    Words are drawn from a Zipf distribution over vocabulary_size words ("w0" the most common), like natural text,
+    so a query mixes words found in most chunks with rare ones."""
+    rng = np.random.default_rng(seed)
+    words = np.array([f"w{i}" for i in range(vocabulary_size)])
+    for start in range(0, n_chunks, batch_size):
+        count = min(batch_size, n_chunks - start)
+        word_ids = np.minimum(
+            rng.zipf(1.2, (count, words_per_chunk)) - 1, vocabulary_size - 1
+        )
+        yield [f"{i // 20}_{i % 20 + 1}" for i in range(start, start + count)], [
+            " ".join(row) for row in words[word_ids]
+        ]
+
+
+class StubServer:
+    """A local HTTP server serving a synthetic ATP site, for scraper benchmarks.
+
+    - /pages/archive.php: an archive page with n_videos links.
+    - /pages/video.php?id=<id>: a video page whose <video> points at /media/<id>.mp4.
+    - /media/<id>.vtt: the WebVTT of the video, generated from seed + id.
+
+    Every response waits latency seconds first, to simulate the network. Use it as a context manager:
+
+        with StubServer(1000, latency=0.05) as server:
+            fetching.fetch_urls([server.url + "/pages/video.php?id=1"])
+    """
+
+    def __init__(
+        self,
+        n_videos: int = 1000,
+        latency: float = 0.0,
+        seed: int = 0,
+        n_cues: int = 600,
+    ):
+        self.n_videos = n_videos
+        self.latency = latency
+        self.seed = seed
+        self.n_cues = n_cues
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _respond(self, path: str, query: dict) -> tuple[int, str, str]:
+        """Returns the status, content type and body of a request."""
+        if path == "/pages/archive.php":
+            html = make_archive_html(
+                random.Random(self.seed), self.n_videos, f"{self.url}/pages/"
+            )
+            return 200, "text/html", html
+        if path == "/pages/video.php" and query.get("id", [""])[0].isdigit():
+            video_id = query["id"][0]
+            html = (
+                "<!DOCTYPE html><html><body><h1>Video</h1>"
+                f'<video controls src="{self.url}/media/{video_id}.mp4"></video>'
+                "</body></html>"
+            )
+            return 200, "text/html", html
+        if path.startswith("/media/") and path.endswith(".vtt"):
+            video_id = path[len("/media/") : -len(".vtt")]
+            if video_id.isdigit():
+                vtt = make_vtt(random.Random(self.seed + int(video_id)), self.n_cues)
+                return 200, "text/vtt", vtt
+        return 404, "text/plain", "Not Found"
+
+    def __enter__(self) -> "StubServer":
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urlsplit(self.path)
+                status, content_type, body = stub._respond(
+                    url.path, parse_qs(url.query)
+                )
+                body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
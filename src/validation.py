@@ -0,0 +1,160 @@
+"""## This file contains the validation of the stage outputs against their patito models
+
+Each model is compiled once into one boolean Polars expression per rule (pattern, min_length, unique, ...),
+which are added to the lazy plan of the stage, so the rows are checked while the plan runs instead of in a second
+full-frame validate() pass. Rows breaking a rule are written to the quarantine, a Parquet side table, with the
+rules they broke, instead of raising or being printed."""
+
+import functools
+import glob
+import os
+import time
+
+import patito as pt
+import polars as pl
+
+import metrics
+from config import *
+from state import ProcessedIndex
+
+index_unique_columns = ["mp4_url", "transcript_hash"]
+"""Unique columns that are also recorded in the processed index, so their uniqueness is checked across runs"""
+
+
+@functools.cache
+def compile_model(
+    model: type[pt.Model], columns: tuple[str] | None = None
+) -> dict[str, pl.Expr]:
+    """Compiles the field constraints of the model into {rule name: expression}, True for the rows that follow the rule.
+
+    Only the given columns are compiled, e.g. to skip the columns an earlier stage already validated.
+    Rule names are "<column>.<constraint>", e.g. "mp4_url.pattern". Uniqueness is compiled separately (see validate).
+    """
+    properties = model._schema_properties()
+    rules = {}
+    for column in columns or model.columns:
+        field = properties[column]
+        value = pl.col(column)
+        if column not in model.nullable_columns:
+            rules[f"{column}.not_null"] = value.is_not_null()
+        if "pattern" in field:
+            rules[f"{column}.pattern"] = value.str.contains(field["pattern"])
+        if "minLength" in field:
+            rules[f"{column}.min_length"] = value.str.len_chars() >= field["minLength"]
+        if "maxLength" in field:
+            rules[f"{column}.max_length"] = value.str.len_chars() <= field["maxLength"]
+        if "minimum" in field:
+            rules[f"{column}.minimum"] = value >= field["minimum"]
+        if "maximum" in field:
+            rules[f"{column}.maximum"] = value <= field["maximum"]
+        if "exclusiveMinimum" in field:
+            rules[f"{column}.exclusive_minimum"] = value > field["exclusiveMinimum"]
+        if "exclusiveMaximum" in field:
+            rules[f"{column}.exclusive_maximum"] = value < field["exclusiveMaximum"]
+        constraints = model.column_infos[column].constraints
+        if constraints is not None:
+            constraints = (
+                constraints if isinstance(constraints, list) else [constraints]
+            )
+            for i, constraint in enumerate(constraints):
+                rules[f"{column}.constraint_{i}"] = constraint
+    # A null value only breaks the not_null rule
+    return {
+        name: rule if name.endswith(".not_null") else rule.fill_null(True)
+        for name, rule in rules.items()
+    }
+
+
+def _check_schema(schema: pl.Schema, model: type[pt.Model], columns: list[str]):
+    """Raises a ValueError if columns are missing or have the wrong dtype, which is a bug rather than bad data."""
+    errors = []
+    for column in columns:
+        if column not in schema:
+            errors.append(f"{column}: missing")
+        elif schema[column] not in model.valid_dtypes[column]:
+            errors.append(f"{column}: unexpected dtype {schema[column]}")
+    if errors:
+        raise ValueError(f"{model.__name__} schema errors: {'; '.join(errors)}")
+
+
+def validate(
+    df: pl.DataFrame | pl.LazyFrame,
+    model: type[pt.Model],
+    stage: str,
+    columns: list[str] | None = None,
+    processed_index: ProcessedIndex | None = None,
+) -> pl.DataFrame:
+    """Returns the rows of df that follow the rules of the model, and quarantines the others.
+
+    - columns: Only validates these columns of the model, all of them by default.
+    - Unique columns must be unique among the valid rows, the first occurrence is kept.
+    - With a processed_index, the index_unique_columns also can't already belong to another video. Only the values
+      of df are looked up in the index.
+
+    The rules are evaluated in the same plan as df, which is collected once. With a processed_index, df is collected
+    first to know which values to look up, and the rules run on the collected rows."""
+    columns = list(columns or model.columns)
+    lf = df.lazy()
+    _check_schema(lf.collect_schema(), model, columns)
+    rules = dict(compile_model(model, tuple(columns)))
+
+    valid = pl.all_horizontal(list(rules.values())) if rules else pl.lit(True)
+    for column in [c for c in columns if c in model.unique_columns]:
+        # Only valid rows take part, so an invalid first occurrence doesn't get a valid duplicate quarantined
+        rules[f"{column}.unique"] = (
+            pl.when(valid).then(pl.col(column)).is_first_distinct() | ~valid
+        )
+    index_columns = []
+    index_check_columns = [c for c in index_unique_columns if c in columns]
+    if (
+        processed_index is not None
+        and index_check_columns
+        and "video_id" in lf.collect_schema()
+    ):
+        lf = lf.collect().lazy()
+        for column in index_check_columns:
+            index_column = f"{column}_indexed_video_id"
+            other_videos = (
+                processed_index.find(column, lf.select(column).collect()[column])
+                .select(column, pl.col("video_id").alias(index_column))
+                .unique(column, keep="first")
+                .with_columns(pl.col(column).cast(lf.collect_schema()[column]))
+            )
+            lf = lf.join(other_videos.lazy(), on=column, how="left")
+            rules[f"{column}.unique_in_index"] = pl.col(index_column).is_null() | (
+                pl.col(index_column) == pl.col("video_id")
+            )
+            index_columns.append(index_column)
+
+    violations = pl.concat_list(
+        [pl.when(~rule).then(pl.lit(name)) for name, rule in rules.items()]
+    ).list.drop_nulls()
+    df = lf.with_columns(violations.alias("violations")).drop(index_columns).collect()
+    is_valid = pl.col("violations").list.len() == 0
+    quarantined = df.filter(~is_valid)
+    if quarantined.height:
+        quarantine(quarantined, stage)
+        metrics.record_dropped(
+            stage,
+            dict(quarantined["violations"].explode().value_counts().iter_rows()),
+        )
+    return df.filter(is_valid).drop("violations")
+
+
+def quarantine(df: pl.DataFrame, stage: str):
+    """Appends the invalid rows of a stage to its quarantine, with the time they were quarantined."""
+    directory = os.path.join(quarantine_dir, stage)
+    os.makedirs(directory, exist_ok=True)
+    df.with_columns(pl.lit(time.time()).alias("quarantined_at")).write_parquet(
+        os.path.join(directory, f"{time.time_ns()}.parquet")
+    )
+
+
+def read_quarantine(stage: str) -> pl.LazyFrame | None:
+    """Returns the quarantined rows of a stage, or None if none were quarantined."""
+    paths = glob.glob(os.path.join(quarantine_dir, stage, "*.parquet"))
+    if not paths:
+        return None
+    return pl.concat(
+        [pl.scan_parquet(path) for path in sorted(paths)], how="diagonal_relaxed"
+    )
@@ -0,0 +1,413 @@
+"""## This file contains the local vector query engine over the chunk embeddings, for the search app
+
+The index is a directory written by build_vector_index (from the Chroma collection) or write_vector_index:
+
+- vectors.f32: the L2-normalized embeddings, a rows x dim float32 matrix. Or vectors.i8 and scales.f32 with int8
+  quantization, a quarter of the size, each row being stored as round(vector / scale) with scale = max(|vector|) / 127.
+- rows.arrow: the chunk_id, metadata and text of every row, as an uncompressed Arrow IPC file.
+- <column>.bits: one packed bitmap of the rows per value of every vector_index_filter_columns column.
+- meta.json: the dim, rows, quantization and the values of the bitmaps.
+
+Everything is memory-mapped, so opening an index takes milliseconds whatever its size. A query is a matmul of the
+query embeddings with blocks of the matrix and an argpartition per block, and filters are ORs / ANDs of the bitmaps,
+so no metadata is checked row by row in Python."""
+
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import polars as pl
+
+from config import *
+
+result_columns = [
+    "chunk_id",
+    "video_id",
+    "chunk_number",
+    "start_seconds",
+    "end_seconds",
+    "section",
+    "title",
+    "preacher",
+    "video_url",
+    "mp4_url",
+    "chunk",
+]
+"""The columns of rows.arrow, returned with the score of every result"""
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalizes the rows, so dot products are cosine similarities."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the int8 rows and the float32 scale of every row, vector ~= int8 row * scale."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+
+class VectorIndexWriter:
+    """Writes an index directory block by block with write(rows, embeddings), so the embeddings never have to be
+    in memory at once. It writes into <path>.tmp, which replaces path on close(), so readers never see a half written index.
+    """
+
+    def __init__(self, path: str, quantize: bool):
+        self.path = path
+        self.tmp_path = path.rstrip("/\\") + ".tmp"
+        self.quantize = quantize
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.dim = None
+        self.row_count = 0
+        self.row_dfs = []
+        self._vectors = open(
+            os.path.join(self.tmp_path, "vectors.i8" if quantize else "vectors.f32"),
+            "wb",
+        )
+        self._scales = (
+            open(os.path.join(self.tmp_path, "scales.f32"), "wb") if quantize else None
+        )
+
+    def write(self, rows: pl.DataFrame, embeddings: np.ndarray):
+        embeddings = _normalize(embeddings)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        if self.quantize:
+            vectors, scales = quantize_int8(embeddings)
+            self._vectors.write(vectors.tobytes())
+            self._scales.write(scales.tobytes())
+        else:
+            self._vectors.write(embeddings.tobytes())
+        self.row_dfs.append(
+            rows.select(
+                [
+                    (
+                        pl.col(column)
+                        if column in rows.columns
+                        else pl.lit(None).alias(column)
+                    )
+                    for column in result_columns
+                ]
+            )
+        )
+        self.row_count += rows.height
+
+    def close(self) -> str:
+        self._vectors.close()
+        if self._scales is not None:
+            self._scales.close()
+        rows = (
+            pl.concat(self.row_dfs, how="vertical_relaxed")
+            if self.row_dfs
+            else pl.DataFrame({column: [] for column in result_columns})
+        )
+        rows.write_ipc(
+            os.path.join(self.tmp_path, "rows.arrow"), compression="uncompressed"
+        )
+        filter_values = {}
+        for column in vector_index_filter_columns:
+            values = rows[column].drop_nulls().unique().sort()
+            filter_values[column] = values.to_list()
+            # The bitmap of a value is its row of a values x ceil(rows / 8) uint8 matrix
+            codes = (
+                rows[column]
+                .cast(pl.Enum(values))
+                .to_physical()
+                .fill_null(len(values))
+                .to_numpy()
+            )
+            bits = np.stack(
+                [np.packbits(codes == i) for i in range(len(values))]
+                or [np.empty(0, dtype=np.uint8)]
+            )
+            bits.tofile(os.path.join(self.tmp_path, f"{column}.bits"))
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim or 0,
+                    "rows": self.row_count,
+                    "quantized": self.quantize,
+                    "filter_values": filter_values,
+                },
+                f,
+            )
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+
+def write_vector_index(
+    rows: pl.DataFrame,
+    embeddings: np.ndarray,
+    path: str = vector_index_dir,
+    quantize: bool = vector_index_quantize,
+) -> str:
+    """Writes an index of the chunk rows (see result_columns) and their embeddings, in the same order. Returns its path."""
+    writer = VectorIndexWriter(path, quantize)
+    for offset in range(0, rows.height, vector_index_build_batch_size):
+        writer.write(
+            rows.slice(offset, vector_index_build_batch_size),
+            embeddings[offset : offset + vector_index_build_batch_size],
+        )
+    return writer.close()
+
+
+def build_vector_index(
+    collection=None,
+    path: str = vector_index_dir,
+    quantize: bool = vector_index_quantize,
+    batch_size: int = vector_index_build_batch_size,
+) -> str:
+    """Builds the index of every chunk of the Chroma collection (get_chunk_collection() by default), page by page."""
+    if collection is None:
+        import ingest
+
+        collection = ingest.get_chunk_collection()
+    writer = VectorIndexWriter(path, quantize)
+    total = collection.count()
+    for offset in range(0, total, batch_size):
+        page = collection.get(
+            limit=batch_size,
+            offset=offset,
+            include=["embeddings", "metadatas", "documents"],
+        )
+        if not page["ids"]:
+            break
+        rows = pl.DataFrame(page["metadatas"], infer_schema_length=None).with_columns(
+            pl.Series("chunk_id", page["ids"], dtype=pl.String),
+            pl.Series("chunk", page["documents"], dtype=pl.String),
+        )
+        writer.write(rows, np.asarray(page["embeddings"], dtype=np.float32))
+        print(f"vector index: {offset + len(page['ids'])}/{total} chunks")
+    return writer.close()
+
+
+def _stat_key(path: str) -> tuple | None:
+    """Identifies the version of a file, which changes when it is written again or replaced."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class VectorIndex:
+    """A memory-mapped index written by write_vector_index or build_vector_index.
+
+    - search(query_embeddings, k, filters) returns the top k rows of every query, by cosine similarity.
+    - submit(...) runs search on the thread pool of the index, for concurrent queries.
+    - lookup(chunk_ids) returns the rows of chunks, e.g. of the keyword search results.
+
+    filters maps a vector_index_filter_columns column to the allowed value(s), e.g. {"preacher": ["Steven Anderson"]}.
+    Values of one column are ORed, columns are ANDed.
+    """
+
+    def __init__(
+        self,
+        path: str = vector_index_dir,
+        workers: int = vector_query_workers,
+        block_rows: int = vector_index_block_rows,
+    ):
+        self.path = path
+        self.block_rows = block_rows
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.row_count = meta["rows"]
+        self.quantized = meta["quantized"]
+        self.filter_values = meta["filter_values"]
+        shape = (self.row_count, self.dim)
+        if self.row_count == 0:
+            self.vectors = np.empty(
+                shape, dtype=np.int8 if self.quantized else np.float32
+            )
+            self.scales = np.empty(0, dtype=np.float32)
+        elif self.quantized:
+            self.vectors = np.memmap(
+                os.path.join(path, "vectors.i8"), dtype=np.int8, mode="r", shape=shape
+            )
+            self.scales = np.memmap(
+                os.path.join(path, "scales.f32"),
+                dtype=np.float32,
+                mode="r",
+                shape=(self.row_count,),
+            )
+        else:
+            self.vectors = np.memmap(
+                os.path.join(path, "vectors.f32"),
+                dtype=np.float32,
+                mode="r",
+                shape=shape,
+            )
+            self.scales = None
+        self.rows = pl.read_ipc(os.path.join(path, "rows.arrow"), memory_map=True)
+        self._bitmaps = {}
+        for column, values in self.filter_values.items():
+            bitmap_path = os.path.join(path, f"{column}.bits")
+            self._bitmaps[column] = (
+                np.memmap(
+                    bitmap_path,
+                    dtype=np.uint8,
+                    mode="r",
+                    shape=(len(values), (self.row_count + 7) // 8),
+                )
+                if values and self.row_count
+                else np.zeros((0, (self.row_count + 7) // 8), dtype=np.uint8)
+            )
+        self._value_positions = {
+            column: {value: i for i, value in enumerate(values)}
+            for column, values in self.filter_values.items()
+        }
+        self._workers = workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._row_numbers = None
+        self._meta_stat = _stat_key(os.path.join(path, "meta.json"))
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    def is_outdated(self) -> bool:
+        """True if the index directory was replaced since it was opened, e.g. by `python main.py vector-index`."""
+        return _stat_key(os.path.join(self.path, "meta.json")) != self._meta_stat
+
+    def reopen(self) -> "VectorIndex":
+        """Returns the index opened again from path, with the same workers and block_rows, and closes this one."""
+        index = VectorIndex(self.path, self._workers, self.block_rows)
+        self.close()
+        return index
+
+    def lookup(self, chunk_ids: list[str]) -> pl.DataFrame:
+        """Returns the rows of the chunk_ids, in their order. Unknown chunk_ids are left out.
+
+        The chunk_id -> row number map is built on the first lookup, not when the index is opened.
+        """
+        with self._executor_lock:
+            if self._row_numbers is None:
+                self._row_numbers = {
+                    chunk_id: i for i, chunk_id in enumerate(self.rows["chunk_id"])
+                }
+        row_numbers = [
+            self._row_numbers[chunk_id]
+            for chunk_id in chunk_ids
+            if chunk_id in self._row_numbers
+        ]
+        return self.rows[row_numbers]
+
+    def filter_rows(self, filters: dict | None) -> np.ndarray | None:
+        """Returns the sorted row numbers matching the filters, None without filters (every row matches)."""
+        if not filters:
+            return None
+        mask = None
+        for column, values in filters.items():
+            if column not in self._bitmaps:
+                raise ValueError(
+                    f"{column} is not a filter column, use one of {vector_index_filter_columns}"
+                )
+            values = [values] if isinstance(values, str) else values
+            positions = [
+                self._value_positions[column][value]
+                for value in values
+                if value in self._value_positions[column]
+            ]
+            if not positions:
+                return np.empty(0, dtype=np.int64)
+            column_mask = np.bitwise_or.reduce(self._bitmaps[column][positions], axis=0)
+            mask = column_mask if mask is None else mask & column_mask
+        return np.flatnonzero(np.unpackbits(mask, count=self.row_count))
+
+    def _scores(self, block: np.ndarray, scales, queries: np.ndarray) -> np.ndarray:
+        """Returns the queries x block rows similarities."""
+        if self.quantized:
+            return (queries @ block.T.astype(np.float32)) * scales
+        return queries @ block.T
+
+    def _blocks(self, rows: np.ndarray | None):
+        """Yields the (row numbers, vectors, scales) of the rows to score, block_rows at a time.
+
+        Without filters, or when most rows match, contiguous slices of the matrix are read. Otherwise only the
+        matching rows are gathered, so a selective filter reads a fraction of the matrix.
+        """
+        if rows is None or len(rows) > self.row_count // 2:
+            for start in range(0, self.row_count, self.block_rows):
+                end = min(start + self.block_rows, self.row_count)
+                block_rows = np.arange(start, end)
+                scales = self.scales[start:end] if self.quantized else None
+                if rows is not None:
+                    # Few rows are filtered out, they are dropped after the matmul instead
+                    block_rows = rows[(rows >= start) & (rows < end)]
+                    yield block_rows, self.vectors[
+                        start:end
+                    ], scales, block_rows - start
+                else:
+                    yield block_rows, self.vectors[start:end], scales, None
+            return
+        for start in range(0, len(rows), self.block_rows):
+            block_rows = rows[start : start + self.block_rows]
+            scales = self.scales[block_rows] if self.quantized else None
+            yield block_rows, self.vectors[block_rows], scales, None
+
+    def search(
+        self, query_embeddings: np.ndarray, k: int = 10, filters: dict | None = None
+    ) -> list[pl.DataFrame]:
+        """Returns the top k rows of every query embedding (one per row of query_embeddings, or a single vector),
+        as a df of the result_columns and their "score", best first."""
+        queries = _normalize(np.atleast_2d(query_embeddings))
+        rows = self.filter_rows(filters)
+        candidate_rows = []
+        candidate_scores = []
+        for block_rows, block, scales, keep in self._blocks(rows):
+            if not len(block_rows):
+                continue
+            scores = self._scores(block, scales, queries)
+            if keep is not None:
+                scores = scores[:, keep]
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                candidate_scores.append(np.take_along_axis(scores, top, axis=1))
+                candidate_rows.append(block_rows[top])
+            else:
+                candidate_scores.append(scores)
+                candidate_rows.append(np.broadcast_to(block_rows, scores.shape))
+
+        results = []
+        if not candidate_scores:
+            empty = self.rows.clear().with_columns(
+                pl.lit(None, pl.Float32).alias("score")
+            )
+            return [empty for _ in range(len(queries))]
+        all_scores = np.concatenate(candidate_scores, axis=1)
+        all_rows = np.concatenate(candidate_rows, axis=1)
+        for query_scores, query_rows in zip(all_scores, all_rows):
+            top = (
+                np.argpartition(-query_scores, k - 1)[:k]
+                if len(query_scores) > k
+                else np.arange(len(query_scores))
+            )
+            top = top[np.argsort(-query_scores[top], kind="stable")]
+            results.append(
+                self.rows[query_rows[top]].with_columns(
+                    pl.Series("score", query_scores[top], dtype=pl.Float32)
+                )
+            )
+        return results
+
+    def submit(
+        self, query_embeddings: np.ndarray, k: int = 10, filters: dict | None = None
+    ) -> Future:
+        """Runs search on the thread pool of the index. NumPy releases the GIL in the matmul, so queries overlap."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        return self._executor.submit(self.search, query_embeddings, k, filters)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()